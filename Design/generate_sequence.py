@@ -13,11 +13,15 @@ from cnn_model import cnn
 from train import load_model
 from data_processing import readinfasta, quick_onehot, check
 import time
+import multiprocessing
 import matplotlib as plt
 from modules import loss_dict
+from ism import ism_loss, ism_batch_loss, sequence_loss
+from incremental import incremental_forward
+from model_ensemble import load_ensemble, model_ensemble
 
-# Enable scoring with set of models from different folds or different intializations
-# 
+# Scoring with a set of models from different folds or different intializations: give a comma separated list of
+# model_params.dat files or a text file with one per line, the mean of all models is optimized, see model_ensemble.py
 
 # Use different attribution methods for GA:
     # Gradient
@@ -52,8 +56,12 @@ def random_sequences(n, l):
     return randseq
 
 
-def optimize_sequences(start, model, targ, loss_function = 'MSE', scoring = 'forward', updates = 'genetic', patience = 100, max_iter = 1000, device = 'cpu', **kwargs):
+# incremental: keep activations of convolutional layers and only update the receptive field of the changed base, see incremental.py
+def optimize_sequences(start, model, targ, loss_function = 'MSE', scoring = 'forward', updates = 'genetic', patience = 100, max_iter = 1000, device = 'cpu', incremental = False, **kwargs):
     
+    if incremental and 'gradient' in scoring:
+        print('Incremental forward pass not possible with gradient scoring, use full forward pass')
+        incremental = False
    
     start, targ = torch.Tensor(start).unsqueeze(0), torch.Tensor(targ).unsqueeze(0)
     bestseq = np.copy(start)
@@ -68,6 +76,8 @@ def optimize_sequences(start, model, targ, loss_function = 'MSE', scoring = 'for
     cseq = torch.clone(start)
     cseq.requires_grad = True
     
+    if incremental:
+        model = incremental_forward(model)
     ppred = model.forward(cseq)
     start_score = ppred.detach().numpy()[0]
     #opt_score.append(start_score)
@@ -80,14 +90,18 @@ def optimize_sequences(start, model, targ, loss_function = 'MSE', scoring = 'for
         t += 1
         
         cseq.requires_grad = True
-        pscore = positional_scoring(nloss, cseq, model = model, loss = loss, target = targ)
+        # forward scoring computes the mutants from the activations that the incremental model keeps for cseq
+        pscore = positional_scoring(nloss, cseq, model = model.model if incremental and scoring != 'forward' else model, loss = loss, target = targ)
         if np.sum(pscore > 0) == 0:
             return bestseq, opt_score[:t-not_imp], start_score, change_pos[:t-not_imp], change_base[:t-not_imp], orig_base[:t-not_imp]
         
         cseq, pos, obase, nbase = update_sequence(cseq, pscore)
         #print(pos, obase, nbase)
         #print(''.join(np.array(list('ACGT'))[np.where(cseq[0].detach().numpy().T>0)[1]]))
-        pred = model.forward(cseq)
+        if incremental:
+            pred = model.update(cseq, pos)
+        else:
+            pred = model.forward(cseq)
         nloss = loss(pred, targ)
         
         
@@ -115,30 +129,15 @@ class positional_scoring_function(nn.Module):
         
     def forward(self, diffloss, nseq, model = None, loss = None, target = None):
         if self.scoretype == 'forward':
-            # remove for loop with extension of axis = 0 in nseq, then set all positions to 0 individually and then insert the one all at once
+            # all mutants are generated at once and run through the model in batches, see ism.py
             if model is None or loss is None or target is None:
                 print("Provide model, loss, and target")
                 sys.exit()
-            loss.reduction = 'none'
-            setto = np.array(np.where(nseq[0] == 0))
-            icur = np.array(np.where(nseq[0] == 1))
-            with torch.no_grad():
-                target = target.expand(len(setto[0])+1,-1)
-                tseq = torch.clone(nseq.detach())
-                tseq = tseq.repeat(len(setto[0])+1,1,1)
-                iscur = []
-                for i in range(len(setto[0])):
-                    iscur.append([icur[0][icur[1] == setto[1][i]][0] , setto[1][i]])
-                    tseq[i, :, setto[1][i]] = 0
-                    tseq[i, setto[0][i], setto[1][i]] = 1
-                iscur = np.array(iscur).T
-                tpred = model.forward(tseq)
-                ismloss = loss(tpred,target)
-                ismloss = torch.mean(ismloss, axis = 1)
-                impact = np.zeros(nseq.size())
-                diffloss = ismloss[-1]
-                impact[0, setto[0], setto[1]] = diffloss - ismloss[:-1]
-                loss.reduction = 'mean'
+            if isinstance(model, incremental_forward):
+                ismloss, refloss, ref_pred = model.ism_loss(nseq, target, loss)
+            else:
+                ismloss, refloss, ref_pred = ism_loss(model, nseq, target, loss)
+            impact = -ismloss[None,...]
             '''
             lenseq = nseq.size(dim=-1)
             with torch.no_grad():
@@ -248,6 +247,177 @@ class update_algs(nn.Module):
     
 
 
+# Scores for all positions of a population of sequences (N, 4, L) at once, same as positional_scoring_function for single sequences
+def population_scoring(scoretype, cseqs, model, loss, targets, max_memory = 1024):
+    if scoretype == 'forward':
+        ismloss, refloss, preds = ism_batch_loss(model, cseqs, targets, loss, max_memory = max_memory)
+        return -ismloss
+    elif scoretype == 'gradient' or scoretype == 'gradient_difference':
+        cseqs = cseqs.detach().clone()
+        cseqs.requires_grad = True
+        # sum of individual losses, so that every sequence receives the gradient of its own loss
+        nloss = torch.sum(sequence_loss(loss, model.forward(cseqs), targets))
+        nloss.backward()
+        grad = cseqs.grad.numpy()
+        if scoretype == 'gradient':
+            grad = -grad
+            grad[np.where(cseqs.detach().numpy() > 0)] = 0
+        else:
+            grad = -grad + np.sum(grad*cseqs.detach().numpy(), axis = 1)[:,None]
+        return grad
+    elif scoretype == 'random_forward':
+        scoring = positional_scoring_function(scoretype)
+        pscore = []
+        for i in range(len(cseqs)):
+            with torch.no_grad():
+                diffloss = sequence_loss(loss, model.forward(cseqs[[i]]), targets[[i]])[0]
+            pscore.append(scoring(diffloss, cseqs[[i]], model = model, loss = loss, target = targets[[i]])[0])
+        return np.array(pscore)
+    elif scoretype == 'random':
+        return np.random.random(cseqs.size())
+
+
+# Update of one base in every sequence of a population, same rules as update_algs
+# Temperature and the last changed position are tracked for every sequence individually with their index in the population
+class population_update(nn.Module):
+    def __init__(self, uptype, n_seqs, init_scaling = .25, temp_update = 'linear', nts = np.array(list('ACGT')), baseline = 1.):
+        super(population_update, self).__init__()
+        
+        self.uptype = uptype
+        self.init_scaling = np.ones(n_seqs)*init_scaling
+        self.t = np.ones(n_seqs, dtype = int)
+        self.nts = nts
+        self.last_pos = -np.ones((n_seqs, 2), dtype = int)
+        self.baseline = baseline
+        self.temp_update = temp_update
+        
+    def forward(self, cseqs, pscore, ids):
+        n = len(ids)
+        npseq = cseqs.detach().numpy()
+        has_last = self.last_pos[ids,0] >= 0
+        if has_last.any():
+            pscore[np.where(has_last)[0], self.last_pos[ids[has_last],0], self.last_pos[ids[has_last],1]] = np.amin(pscore.reshape(n, -1), axis = 1)[has_last]
+        # positions are ordered by position first and then base, as in update_algs
+        pscore = np.transpose(pscore, axes = (0,2,1)).reshape(n, -1)
+        if self.uptype == 'genetic':
+            chosenpos = np.argmax(pscore, axis = 1)
+        else:
+            pscore[pscore < self.baseline] = self.baseline
+            pscore[np.transpose(npseq, axes = (0,2,1)).reshape(n, -1) > 0] = 0
+            if self.temp_update == 'equalchance':
+                proba = (pscore > 0).astype(float)
+            else:
+                first = self.t[ids] == 1
+                self.init_scaling[ids[first]] = np.amax(pscore[first], axis = 1)*self.init_scaling[ids[first]]
+                scaling = self.init_scaling[ids]/self.t[ids]
+                proba = np.exp(pscore/scaling[:,None])
+                mask = np.isinf(proba)
+                rmask = mask.any(axis = 1)
+                proba[rmask] = mask[rmask].astype(float)
+                proba = proba/np.amax(proba, axis = 1)[:,None]
+            proba = np.cumsum(proba, axis = 1)
+            # sample one position per sequence from the cumulative probabilities
+            chosenpos = np.sum(proba < np.random.random(n)[:,None]*proba[:,[-1]], axis = 1)
+        
+        pos = (chosenpos/4).astype(int)
+        obase_i = np.argmax(npseq[np.arange(n), :, pos], axis = 1)
+        self.last_pos[ids] = np.array([obase_i, pos]).T
+        obase = self.nts[obase_i]
+        nbase = self.nts[chosenpos%4]
+        with torch.no_grad():
+            cseqs[np.arange(n), :, pos] = 0
+            cseqs[np.arange(n), chosenpos%4, pos] = 1
+        self.t[ids] += 1
+        return cseqs, pos, obase, nbase
+
+
+# Optimizes all start sequences (N, 4, L) together as one batch
+# Every sequence stops with the same criteria as optimize_sequences and is removed from the batch afterwards
+# Returns a list with the output of optimize_sequences for each start sequence
+# n_jobs > 1 splits the population into chunks that are optimized in separate processes
+def optimize_population(starts, model, targ, loss_function = 'MSE', scoring = 'forward', updates = 'genetic', patience = 100, max_iter = 1000, device = 'cpu', max_memory = 1024, n_jobs = 1, seed = None, **kwargs):
+    
+    if n_jobs > 1 and len(starts) > 1:
+        chunks = np.array_split(np.arange(len(starts)), min(n_jobs, len(starts)))
+        if seed is None:
+            seed = np.random.randint(2**31)
+        jobs = [[starts[chunk], model, targ, loss_function, scoring, updates, patience, max_iter, device, max_memory, seed + c, kwargs] for c, chunk in enumerate(chunks)]
+        with multiprocessing.get_context('spawn').Pool(len(chunks)) as pool:
+            results = pool.map(population_worker, jobs)
+        return [r for result in results for r in result]
+    
+    if seed is not None:
+        np.random.seed(seed)
+    
+    n_seqs = len(starts)
+    cseqs = torch.Tensor(np.array(starts))
+    targets = torch.Tensor(np.array(targ)).reshape(1,-1).expand(n_seqs, -1)
+    loss = loss_dict[loss_function]
+    loss.reduction = 'mean'
+    
+    update_sequence = population_update(updates, n_seqs, init_scaling = 0.01*max_iter, **kwargs)
+    
+    with torch.no_grad():
+        ppred = model.forward(cseqs)
+        oloss = sequence_loss(loss, ppred, targets).numpy()
+    start_score = ppred.numpy()
+    bestseq = cseqs.numpy().copy()
+    
+    opt_score, change_pos, change_base, orig_base = [[] for i in range(n_seqs)], [[] for i in range(n_seqs)], [[] for i in range(n_seqs)], [[] for i in range(n_seqs)]
+    not_imp = np.zeros(n_seqs, dtype = int)
+    # optimize_sequences keeps one more step if it stops because no position improves the loss
+    no_positive = np.zeros(n_seqs, dtype = int)
+    
+    # indices of sequences that are still optimized
+    ids = np.arange(n_seqs)
+    t = 0
+    while len(ids) > 0:
+        t += 1
+        pscore = population_scoring(scoring, cseqs, model, loss, targets[ids], max_memory = max_memory)
+        
+        # sequences without any improving position are finished
+        improve = np.sum(pscore.reshape(len(ids), -1) > 0, axis = 1) > 0
+        if not improve.all():
+            no_positive[ids[~improve]] = 1
+            ids, cseqs, pscore = ids[improve], cseqs[torch.tensor(improve)], pscore[improve]
+            if len(ids) == 0:
+                break
+        
+        cseqs, pos, obase, nbase = update_sequence(cseqs, pscore, ids)
+        with torch.no_grad():
+            pred = model.forward(cseqs)
+            nloss = sequence_loss(loss, pred, targets[ids]).numpy()
+        pred = pred.numpy()
+        
+        for i, j in enumerate(ids):
+            opt_score[j].append(pred[i])
+            change_pos[j].append(pos[i])
+            change_base[j].append(nbase[i])
+            orig_base[j].append(obase[i])
+        
+        improved = nloss < oloss[ids]
+        not_imp[ids[improved]] = 0
+        not_imp[ids[~improved]] += 1
+        bestseq[ids[improved]] = cseqs.numpy()[improved]
+        oloss[ids[improved]] = nloss[improved]
+        
+        finished = (oloss[ids] == 0) | (not_imp[ids] == patience) | (t == max_iter)
+        if finished.any():
+            ids, cseqs = ids[~finished], cseqs[torch.tensor(~finished)]
+    
+    results = []
+    for j in range(n_seqs):
+        k = min(len(opt_score[j]), len(opt_score[j]) - not_imp[j] + no_positive[j])
+        results.append([bestseq[[j]], opt_score[j][:k], start_score[j], change_pos[j][:k], change_base[j][:k], orig_base[j][:k]])
+    return results
+
+
+def population_worker(args):
+    starts, model, targ, loss_function, scoring, updates, patience, max_iter, device, max_memory, seed, kwargs = args
+    torch.set_num_threads(1)
+    return optimize_population(starts, model, targ, loss_function = loss_function, scoring = scoring, updates = updates, patience = patience, max_iter = max_iter, device = device, max_memory = max_memory, seed = seed, **kwargs)
+
+
 if __name__ == '__main__':
     
     np.random.seed(1)    
@@ -258,7 +428,10 @@ if __name__ == '__main__':
     device = 'cpu'
     if '--gpu' in sys.argv:
         device = sys.argv[sys.argv.index('--gpu')+1]
-    model = load_cnn_model(predictor, device = device)
+    if ',' in predictor or not predictor.endswith('model_params.dat'):
+        model = load_ensemble(predictor, device = device)
+    else:
+        model = load_cnn_model(predictor, device = device)
     
     if '--outname' in sys.argv:
         outname = sys.argv[sys.argv.index('--outname')+1]
@@ -289,8 +462,11 @@ if __name__ == '__main__':
         else:
             target_tracks = [int(target_tracks)]
     
-    model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[target_tracks])
-    model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[target_tracks])
+    if isinstance(model, model_ensemble):
+        model.select_tracks(target_tracks)
+    else:
+        model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[target_tracks])
+        model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[target_tracks])
     
     target_values = sys.argv[3]
     outname += '_'+target_values.replace(',','-')
@@ -328,6 +504,9 @@ if __name__ == '__main__':
     
     loss_function = sys.argv[7]
     
+    if '--incremental' in sys.argv:
+        kwargs['incremental'] = True
+    
     outname += '_'+loss_function+scoring+update_alg
     
     if '--load_sequences' in sys.argv:
@@ -349,12 +528,29 @@ if __name__ == '__main__':
         obj.close()
     
     
+    # optimize all seeds and starts together in one batch, optionally split into processes with --n_jobs
+    population = None
+    if '--population' in sys.argv:
+        n_jobs = 1
+        if '--n_jobs' in sys.argv:
+            n_jobs = int(sys.argv[sys.argv.index('--n_jobs')+1])
+        if '--max_memory' in sys.argv:
+            kwargs['max_memory'] = float(sys.argv[sys.argv.index('--max_memory')+1])
+        kwargs.pop('incremental', None)
+        t1 = time.time()
+        population = optimize_population(np.repeat(seed_seqs, n_starts, axis = 0), model, target_values, loss_function = loss_function, scoring = scoring, updates = update_alg, n_jobs = n_jobs, **kwargs)
+        t2 = time.time()
+        print('Optimized', len(population), 'sequences in', round(t2-t1, 1))
+    
     outfile = open(outname + '_optimization_steps.txt', 'w')
     optimized_sequences = []
     for s, seq in enumerate(seed_seqs):
         for n in range(n_starts):
             t1 = time.time()
-            opt_seq, opt_score, start_score, change_pos, change_base, orig_base = optimize_sequences(seq, model, target_values, loss_function = loss_function, scoring = scoring, updates = update_alg, **kwargs)
+            if population is not None:
+                opt_seq, opt_score, start_score, change_pos, change_base, orig_base = population[s*n_starts + n]
+            else:
+                opt_seq, opt_score, start_score, change_pos, change_base, orig_base = optimize_sequences(seq, model, target_values, loss_function = loss_function, scoring = scoring, updates = update_alg, **kwargs)
             t2 = time.time()
             if len(opt_score) == 0:
                 opt_score = np.array([start_score])
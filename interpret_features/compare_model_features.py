@@ -25,6 +25,7 @@ import matplotlib.pyplot as plt
 from scipy.spatial.distance import cdist
 from functools import reduce
 from scipy.stats import pearsonr
+from results_store import read_index, select_runs, load_runs
 
 def isint(pint):
     try:
@@ -49,6 +50,10 @@ def read_in(file, delimiter = ' ', splitaxis = None, splitname = '.', splitposit
     xaxis = np.array(xaxis)
     yaxis = np.array(yaxis)
     data[np.isnan(data)] = nan
+    return split_data(xaxis, yaxis, data, splitaxis = splitaxis, splitname = splitname, splitposition = splitposition)
+
+# Splits data into groups given by part splitposition of the names along splitaxis
+def split_data(xaxis, yaxis, data, splitaxis = None, splitname = '.', splitposition = None):
     if splitaxis is not None:
         groupnames = []
         if splitaxis == 0:
@@ -72,6 +77,25 @@ def read_in(file, delimiter = ' ', splitaxis = None, splitname = '.', splitposit
     
     return xaxis, yaxis, data
 
+# Same output as read_in for the kernel importance of a run in the results store of cnn_model.py
+# run is the name of the run or a unique prefix of it
+def read_store(storedir, run, key = 'importance', splitaxis = None, splitname = '.', splitposition = None, nan = 1., index = None):
+    if index is None:
+        index = read_index(storedir)
+    mask = index['run'] == run
+    if not mask.any():
+        mask = select_runs(index, prefix = run)
+    if np.sum(mask) != 1:
+        print(run, 'matches', np.sum(mask), 'runs in', storedir)
+        sys.exit()
+    data, yaxis, xaxis = [load_runs(storedir, index, mask, k)[0] for k in [key, 'motifnames', 'experiments']]
+    if data is None:
+        print(key, 'not stored for', run)
+        sys.exit()
+    data = np.array(data, dtype = float).T
+    data[np.isnan(data)] = nan
+    return split_data(np.array(xaxis), np.array(yaxis), data, splitaxis = splitaxis, splitname = splitname, splitposition = splitposition)
+
 from scipy.cluster import hierarchy
 import scipy.special as special 
 
@@ -276,6 +300,12 @@ if __name__ == '__main__':
     correlation = 'spearman'
     if '--correlation' in sys.argv:
         correlation = sys.argv[sys.argv.index('--correlation')+1]
+    
+    # files are names of runs in the results store of cnn_model.py instead of files
+    storedir, index = None, None
+    if '--results_store' in sys.argv:
+        storedir = sys.argv[sys.argv.index('--results_store')+1]
+        index = read_index(storedir)
         
 
     if ',' in files:
@@ -285,7 +315,10 @@ if __name__ == '__main__':
         ys = []
         xs = []
         for fi in files:
-            xnames, ynames, datmat = read_in(fi)
+            if storedir is not None:
+                xnames, ynames, datmat = read_store(storedir, fi, index = index)
+            else:
+                xnames, ynames, datmat = read_in(fi)
             xs.append(xnames)
             ys.append(ynames)
             data.append(datmat)
@@ -303,7 +336,10 @@ if __name__ == '__main__':
     else:
         splitaxis = isint(sys.argv[2])
         splitposition = int(sys.argv[3])
-        xnames, groups, data = read_in(files, splitaxis = splitaxis, splitposition = splitposition)
+        if storedir is not None:
+            xnames, groups, data = read_store(storedir, files, splitaxis = splitaxis, splitposition = splitposition, index = index)
+        else:
+            xnames, groups, data = read_in(files, splitaxis = splitaxis, splitposition = splitposition)
         mask = np.sum(np.absolute(data), axis = 0) > 0
         groups = groups[mask]
         data = data[:, mask]
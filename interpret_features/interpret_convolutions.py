@@ -5,6 +5,9 @@ import torch
 from torch import nn
 import matplotlib.pyplot as plt
 from scipy.stats import pearsonr
+from motif_similarity import ppm_similarity
+from motif_clustering import knn_graph, graph_clustering, consensus_ppms
+from motif_export import pfm2iupac, write_meme_file
 from sklearn.cluster import AgglomerativeClustering
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
@@ -32,64 +35,9 @@ def generate_pwms_from_seqs(seqs, activation = None, act_cut = None, weighted =
     
     return ppm
 
-def compare_ppms(ppms, ppms_ref, find_bestmatch = True, fill_logp_self = 0, one_half = True, min_sim = 5, padding = 0.25, infocont = False, bk_freq = 0.25):
-    # measure lengths of motifs
-    motif_len, motif_len_ref = [np.shape(ppm)[0] for ppm in ppms], [np.shape(ppm)[0] for ppm in ppms_ref]
-    offsets = np.zeros((len(ppms), len(ppms_ref)), dtype = int)
-    log_pvalues = np.zeros((len(ppms), len(ppms_ref)), dtype = float)
-    correlation = np.zeros((len(ppms), len(ppms_ref)), dtype = float)
-    if infocont:
-        padding = max(0,np.log2(padding/bk_freq))
-    for p, ppm in enumerate(ppms):
-        if p% 25 == 0:
-            print(p)
-        if one_half: 
-            p_start = p+1
-        else:
-            p_start = 0
-        if infocont:
-            ppm = np.log2(ppm/bk_freq)
-            ppm[ppm<0] = 0
-        for q in range(p_start, len(ppms_ref)):
-            qpm = ppms_ref[q]
-            if infocont:
-                qpm = np.log2(qpm/bk_freq)
-                qpm[qpm<0] = 0
-            pvals = []
-            pearcors = []
-            offs = []
-            
-            #vectors = []
-            #shorts = []
-            for i in range(min(0,-motif_len[p]+min_sim), motif_len_ref[q]-min(motif_len[p],min_sim) + 1):
-                if padding is not None:
-                    refppm, testppm = np.ones((motif_len_ref[q]-min(motif_len[p],min_sim) + motif_len[p]-min(0,-motif_len[p]+min_sim),4))*padding, np.ones((motif_len_ref[q]-min(motif_len[p],min_sim) + motif_len[p]-min(0,-motif_len[p]+min_sim),4))*padding
-                    refppm[-min(0,-motif_len[p]+min_sim):motif_len_ref[q]-min(0,-motif_len[p]+min_sim)] = qpm
-                    testppm[i-min(0,-motif_len[p]+min_sim):i-min(0,-motif_len[p]+min_sim)+motif_len[p]] = ppm
-                    mask = np.sum(testppm+refppm != 2*padding ,axis = 1) > 0
-                    refppm, testppm = refppm[mask], testppm[mask]
-                else:
-                    refppm = qpm[max(i,0):min(motif_len_ref[q],motif_len[p]+i)]
-                    testppm = ppm[max(0,-i): min(motif_len[p],motif_len_ref[q]-i)]
-                peacor, pval = pearsonr(testppm.flatten(), refppm.flatten())
-                #vectors.append([testppm.flatten(), refppm.flatten()])
-                #shorts.append(pfm2iupac([testppm, refppm], bk_freq = 0.28))
-                pvals.append(-np.sign(peacor)*np.log10(pval))
-                pearcors.append(peacor)
-                offs.append(i)
-            maxp = np.argmax(pvals)
-            log_pvalues[p,q] = pvals[maxp]
-            offsets[p,q] = offs[maxp]
-            correlation[p,q] = 1.-pearcors[maxp]
-            if one_half:
-                log_pvalues[q,p] = pvals[maxp]
-                offsets[q,p] = -offs[maxp]
-                correlation[q,p] = 1.-pearcors[maxp]
-            #if pearcors[maxp] > 0.8:
-                #print(shorts[maxp])
-                #plt.scatter(vectors[maxp][0], vectors[maxp][1])
-                #plt.show()
-                #plt.close()
+def compare_ppms(ppms, ppms_ref, find_bestmatch = True, fill_logp_self = 0, one_half = True, min_sim = 5, padding = 0.25, infocont = False, bk_freq = 0.25, max_memory = 1024, outfile = None):
+    # correlation at all offsets for all pairs is computed at once in blocks that fit into max_memory (MB)
+    correlation, log_pvalues, offsets = ppm_similarity(ppms, ppms_ref, one_half = one_half, min_sim = min_sim, padding = padding, infocont = infocont, bk_freq = bk_freq, max_memory = max_memory, outfile = outfile)
     log_pvalues[np.isinf(log_pvalues)] = fill_logp_self
     log_pvalues = log_pvalues * np.sign(correlation)
     if one_half:
@@ -136,84 +84,19 @@ def compute_importance(model, in_test, out_test, activation_measure = 'euclidean
 
 def kernel_to_ppm(kernels, kernel_bias = None, bk_freq = None):
     n_kernel, n_input, l_kernel = np.shape(kernels)
+    # kernels can share memory with the model parameters, they are copied instead of changed in place
+    kernels = np.array(kernels, dtype = float)
     if kernel_bias is not None:
-        kernels += kernel_bias[:,None,None]
+        kernels = kernels + kernel_bias[:,None,None]
     if bk_freq is None:
         bk_freq = np.ones(n_input)*np.log2(1./float(n_input))
     elif isinstance(bk_freq, float) or isinstance(bk_freq, int):
         bk_freq = np.ones(n_input)*np.log2(1./float(bk_freq))
-    kernels -= bk_freq[None,:,None]
+    kernels = kernels - bk_freq[None,:,None]
     ppms = 2.**kernels
     ppms = ppms/np.sum(ppms, axis = 1)[:,None, :]
     return ppms
 
-def pfm2iupac(pwms, bk_freq = None):
-    hash = {'A':16, 'C':8, 'G':4, 'T':2}
-    dictionary = {'A':16, 'C':8, 'G':4, 'T':2, 'R':20, 'Y':10, 'S':12, 'W':18, 'K':6, 'M':24, 'B':14, 'D':22, 'H':26, 'V':28, 'N':0}
-    res = dict((v,k) for k,v in dictionary.items())
-    n_nts = len(pwms[0].T)
-    if bk_freq is None:
-        bk_freq = (1./float(n_nts))*np.ones(n_nts)
-    else:
-        bk_freq = bk_freq*np.ones(n_nts)
-    motifs = []
-    for pwm in pwms:
-        m = ''
-        for p in pwm:
-            score = 0
-            for i in range(len(p)):
-                if p[i] > bk_freq[i]:
-                    score += list(hash.values())[i]
-            m += res[score]
-        motifs.append(m)
-    return motifs
-        
-def write_meme_file(pwm, pwmname, output_file_path, transpose = True):
-    """[summary]
-    write the pwm to a meme file
-    Args:
-        pwm ([np.array]): n_filters * 4 * motif_length
-        output_file_path ([type]): [description]
-    """
-    if transpose:
-        pwms = []
-        for pw in pwm:
-            pwms.append(np.array(pw).T)
-        pwm = pwms
-        
-    n_filters = len(pwm)
-    print(n_filters)
-    meme_file = open(output_file_path, "w")
-    meme_file.write("MEME version 4 \n")
-    meme_file.write("ALPHABET= ACGT \n")
-    meme_file.write("strands: + -\n")
-
-    print("Saved PWM File as : {}".format(output_file_path))
-
-    for i in range(0, n_filters):
-        if np.sum(pwm[i]) > 0:
-            meme_file.write("\n")
-            meme_file.write("MOTIF %s \n" % pwmname[i])
-            meme_file.write(
-                "letter-probability matrix: alength= 4 w= %d \n"
-                % np.count_nonzero(np.sum(pwm[i], axis=0))
-            )
-        
-        for j in range(0, np.shape(pwm[i])[-1]):
-            if np.sum(pwm[i][:, j]) > 0:
-                meme_file.write(
-                    str(pwm[i][ 0, j])
-                    + "\t"
-                    + str(pwm[i][1, j])
-                    + "\t"
-                    + str(pwm[i][2, j])
-                    + "\t"
-                    + str(pwm[i][3, j])
-                    + "\n"
-                )
-
-    meme_file.close()
-
 def read_meme(file_path):
     lines = open(file_path, 'r').readlines()
     pwms = []
@@ -239,44 +122,9 @@ def read_meme(file_path):
     return pwms, names
     
 
-def combine_pwms(pwms, clusters, similarity, offsets, maxnorm = True):
-    lenpwms = np.array([len(pwm) for pwm in pwms])
-    unclusters = np.unique(clusters)
-    comb_pwms = []
-    
-    #pwmotif = np.array(pfm2iupac(pwms, bk_freq = 0.28))
-    
-    for u in unclusters:
-        mask = np.where(clusters == u)[0]
-        if len(mask) > 1:
-            #print(pwmotif[mask])
-            simcluster = np.argmax(np.sum(similarity[mask][:,mask], axis = 1))
-            offsetcluster = offsets[mask][:,mask]
-            off = offsetcluster.T[simcluster]
-            #print(simcluster, off)
-            clusterlen = lenpwms[mask]
-            #print(similarity[mask][:, mask])
-            #print(correlation[mask][:,mask])
-            seed = np.zeros((np.amax(off+clusterlen)-np.amin(off),len(pwms[0][0])))
-            #seed2 = np.copy(seed)
-            seed[-np.amin(off):lenpwms[mask[simcluster]]-np.amin(off)] = pwms[mask[simcluster]]
-            #seed1 = np.copy(seed)
-            #print(pfm2iupac([seed], bk_freq = 0.28)[0])
-            for m, ma in enumerate(mask):
-                if m != simcluster:
-                    seed[-np.amin(off)+off[m]:lenpwms[ma]+off[m]-np.amin(off)] += pwms[ma]
-                    #check = np.copy(seed2)
-                    #check[-np.amin(off)+off[m]:lenpwms[ma]+off[m]-np.amin(off)] = pwms[ma]
-                    #print(pfm2iupac([check], bk_freq = 0.28)[0], pearsonr(check.flatten(), seed1.flatten()))
-            if maxnorm:
-                seed = seed/np.amax(np.sum(seed,axis = 1))
-            else:
-                seed = seed/np.sum(seed,axis = 1)[:, None]
-            #print(pfm2iupac([seed], bk_freq = 0.28)[0])
-            comb_pwms.append(seed)
-        else:
-            comb_pwms.append(pwms[mask[0]])
-    return comb_pwms
+def combine_pwms(pwms, clusters, similarity, offsets, maxnorm = True, graph = None):
+    # members are aligned to the seed of their cluster all at once, graph from knn_graph can replace similarity and offsets
+    return consensus_ppms(pwms, clusters, similarity = similarity, offsets = offsets, graph = graph, maxnorm = maxnorm, remove_low = 0, normalize_single = False)
 
 def sim_matplot(groups, features, data, group_annotation = None, group_distance = 'spearman', group_linkage = 'single', feature_distance = None, feature_linkage = None, feature_pwms = None, text = True, vmin = 0., vmax = 1., norm_data = False, top = 100, dpi = 60, pwm_min = 0, pwm_max = 2 ): 
     
@@ -435,30 +283,42 @@ if __name__ == '__main__':
             clusters[pwmsin] = p
         
     else:
-        print('Computing similarity between pwms')
-        correlation, logs, ofs, best = compare_ppms(pwm_set, pwm_set, find_bestmatch = True, fill_logp_self = 1000)
-        
         linkage = sys.argv[2]
         distance_threshold = float(sys.argv[3])
         outname = sys.argv[4] + linkage+str(distance_threshold)
         
-        # COMPARE RUNS:
-        # cluster motifs on log pvalues from all files together
-            # motifs from same run can also fall into the same cluster and therefore split importance for some sites
-        print('Clustering pwms')
-        #connectmat = (logs>=p_threshold).astype(int) # originally intended to use with connectivity = connectmat. Did not work as expected.
-        clustering = AgglomerativeClustering(n_clusters = None, affinity = 'precomputed', linkage = linkage, distance_threshold = distance_threshold).fit(correlation)
-        clusters = clustering.labels_
-        
-        clusterpwms = combine_pwms(pwm_set, clusters, logs, ofs)
+        if '--knn' in sys.argv:
+            # kernels of many folds and seeds: sparse graph of the k most similar kernels instead of all pairs
+            print('Computing similarity graph between pwms')
+            knn = int(sys.argv[sys.argv.index('--knn')+1])
+            n_candidates = None
+            if '--n_candidates' in sys.argv:
+                n_candidates = int(sys.argv[sys.argv.index('--n_candidates')+1])
+            graph = knn_graph(pwm_set, k = knn, radius = min(2., 2*distance_threshold), n_candidates = n_candidates)
+            print('Clustering pwms')
+            clusters = graph_clustering(graph, linkage = linkage, distance_threshold = distance_threshold)
+            clusterpwms = combine_pwms(pwm_set, clusters, None, None, graph = graph)
+        else:
+            print('Computing similarity between pwms')
+            correlation, logs, ofs, best = compare_ppms(pwm_set, pwm_set, find_bestmatch = True, fill_logp_self = 1000)
+            
+            # COMPARE RUNS:
+            # cluster motifs on log pvalues from all files together
+                # motifs from same run can also fall into the same cluster and therefore split importance for some sites
+            print('Clustering pwms')
+            #connectmat = (logs>=p_threshold).astype(int) # originally intended to use with connectivity = connectmat. Did not work as expected.
+            clustering = AgglomerativeClustering(n_clusters = None, affinity = 'precomputed', linkage = linkage, distance_threshold = distance_threshold).fit(correlation)
+            clusters = clustering.labels_
+            
+            clusterpwms = combine_pwms(pwm_set, clusters, logs, ofs)
         pwmnames = []
         for c in np.unique(clusters):
             pwmnames.append(','.join(pwm_names[clusters == c]))
-        write_meme_file(clusterpwms, np.array(pwmnames), outname+'_clusterpwms.meme')
+        write_meme_file(clusterpwms, np.array(pwmnames), 'ACGT', outname+'_clusterpwms.meme', transpose = True)
     
     unique_clusters, cluster_len = np.unique(clusters, return_counts = True)
     print(len(unique_clusters), 'clusters found.\n', int(np.sum((cluster_len == 1))), 'single ones\n', np.amax(cluster_len), 'is largest')
-    clustermotifs = np.array(pfm2iupac(clusterpwms, bk_freq = 0.28))
+    clustermotifs = pfm2iupac(clusterpwms, bk_freq = 0.28, transpose = True)
     
     print(clustermotifs[np.argsort(-cluster_len)[:10]], -np.sort(-cluster_len)[:10])
     
@@ -0,0 +1,75 @@
+# activation_ppms.py
+# PPMs of all kernels of the first convolutional layer from the sequence windows that activate them,
+# computed in one pass over the data set in batches with memory that does not grow with the number of sequences.
+# With act_cut, every window with activation above act_cut is added to the ppm of the kernel, weighted by its activation
+# if weighted, with one weight gradient of the convolution per batch.
+# With topk, the topk activations of every kernel are kept and merged with every new batch (a batched heap), and the
+# ppms are built from the windows of the final topk sites.
+# X are one-hot encoded sequences (N, n_features, L), only the first n_nts features are used for the ppms
+import numpy as np
+import sys, os
+import torch
+from torch.nn.grad import conv1d_weight
+
+
+# Windows of length l_kernels of padded batch x for every output position of model.convolutions (B, n_features, L_out, l_kernels)
+def conv_windows(x, l_kernels, padding):
+    x = torch.nn.functional.pad(x, (padding, padding))
+    return x.unfold(2, l_kernels, 1)
+
+
+# PPMs (n_kernels, n_nts, l_kernels) and number of windows of every kernel, and the topk sites (seq, pos, activation) (n_kernels, topk)
+def activation_ppms(model, X, topk = None, act_cut = 0., weighted = True, n_nts = 4, batchsize = None, device = None):
+    if device is None:
+        device = model.device
+    if batchsize is None:
+        batchsize = model.batchsize if model.batchsize is not None else 256
+    conv = model.convolutions
+    n_kernels, l_kernels = conv.weight.shape[0], conv.weight.shape[-1]
+    padding = conv.padding[0]
+    conv.to(device)
+    ppms = torch.zeros((n_kernels, n_nts, l_kernels), device = device)
+    nsites = torch.zeros(n_kernels, device = device)
+    if topk is not None:
+        topact = torch.ones((n_kernels, 0), device = device)*-np.inf
+        topsite = torch.zeros((n_kernels, 0), dtype = torch.long, device = device)
+    with torch.no_grad():
+        for b in range(0, len(X), batchsize):
+            x = torch.Tensor(np.array(X[b:b+batchsize], dtype = float)).to(device)
+            act = conv(x)
+            l_out = act.shape[-1]
+            if topk is None:
+                weight = act * (act > act_cut)
+                if not weighted:
+                    weight = (weight > 0).float()
+                # sum of weighted windows is the gradient of the kernel weights for output gradient weight
+                ppms += conv1d_weight(x[:, :n_nts], (n_kernels, n_nts, l_kernels), weight, padding = padding)
+                nsites += torch.sum(act > act_cut, dim = (0, 2))
+            else:
+                # merge current topk with all windows of the batch, sites are flat indices seq*l_out + pos
+                batchact = act.permute(1, 0, 2).reshape(n_kernels, -1)
+                batchsite = torch.arange(b*l_out, b*l_out + batchact.shape[1], device = device)[None, :].expand(n_kernels, -1)
+                topact, top = torch.topk(torch.cat([topact, batchact], dim = 1), min(topk, topact.shape[1] + batchact.shape[1]), dim = 1)
+                topsite = torch.gather(torch.cat([topsite, batchsite], dim = 1), 1, top)
+    if topk is not None:
+        topact, topsite = topact.cpu().numpy(), topsite.cpu().numpy()
+        seqs, pos = np.divmod(topsite, l_out)
+        # windows of the topk sites are extracted from the padded sequences
+        for k in range(n_kernels):
+            keep = topact[k] > act_cut if act_cut is not None else np.ones(len(topact[k]), dtype = bool)
+            if keep.sum() == 0:
+                continue
+            x = torch.Tensor(np.array(X[np.sort(np.unique(seqs[k][keep]))], dtype = float)).to(device)
+            rows = np.searchsorted(np.sort(np.unique(seqs[k][keep])), seqs[k][keep])
+            windows = conv_windows(x[:, :n_nts], l_kernels, padding)[torch.LongTensor(rows), :, torch.LongTensor(pos[k][keep])]
+            weight = torch.Tensor(topact[k][keep] if weighted else np.ones(keep.sum())).to(device)
+            ppms[k] = torch.sum(weight[:, None, None]*windows, dim = 0)
+            nsites[k] = float(keep.sum())
+    ppms = ppms.cpu().numpy()
+    norm = np.sum(ppms, axis = 1)
+    norm[norm == 0] = 1.
+    ppms = ppms/norm[:, None, :]
+    nsites = nsites.cpu().numpy()
+    if topk is not None:
+        return ppms, nsites, np.array([seqs, pos, topact])
+    return ppms, nsites, None
@@ -0,0 +1,191 @@
+# attribution.py
+# Batched attributions for one-hot encoded sequences (N, 4, L)
+# Integrated gradients: gradients are averaged along the straight path from a baseline to the sequence
+# and multiplied with the difference between sequence and baseline.
+# DeepLIFT-style: the baselines are shuffled versions of the sequence (dinucleotide content preserved),
+# attributions are averaged over several references.
+# All interpolation steps of all references of several sequences are stacked into one batch and one backward pass.
+# Attributions are written into a memory-mapped .npy file (N, 4, L) that can be read with np.load(file, mmap_mode = 'r')
+import numpy as np
+import torch
+import torch.nn as nn
+import sys, os
+from data_processing import readinfasta, quick_onehot
+from generate_sequence import load_cnn_model
+from model_ensemble import load_ensemble, model_ensemble
+from modules import loss_dict
+from ism import memory_per_sequence, sequence_loss
+
+
+# Shuffles the order of bases in one-hot encoded seq (4, L) while keeping the dinucleotide counts
+# Random Eulerian walk through the graph of dinucleotides (Altschul and Erickson, 1985)
+def dinucleotide_shuffle(seq, n_shuffles, rng = np.random):
+    tokens = np.argmax(seq, axis = 0)
+    l = len(tokens)
+    # next positions for every base, the last transition out of every base is kept to guarantee a valid walk
+    next_pos = [np.where(tokens[:-1] == b)[0] + 1 for b in range(4)]
+    shuffled = np.zeros((n_shuffles, 4, l), dtype = seq.dtype)
+    for n in range(n_shuffles):
+        shuf_pos = []
+        for b in range(4):
+            order = np.arange(len(next_pos[b]))
+            order[:-1] = rng.permutation(len(order)-1)
+            shuf_pos.append(next_pos[b][order])
+        counter = np.zeros(4, dtype = int)
+        walk = np.zeros(l, dtype = int)
+        p = 0
+        for i in range(1, l):
+            b = tokens[p]
+            p = shuf_pos[b][counter[b]]
+            counter[b] += 1
+            walk[i] = p
+        shuffled[n, tokens[walk], np.arange(l)] = 1
+    return shuffled
+
+
+# Shuffles of every sequence in seqs (N, 4, L) that only keep the base composition
+def mononucleotide_shuffle(seqs, n_shuffles, rng = np.random):
+    perm = np.argsort(rng.random_sample((len(seqs), n_shuffles, seqs.shape[-1])), axis = -1)
+    return np.take_along_axis(seqs[:, None], perm[:, :, None, :], axis = -1)
+
+
+# Baselines (N, n_references, 4, L) for seqs (N, 4, L)
+# zeros, uniform (0.25 for every base), mononucleotide or dinucleotide shuffled sequences
+def get_baselines(seqs, baseline = 'dinucleotide', n_references = 10, seed = None):
+    rng = np.random.RandomState(seed)
+    if baseline == 'zeros':
+        return np.zeros((len(seqs), 1) + np.shape(seqs)[1:])
+    elif baseline == 'uniform':
+        return np.ones((len(seqs), 1) + np.shape(seqs)[1:])*0.25
+    elif baseline == 'mononucleotide':
+        return mononucleotide_shuffle(seqs, n_references, rng = rng)
+    elif baseline == 'dinucleotide':
+        return np.array([dinucleotide_shuffle(seq, n_references, rng = rng) for seq in seqs])
+    else:
+        print(baseline, 'not a valid baseline')
+        sys.exit()
+
+
+# Scalar value per sequence that is attributed: mean of the predictions for tracks
+# or the negative loss to target, so that positive attributions point towards the target as in saliency_map
+def attribution_objective(pred, tracks = None, target = None, loss = None):
+    if target is not None:
+        return -sequence_loss(loss, pred, target)
+    if tracks is not None:
+        pred = pred[:, tracks]
+    return torch.mean(pred, dim = 1)
+
+
+# Integrated gradients for seqs (N, 4, L) with baselines (N, n_references, 4, L)
+# Gradients are evaluated at the midpoints of steps intervals along the path
+# If project, the sum of the attributions at each position is assigned to the base in the sequence
+def integrated_gradients(model, seqs, baselines, steps = 32, tracks = None, target = None, loss = None, project = True, device = 'cpu'):
+    seqs, baselines = torch.Tensor(np.array(seqs)).to(device), torch.Tensor(np.array(baselines)).to(device)
+    n, r = baselines.size(0), baselines.size(1)
+    alphas = ((torch.arange(steps, dtype = torch.float) + 0.5)/steps).to(device)
+    diff = seqs.unsqueeze(1) - baselines
+    # (N, n_references, steps, 4, L)
+    path = baselines.unsqueeze(2) + alphas[None, None, :, None, None] * diff.unsqueeze(2)
+    path = path.reshape((-1,) + tuple(seqs.size()[1:]))
+    path.requires_grad = True
+    if target is not None:
+        target = torch.Tensor(np.array(target)).to(device).reshape(1, -1)
+    objective = attribution_objective(model.forward(path), tracks = tracks, target = target, loss = loss)
+    grad = torch.autograd.grad(torch.sum(objective), path)[0]
+    grad = grad.reshape((n, r, steps) + tuple(seqs.size()[1:]))
+    attributions = torch.mean(torch.mean(grad, dim = 2) * diff, dim = 1)
+    attributions = attributions.detach().cpu().numpy()
+    if project:
+        attributions = np.sum(attributions, axis = 1)[:, None] * seqs.cpu().numpy()
+    return attributions
+
+
+# Creates memory mapped attribution store (N, 4, L)
+def attribution_store(outfile, shape, dtype = np.float32):
+    return np.lib.format.open_memmap(outfile, mode = 'w+', dtype = dtype, shape = tuple(shape))
+
+
+def read_attribution_store(outfile):
+    return np.load(outfile, mmap_mode = 'r')
+
+
+# Computes attributions for all seqs (N, 4, L) in batches and writes them into the store outfile
+# method: integrated_gradients, uses a single baseline, or deeplift, uses n_references shuffled baselines
+# The number of sequences per batch is chosen so that all steps and references fit into max_memory (MB)
+def compute_attributions(model, seqs, outfile, method = 'deeplift', baseline = None, steps = 32, n_references = 10, tracks = None, target = None, loss_function = 'MSE', project = True, max_memory = 1024, seed = 1, device = 'cpu', verbose = False):
+    if baseline is None:
+        baseline = 'dinucleotide' if method == 'deeplift' else 'zeros'
+    if method == 'integrated_gradients' and baseline in ['mononucleotide', 'dinucleotide']:
+        n_references = 1
+    n_ref = 1 if baseline in ['zeros', 'uniform'] else n_references
+    loss = loss_dict[loss_function] if target is not None else None
+    model.eval()
+    store = attribution_store(outfile, np.shape(seqs))
+    # backward pass needs about twice the memory of the forward pass
+    batchsize = max(1, int(max_memory * 2**20/(3*memory_per_sequence(model, torch.Tensor(np.array(seqs[:1]))))/(n_ref*steps)))
+    for b in range(0, len(seqs), batchsize):
+        bseqs = np.array(seqs[b:b+batchsize], dtype = float)
+        baselines = get_baselines(bseqs, baseline = baseline, n_references = n_ref, seed = None if seed is None else seed + b)
+        store[b:b+batchsize] = integrated_gradients(model, bseqs, baselines, steps = steps, tracks = tracks, target = target, loss = loss, project = project, device = device)
+        if verbose:
+            print(min(b+batchsize, len(seqs)), '/', len(seqs))
+    store.flush()
+    return store
+
+
+if __name__ == '__main__':
+    # model_params.dat of model, and fasta file with sequences
+    predictor = sys.argv[1]
+    names, seqs = readinfasta(sys.argv[2])
+    seqs, nts = quick_onehot(seqs)
+    seqs = np.transpose(seqs, axes = (0,2,1))
+
+    method = sys.argv[3] # integrated_gradients or deeplift
+
+    device = 'cpu'
+    if '--gpu' in sys.argv:
+        device = sys.argv[sys.argv.index('--gpu')+1]
+    # several models as comma separated list or text file are combined into their mean, see model_ensemble.py
+    if ',' in predictor or not predictor.endswith('model_params.dat'):
+        model = load_ensemble(predictor, device = device, verbose = False)
+    else:
+        model = load_cnn_model(predictor, device = device, verbose = False)
+
+    outname = os.path.splitext(sys.argv[2])[0]+'_'+method
+    if '--outname' in sys.argv:
+        outname = sys.argv[sys.argv.index('--outname')+1]
+
+    tracks = None
+    if '--tracks' in sys.argv:
+        tracks = np.array(sys.argv[sys.argv.index('--tracks')+1].split(','), dtype = int)
+        outname += '_tr'+'-'.join(tracks.astype(str))
+
+    target, loss_function = None, 'MSE'
+    if '--target' in sys.argv:
+        target = np.array(sys.argv[sys.argv.index('--target')+1].split(','), dtype = float)
+        if tracks is not None:
+            if isinstance(model, model_ensemble):
+                model.select_tracks(tracks)
+            else:
+                model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[tracks])
+                model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[tracks])
+            tracks = None
+        if '--loss_function' in sys.argv:
+            loss_function = sys.argv[sys.argv.index('--loss_function')+1]
+
+    baseline = None
+    if '--baseline' in sys.argv:
+        baseline = sys.argv[sys.argv.index('--baseline')+1]
+    steps = 32
+    if '--steps' in sys.argv:
+        steps = int(sys.argv[sys.argv.index('--steps')+1])
+    n_references = 10
+    if '--n_references' in sys.argv:
+        n_references = int(sys.argv[sys.argv.index('--n_references')+1])
+    max_memory = 1024
+    if '--max_memory' in sys.argv:
+        max_memory = float(sys.argv[sys.argv.index('--max_memory')+1])
+
+    compute_attributions(model, seqs, outname+'_attributions.npy', method = method, baseline = baseline, steps = steps, n_references = n_references, tracks = tracks, target = target, loss_function = loss_function, project = '--hypothetical' not in sys.argv, max_memory = max_memory, device = device, verbose = True)
+    np.savetxt(outname+'_attribution_names.txt', names, fmt = '%s')
+    print(outname+'_attributions.npy')
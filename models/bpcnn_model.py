@@ -23,8 +23,9 @@ from functions import dist_measures
 from interpret_cnn import write_meme_file, pfm2iupac, kernel_to_ppm, compute_importance 
 from init import get_device, MyDataset, kmer_from_pwm, pwm_from_kmer, kmer_count, kernel_hotstart, load_parameters
 from modules import parallel_module, gap_conv, interaction_module, pooling_layer, correlation_loss, correlation_both, cosine_loss, cosine_both, zero_loss, Complex, Expanding_linear, Res_FullyConnect, Residual_convolution, Res_Conv1d, MyAttention_layer, Kernel_linear, loss_dict, func_dict, Padded_Conv1d, final_convolution
-from train import pwmset, pwm_scan, batched_predict
+from train import pwmset, pwm_scan, pwmset_thresholds, batched_predict
 from train import fit_model
+from motif_scanning import pfm_logodds
 from compare_expression_distribution import read_separated
 from output import add_params_to_outname
 
@@ -633,6 +634,7 @@ if __name__ == '__main__':
     
     pfms = None
     pwmusage = 'none'
+    motpval = None
     if '--list_of_pwms' in sys.argv:
         list_of_pwms = sys.argv[sys.argv.index('--list_of_pwms')+1]
         pwmusage = sys.argv[sys.argv.index('--list_of_pwms')+2]
@@ -655,6 +657,14 @@ if __name__ == '__main__':
         
         pfms, rbpnames = read_pwm(list_of_pwms)
         pwms = rescale_pwm(pfms, psam = psam, infcont = infcont, norm = True)
+        # log-odds against uniform background instead of rescaled pfms, with cutoffs for a p-value of their scores
+        # that are computed for the windows of l_kernels that are scanned, when the kernel length is known
+        if '--logodds_pwms' in sys.argv:
+            pwms = pfm_logodds(pfms)
+            outname += 'lo'
+            if '--motif_pvalue' in sys.argv:
+                motpval = float(sys.argv[sys.argv.index('--motif_pvalue')+1])
+                outname += 'mp'+str(motpval)
         if pwmusage != 'initialize': 
             params['fixed_kernels'] = pwms
             params['motif_cutoff'] = motcut
@@ -707,6 +717,8 @@ if __name__ == '__main__':
         params['outname'] = outname
         print('Device', params['device'])
         params['n_features'], params['l_seqs'] = np.shape(X)[-2], np.shape(X)[-1]
+        if motpval is not None and params.get('fixed_kernels') is not None:
+            params['motif_cutoff'] = pwmset_thresholds(params['fixed_kernels'], params.get('l_kernels', 7), pvalue = motpval)
         model = bpcnn(**params)
        
     weights = None
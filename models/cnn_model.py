@@ -1,4 +1,5 @@
 import sys, os 
+import time
 import numpy as np
 import scipy.stats as stats
 from scipy.stats import pearsonr, cosine
@@ -21,12 +22,18 @@ from functions import mse, correlation, dist_measures
 from output import print_averages, save_performance, plot_scatter
 from functions import dist_measures
 from interpret_cnn import write_meme_file, pfm2iupac, kernel_to_ppm, compute_importance 
+from motif_export import write_motif_files
+from activation_ppms import activation_ppms
 from init import get_device, MyDataset, kmer_from_pwm, pwm_from_kmer, kmer_count, kernel_hotstart, load_parameters
 from modules import parallel_module, gap_conv, interaction_module, pooling_layer, correlation_loss, correlation_both, cosine_loss, cosine_both, zero_loss, Complex, Expanding_linear, Res_FullyConnect, Residual_convolution, Res_Conv1d, MyAttention_layer, Kernel_linear, loss_dict, func_dict
-from train import pwmset, pwm_scan, batched_predict
+from train import pwmset, pwm_scan, pwmset_thresholds, batched_predict
 from train import fit_model
+from seed_ensemble import fit_ensemble
+from motif_scanning import pfm_logodds
 from compare_expression_distribution import read_separated
 from output import add_params_to_outname
+from results_store import store_run, model_params, class_metrics
+from run_registry import open_registry, register_run, data_hash
 
 # Include customized non-linear Convolutions: 
     # CNN network for each convolution, can be interpreted as one complex motif, should not sum over all positions but instead put them into a fully connected network and only sum at the end. So that this network creates outputs for each position instead of the convolution operation
@@ -511,12 +518,19 @@ class cnn(nn.Module):
         if location == '0':    
             return torch.flatten(pred, start_dim = 1)
         
-        pred = self.modelstart(pred)
+        return self.forward_from(pred, start = 0, location = location)
+    
+    # Continues the forward pass from the output of layer block start
+    # 0: first convolution, 1: modelstart, 2: dilated convolutions
+    # Used to reuse the activations of the first blocks, f.e. in ISM, where only a small window changes
+    def forward_from(self, pred, start = 0, location = 'None'):
+        if start < 1:
+            pred = self.modelstart(pred)
         
         if location == '1':
             return torch.flatten(pred, start_dim = 1)
         
-        if self.dilated_convolutions > 0:
+        if self.dilated_convolutions > 0 and start < 2:
             pred = self.convolution_layers(pred)
         
         if location == '2':
@@ -563,8 +577,11 @@ class cnn(nn.Module):
         return pred
     
     
-    def fit(self, X, Y, XYval = None, sample_weights = None):
-        self.saveloss = fit_model(self, X, Y, XYval = XYval, sample_weights = sample_weights, loss_function = self.loss_function, validation_loss = self.validation_loss, batchsize = self.batchsize, device = self.device, optimizer = self.optimizer, optim_params = self.optim_params, verbose = self.verbose, lr = self.lr, kernel_lr = self.kernel_lr, hot_start = self.hot_start, warm_start = self.warm_start, outname = self.outname, adjust_lr = self.adjust_lr, patience = self.patience, init_adjust = self.init_adjust, keepmodel = self.keepmodel, load_previous = self.load_previous, write_steps = self.write_steps, checkval = self.checkval, writeloss = self.writeloss, init_epochs = self.init_epochs, epochs = self.epochs, l1reg_last = self.l1reg_last, l2_reg_last = self.l2reg_last, l1_kernel = self.l1_kernel, reverse_sign = self.reverse_sign, shift_back = self.shift_sequence, random_shift=self.random_shift, smooth_onehot = self.smooth_onehot, restart = self.restart, **self.kwargs)
+    # kwargs are passed to fit_model in addition to the kwargs of the model, f.e. epoch_budget or checkpoint_minutes
+    def fit(self, X, Y, XYval = None, sample_weights = None, **kwargs):
+        fit_kwargs = dict(self.kwargs)
+        fit_kwargs.update(kwargs)
+        self.saveloss = fit_model(self, X, Y, XYval = XYval, sample_weights = sample_weights, loss_function = self.loss_function, validation_loss = self.validation_loss, batchsize = self.batchsize, device = self.device, optimizer = self.optimizer, optim_params = self.optim_params, verbose = self.verbose, lr = self.lr, kernel_lr = self.kernel_lr, hot_start = self.hot_start, warm_start = self.warm_start, outname = self.outname, adjust_lr = self.adjust_lr, patience = self.patience, init_adjust = self.init_adjust, keepmodel = self.keepmodel, load_previous = self.load_previous, write_steps = self.write_steps, checkval = self.checkval, writeloss = self.writeloss, init_epochs = self.init_epochs, epochs = self.epochs, l1reg_last = self.l1reg_last, l2_reg_last = self.l2reg_last, l1_kernel = self.l1_kernel, reverse_sign = self.reverse_sign, shift_back = self.shift_sequence, random_shift=self.random_shift, smooth_onehot = self.smooth_onehot, restart = self.restart, **fit_kwargs)
         
 
 
@@ -572,6 +589,7 @@ class cnn(nn.Module):
 
 
 if __name__ == '__main__':
+    starttime = time.time()
     inputfile = sys.argv[1]
     outputfile = sys.argv[2]
     
@@ -687,6 +705,7 @@ if __name__ == '__main__':
     
     pfms = None
     pwmusage = 'none'
+    motpval = None
     if '--list_of_pwms' in sys.argv:
         list_of_pwms = sys.argv[sys.argv.index('--list_of_pwms')+1]
         pwmusage = sys.argv[sys.argv.index('--list_of_pwms')+2]
@@ -709,6 +728,14 @@ if __name__ == '__main__':
         
         pfms, rbpnames = read_pwm(list_of_pwms)
         pwms = rescale_pwm(pfms, psam = psam, infcont = infcont, norm = True)
+        # log-odds against uniform background instead of rescaled pfms, with cutoffs for a p-value of their scores
+        # that are computed for the windows of l_kernels that are scanned, when the kernel length is known
+        if '--logodds_pwms' in sys.argv:
+            pwms = pfm_logodds(pfms)
+            outname += 'lo'
+            if '--motif_pvalue' in sys.argv:
+                motpval = float(sys.argv[sys.argv.index('--motif_pvalue')+1])
+                outname += 'mp'+str(motpval)
         if pwmusage != 'initialize': 
             params['fixed_kernels'] = pwms
             params['motif_cutoff'] = motcut
@@ -759,12 +786,21 @@ if __name__ == '__main__':
         params['outname'] = outname
         print('Device', params['device'])
         params['n_features'], params['l_seqs'] = np.shape(X)[-2], np.shape(X)[-1]
+        if motpval is not None and params.get('fixed_kernels') is not None:
+            params['motif_cutoff'] = pwmset_thresholds(params['fixed_kernels'], params.get('l_kernels', 7), pvalue = motpval)
         model = cnn(**params)
         
     if weights is not None:
         weights = weights[trainset]
             
     
+    # --seed_ensemble seed1,seed2 trains models with these seeds together with the model in one vectorized loop
+    # every additional member is initialized like the model, saved and assessed on the test set with the seed added to its outname
+    members = []
+    if '--seed_ensemble' in sys.argv and train_model:
+        for seed in sys.argv[sys.argv.index('--seed_ensemble')+1].split(','):
+            members.append(cnn(**dict(params, seed = int(seed), outname = outname+'s'+seed)))
+    
     translate_dict = None
     exclude_dict = []
     allow_reduction = False
@@ -775,7 +811,8 @@ if __name__ == '__main__':
         exclude_params = sys.argv[sys.argv.index('--load_parameters')+3] # list with names from loaded model that should be ignored when loading
         include = sys.argv[sys.argv.index('--load_parameters')+4] == 'True' # if include then exclude list is list of parameters that will be included
         allow_reduction = sys.argv[sys.argv.index('--load_parameters')+5] == 'True' # if include then exclude list is list of parameters that will be included
-        model.outname += sys.argv[sys.argv.index('--load_parameters')+6]
+        for m in [model] + members:
+            m.outname += sys.argv[sys.argv.index('--load_parameters')+6]
         if ":" in translate_params:
             if ',' in tranlate_params:
                 translate_params = translate_params.split(',')
@@ -795,19 +832,21 @@ if __name__ == '__main__':
         
     # parameterfile is loaded into the model
     if parameterfile:
-        load_parameters(model, parameterfile, translate_dict = translate_dict, exclude = exclude_dict, include = include, allow_reduction = allow_reduction)
-        if model.generate_paramfile:
-            obj = open(model.outname+'_model_params.dat', 'a')
-            obj.write('param_file : '+ os.path.split(parameterfile)[1] +'\n')
-            obj.close()
+        for m in [model] + members:
+            load_parameters(m, parameterfile, translate_dict = translate_dict, exclude = exclude_dict, include = include, allow_reduction = allow_reduction)
+            if m.generate_paramfile:
+                obj = open(m.outname+'_model_params.dat', 'a')
+                obj.write('param_file : '+ os.path.split(parameterfile)[1] +'\n')
+                obj.close()
     
     if select_track is not None:
         if select_track[0] in experiments:
             select_track = [list(experiments).index(st) for st in select_track]
-                
-        model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[select_track])
-        model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[select_track])
-        model.n_classes = len(select_track)
+        
+        for m in [model] + members:
+            m.classifier.Linear.weight = nn.Parameter(m.classifier.Linear.weight[select_track])
+            m.classifier.Linear.bias = nn.Parameter(m.classifier.Linear.bias[select_track])
+            m.n_classes = len(select_track)
         Y = Y[:,select_track]
         experiments = experiments[select_track]
         print(len(select_track), '('+','.join(experiments)+')', 'tracks selected')
@@ -817,16 +856,26 @@ if __name__ == '__main__':
         init_kernels = [pwmset(pwm.T, params['l_kernels'], shift_long = False) for pwm in pwms]
         init_kernels = np.concatenate(init_kernels, axis = 0)
         print('INIT kernels', len(init_kernels))
-        if model.generate_paramfile:
-            obj = open(model.outname+'_model_params.dat', 'a')
-            obj.write('param_file : '+ os.path.split(list_of_pwms)[1] +'\n')
-            obj.close()
         init_kernels = OrderedDict({ 'convolutions.weight': torch.Tensor(init_kernels[np.argsort(-np.sum(init_kernels, axis = (1,2)))])})
-        load_parameters(model, init_kernels, allow_reduction = True)
+        for m in [model] + members:
+            if m.generate_paramfile:
+                obj = open(m.outname+'_model_params.dat', 'a')
+                obj.write('param_file : '+ os.path.split(list_of_pwms)[1] +'\n')
+                obj.close()
+            load_parameters(m, init_kernels, allow_reduction = True)
     
     
+    # --checkpoint minutes saves the full training state every minutes to _checkpoint.pth, 
+    # a preempted run that is started again with the same parameters continues from the last checkpoint
+    fit_kwargs = {}
+    if '--checkpoint' in sys.argv:
+        fit_kwargs['checkpoint_minutes'] = float(sys.argv[sys.argv.index('--checkpoint')+1])
+    
     if train_model:
-        model.fit(X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights)
+        if len(members) > 0:
+            fit_ensemble([model] + members, X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights, **fit_kwargs)
+        else:
+            model.fit(X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights, **fit_kwargs)
     
     Y_pred = model.predict(X[testset])
     
@@ -842,6 +891,20 @@ if __name__ == '__main__':
         outname = model.outname
     print(outname)
     
+    # collects results of the run for the columnar store of many runs
+    storedir = None
+    if '--results_store' in sys.argv:
+        storedir = sys.argv[sys.argv.index('--results_store')+1]
+        results = {'experiments': experiments}
+        if model.num_kernels > 0:
+            results['kernels'] = model.convolutions.weight.detach().cpu().numpy()
+    
+    # --run_registry path registers the run with parameters, losses, metrics, data hashes and files in an sqlite file, see run_registry.py
+    registry, metrics = None, None
+    if '--run_registry' in sys.argv:
+        registry = open_registry(sys.argv[sys.argv.index('--run_registry')+1])
+        hashes = {'data': data_hash(X, Y), 'trainset': data_hash(trainset), 'valset': data_hash(valset), 'testset': data_hash(testset)}
+    
     
     if Y is not None:
             
@@ -869,11 +932,28 @@ if __name__ == '__main__':
         
         # USE: --save_correlation_perclass --save_auroc_perclass --save_auprc_perclass --save_mse_perclass --save_correlation_pergene '--save_mse_pergene --save_auroc_pergene --save_auprc_pergene --save_topdowncorrelation_perclass
         save_performance(Y_pred, Y[testset], testclasses, experiments, names[testset], outname, sys.argv, compare_random = True)
+        if storedir is not None or registry is not None:
+            metrics = class_metrics(Y_pred, Y[testset], testclasses)
+            if storedir is not None:
+                results['metrics'] = metrics
         
     if '--save_predictions' in sys.argv:
         print('SAVED', outname+'_pred.txt')
         np.savetxt(outname+'_pred.txt', np.append(names[testset][:, None], Y_pred, axis = 1), fmt = '%s')
     
+    for member in members:
+        Y_predm = member.predict(X[testset])
+        if '--norm2output' in sys.argv:
+            Y_predm *= outnorm[testset]
+        elif '--norm2outputclass' in sys.argv:
+            Y_predm *= outnorm
+        if Y is not None:
+            save_performance(Y_predm, Y[testset], testclasses, experiments, names[testset], member.outname, sys.argv, compare_random = True)
+        if '--save_predictions' in sys.argv:
+            np.savetxt(member.outname+'_pred.txt', np.append(names[testset][:, None], Y_predm, axis = 1), fmt = '%s')
+        if registry is not None:
+            register_run(registry, member.outname, model_params(member), saveloss = member.saveloss, metrics = None if Y is None else class_metrics(Y_predm, Y[testset], testclasses), experiments = experiments, hashes = hashes, started = starttime, epochs = member.epochs_trained)
+    
     # Generate PPMs for kernels
     if '--convertedkernel_ppms' in sys.argv:
         lpwms = 4
@@ -909,6 +989,15 @@ if __name__ == '__main__':
             ppms = list(ppms) + list(pfms)
         
         write_meme_file(ppms, motifnames, ''.join(np.array([f[0] for f in features[:lpwms]])), outname+'_kernel_ppms.meme')
+        # additional motif formats, f.e. --kernel_motif_formats jaspar,homer
+        if '--kernel_motif_formats' in sys.argv:
+            write_motif_files(ppms, motifnames, outname+'_kernel', formats = sys.argv[sys.argv.index('--kernel_motif_formats')+1].split(','), alphabet = ''.join(np.array([f[0] for f in features[:lpwms]])))
+        # ppms from the windows in the test set that activate every kernel, in one pass over all sequences
+        # f.e. --activation_ppms 200 for the top 200 windows of every kernel, or --activation_ppms 0 for all windows with positive activation
+        if '--activation_ppms' in sys.argv:
+            topk = int(sys.argv[sys.argv.index('--activation_ppms')+1])
+            actppms, nsites, topsites = activation_ppms(model, X[testset], topk = topk if topk > 0 else None, n_nts = lpwms)
+            write_meme_file(actppms, motifnames[:len(actppms)], ''.join(np.array([f[0] for f in features[:lpwms]])), outname+'_kernel_actppms.meme')
         
         #### enable this to generate values per cell type and per gene when different activation_measure given
         
@@ -916,6 +1005,8 @@ if __name__ == '__main__':
         
         np.savetxt(outname+'_kernel_importance.dat', np.concatenate([motifnames.reshape(-1,1), iupacmotifs.reshape(-1,1), motifimpact], axis = 1).astype(str), fmt = '%s', header = 'Kernel IUPAC '+' '.join(experiments))
         np.savetxt(outname+'_kernel_impact.dat', np.concatenate([motifnames.reshape(-1,1), iupacmotifs.reshape(-1,1), impact_direction], axis = 1).astype(str), fmt = '%s', header = 'Kernel IUPAC '+' '.join(experiments))
+        if storedir is not None:
+            results.update({'ppms': ppms, 'motifnames': motifnames, 'iupac': iupacmotifs, 'importance': motifimpact, 'impact': impact_direction})
         
         # Due to early stopping the importance scores from training and testing should be the same
         # However training importance provide impacts of patterns from overfitting
@@ -928,6 +1019,11 @@ if __name__ == '__main__':
             
 
 
+    if storedir is not None:
+        print('Stored in', store_run(storedir, outname, model_params(model), **results))
+    if registry is not None:
+        register_run(registry, outname, model_params(model), saveloss = getattr(model, 'saveloss', None), metrics = metrics, experiments = experiments, hashes = hashes, started = starttime, epochs = getattr(model, 'epochs_trained', None))
+
     # plots scatter plot for each output class
     if '--plot_correlation_perclass' in sys.argv:
         plot_scatter(Y[testset], Y_pred, xlabel = 'Measured', ylabel = 'Predicted', titles = experiments, include_lr = False, outname = outname + '_class_scatter.jpg')
@@ -0,0 +1,127 @@
+# cost_model.py
+# Static estimate of the memory and compute that a cnn configuration needs, without allocating any data:
+# the model is built on the meta device and a shape-only forward pass records every operation.
+# Parameters are counted from the model, activations are the outputs of all operations in the forward pass that
+# are not views or in-place, FLOPs are counted with torch's flop counter (including the L x L matrices of attention).
+# The peak memory of training is estimated as weights, gradients and optimizer states plus batchsize times the input,
+# the activations and their gradients.
+import numpy as np
+import sys, os
+import copy
+import subprocess
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+# Number of states per parameter that the optimizers of fit_model keep
+optimizer_states = {'Adam': 2, 'AdamW': 2, 'NAdam': 2, 'Amsgrad': 3, 'SGD': 1, 'Adagrad': 1, 'Adadelta': 2, 'RMSprop': 2}
+
+
+# Records the bytes of the outputs of all operations that allocate new memory
+class activation_counter(TorchDispatchMode):
+    def __init__(self):
+        super(activation_counter, self).__init__()
+        self.nbytes = 0
+        self.largest = 0
+
+    def __torch_dispatch__(self, func, types, args = (), kwargs = None):
+        out = func(*args, **(kwargs or {}))
+        if not func.is_view and not func._schema.name.endswith('_'):
+            for tensor in tree_flatten(out)[0]:
+                if isinstance(tensor, torch.Tensor):
+                    nbytes = tensor.numel()*tensor.element_size()
+                    self.nbytes += nbytes
+                    self.largest = max(self.largest, nbytes)
+        return out
+
+
+# Shape-only forward pass of model (on meta device) with a batch of size n_samples
+# Returns parameters, bytes of parameters, bytes of input, activations and largest activation per sample, and FLOPs per sample
+def meta_forward(model, n_features, l_seqs, n_samples = 2):
+    x = torch.empty((n_samples, n_features, l_seqs), device = 'meta')
+    xadd = None
+    if getattr(model, 'fixed_kernels', None) is not None:
+        # the pwm scan has the length of the convolution output or of a valid scan with l_kernels
+        if model.num_kernels > 0:
+            l_scan = model.convolutions(x).size(-1)
+        else:
+            l_scan = l_seqs - model.l_kernels + 1
+        xadd = torch.empty((n_samples, len(model.fixed_kernels), l_scan), device = 'meta')
+    model.train()
+    counter = activation_counter()
+    flops = FlopCounterMode(display = False)
+    # tensors that modules create in their forward, f.e. norms of pooling layers, are also created on the meta device
+    with torch.device('meta'), flops, counter:
+        model(x, xadd = xadd)
+    costs = {}
+    costs['parameters'] = int(np.sum([p.numel() for p in model.parameters()]))
+    costs['trainable'] = int(np.sum([p.numel() for p in model.parameters() if p.requires_grad]))
+    costs['parameter_bytes'] = int(np.sum([p.numel()*p.element_size() for p in model.parameters()]))
+    costs['input_bytes'] = int(x.numel()*x.element_size()/n_samples)
+    costs['activation_bytes'] = int(counter.nbytes/n_samples)
+    costs['largest_activation'] = int(counter.largest/n_samples)
+    costs['flops'] = int(flops.get_total_flops()/n_samples)
+    # forward and backward together are about three times the forward FLOPs
+    costs['train_flops'] = 3*costs['flops']
+    return costs
+
+
+# Peak memory of training and of prediction in bytes for batchsize
+def peak_memory(costs, batchsize, optimizer = 'Adam'):
+    n_states = optimizer_states.get(optimizer, 2)
+    trainable_bytes = costs['parameter_bytes']*costs['trainable']/max(1, costs['parameters'])
+    train = costs['parameter_bytes'] + (1 + n_states)*trainable_bytes + batchsize*(costs['input_bytes'] + 2*costs['activation_bytes'])
+    predict = costs['parameter_bytes'] + batchsize*(costs['input_bytes'] + 2*costs['largest_activation'])
+    return int(train), int(predict)
+
+
+# Costs of an initialized model, the model is copied to the meta device and not changed
+# batchsize is the number of data points in a training step, if None model.batchsize or n_data
+def model_costs(model, batchsize = None, n_features = None, l_seqs = None, n_data = None):
+    if n_features is None:
+        n_features = model.n_features
+    if l_seqs is None:
+        l_seqs = model.l_seqs
+    if batchsize is None:
+        batchsize = getattr(model, 'batchsize', None)
+        if batchsize is None:
+            batchsize = n_data if n_data is not None else 1
+    metamodel = copy.deepcopy(model).to('meta')
+    costs = meta_forward(metamodel, n_features, l_seqs)
+    costs['batchsize'] = batchsize
+    costs['peak'], costs['peak_predict'] = peak_memory(costs, batchsize, optimizer = getattr(model, 'optimizer', 'Adam'))
+    return costs
+
+
+# Costs of cnn_model.cnn(**params) without allocating the weights, no files are written
+def config_costs(params, batchsize = None, n_data = None):
+    import cnn_model
+    params = dict(params)
+    params['generate_paramfile'], params['verbose'] = False, False
+    with torch.device('meta'):
+        model = cnn_model.cnn(**params)
+    if batchsize is None:
+        batchsize = model.batchsize
+        if batchsize is None:
+            batchsize = n_data if n_data is not None else 1
+    costs = meta_forward(model, model.n_features, model.l_seqs)
+    costs['batchsize'] = batchsize
+    costs['peak'], costs['peak_predict'] = peak_memory(costs, batchsize, optimizer = model.optimizer)
+    return costs
+
+
+# Memory of the machine in MB of 2**20 bytes: available memory on cpu, or free memory of every gpu from nvidia-smi
+def available_memory(device = 'cpu'):
+    if 'cuda' in str(device):
+        out = subprocess.run(['nvidia-smi', '--query-gpu=memory.used,memory.total', '--format=csv,noheader,nounits'], capture_output = True, text = True)
+        if out.returncode != 0:
+            print('nvidia-smi failed', out.stderr)
+            sys.exit()
+        memory = np.array([line.split(',') for line in out.stdout.strip().split('\n')], dtype = float)
+        return memory[:, 1] - memory[:, 0]
+    if os.path.isfile('/proc/meminfo'):
+        for line in open('/proc/meminfo', 'r').readlines():
+            if line.startswith('MemAvailable'):
+                return np.array([float(line.split()[1])/1024.])
+    return np.array([os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')/1024.**2])
@@ -0,0 +1,227 @@
+# crossvalidation.py
+# Trains all folds of a cross-validation, and optionally several repeats with different seeds, in one call.
+# Data is read, split, normalized and scanned with pwms only once, and the folds are trained in parallel worker processes
+# of job_scheduler.py that share X, Y and the pwm scans memory-mapped.
+# Every fold writes its performance like cnn_model.py --crossvalidation folds fold, the predictions of all test sets
+# are collected into out-of-fold predictions for every sequence, and the mean over repeats is assessed as ensemble.
+# Usage:
+# python crossvalidation.py inputfile outputfile --cnn params --folds 10 cutoff --seeds 1010,2020 --n_workers 10 1
+import numpy as np
+import sys, os
+import time
+from data_processing import readin, read_mutationfile, create_sets, create_outname, rescale_pwm, read_pwm, check
+from train import pwm_scan, pwmset_thresholds
+from motif_scanning import pfm_logodds
+from output import print_averages, save_performance
+from job_scheduler import job_pool, write_ctrl
+from results_store import class_metrics
+from run_registry import open_registry, register_run, data_hash
+
+
+if __name__ == '__main__':
+
+    inputfile = sys.argv[1]
+    outputfile = sys.argv[2]
+
+    delimiter = ','
+    if '--delimiter' in sys.argv:
+        delimiter = sys.argv[sys.argv.index('--delimiter')+1]
+
+    aregion = True
+    if '--regionless' in sys.argv:
+        aregion = False
+
+    X, Y, names, features, experiments = readin(inputfile, outputfile, delimiter = delimiter, return_header = True, assign_region = aregion)
+
+    if ',' in inputfile:
+        inputfiles = inputfile.split(',')
+        inputfile = inputfiles[0]
+        for inp in inputfiles[1:]:
+            inputfile = create_outname(inp, inputfile, lword = 'and')
+
+    outname = create_outname(inputfile, outputfile)
+    if '--regionless' in sys.argv:
+        outname += '-rgls'
+
+    if '--outdir' in sys.argv:
+        outname = sys.argv[sys.argv.index('--outdir')+1] + os.path.split(outname)[1]
+
+    if '--addname' in sys.argv:
+        outname += '_'+sys.argv[sys.argv.index('--addname')+1]
+
+    weights = None
+    if '--mutation_file' in sys.argv:
+        mutfile = sys.argv[sys.argv.index('--mutation_file')+1]
+        X,Y,names,experiments,weights = read_mutationfile(mutfile,X,Y,names,experiments)
+        if sys.argv[sys.argv.index('--mutation_file')+2] != 'weighted':
+            weights = None
+        outname = create_outname(mutfile, outname+'.dat', lword = 'with')
+    print(outname)
+
+    # --folds folds cutoff: number of folds or file with sets, and the cutoff to stratify the folds as in cnn_model.py --crossvalidation
+    # with --significant_genes the folds are stratified by the list of genes instead
+    folds, Yclass, cutoff = 10, None, None
+    if '--folds' in sys.argv:
+        folds = check(sys.argv[sys.argv.index('--folds')+1])
+        if '--significant_genes' in sys.argv:
+            siggenes = np.genfromtxt(sys.argv[sys.argv.index('--significant_genes')+1], dtype = str)
+            Yclass = np.isin(names, siggenes).astype(int)
+        elif len(sys.argv) > sys.argv.index('--folds')+2 and '--' not in sys.argv[sys.argv.index('--folds')+2]:
+            cutoff = float(sys.argv[sys.argv.index('--folds')+2])
+            Yclass = (np.sum(np.absolute(Y)>=cutoff, axis = 1) > 0).astype(int)
+    if isinstance(folds, int):
+        n_folds = folds
+        outname += '-cv'+str(folds)
+    else:
+        # a file with sets uses set fold as validation and fold+1 as test set
+        n_folds = len([line for line in open(folds, 'r').readlines() if line[0] != '#']) - 1
+        outname += '-cv'+os.path.splitext(os.path.split(folds)[1])[0]
+
+    # --seeds seed1,seed2 repeats the cross-validation with different splits and model initializations
+    seeds = [1010]
+    if '--seeds' in sys.argv:
+        seeds = [int(s) for s in sys.argv[sys.argv.index('--seeds')+1].split(',')]
+        outname += 'x'+str(len(seeds))
+
+    if '--norm2output' in sys.argv:
+        print ('ATTENTION: output has been normalized along data points')
+        outname += '-n2out'
+        outnorm = np.sqrt(np.sum(Y*Y, axis = 1))[:, None]
+        Y = Y/outnorm
+    elif '--norm2outputclass' in sys.argv:
+        print('ATTENTION: output has been normalized along data classess')
+        outname += '-n2outc'
+        outnorm = np.sqrt(np.sum(Y*Y, axis = 0))
+        Y = Y/outnorm
+
+    params = {'device': 'cpu'}
+    pwms, motcut, motpval = None, None, None
+    if '--list_of_pwms' in sys.argv:
+        list_of_pwms = sys.argv[sys.argv.index('--list_of_pwms')+1]
+        psam = '--psam' in sys.argv
+        infcont = '--infocont' in sys.argv
+        pwmnameset = np.array(os.path.splitext(os.path.split(list_of_pwms)[1])[0].split('_'))
+        outname += '_pwms'+'_'.join(pwmnameset[~np.isin(pwmnameset, outname.split('_'))]) + 'ps'+str(psam)[0]+'ic'+str(infcont)[0]
+        if '--motif_cutoff' in sys.argv:
+            motcut = float(sys.argv[sys.argv.index('--motif_cutoff')+1])
+            outname += 'mc'+str(motcut)
+        pfms, rbpnames = read_pwm(list_of_pwms)
+        pwms = rescale_pwm(pfms, psam = psam, infcont = infcont, norm = True)
+        if '--logodds_pwms' in sys.argv:
+            pwms = pfm_logodds(pfms)
+            outname += 'lo'
+            if '--motif_pvalue' in sys.argv:
+                motpval = float(sys.argv[sys.argv.index('--motif_pvalue')+1])
+                outname += 'mp'+str(motpval)
+        params['fixed_kernels'] = pwms
+        params['motif_cutoff'] = motcut
+
+    if '--cnn' in sys.argv:
+        parameters = sys.argv[sys.argv.index('--cnn')+1].split('+')
+        for p in parameters:
+            if ':' in p and '=' in p:
+                p = p.split('=',1)
+            elif ':' in p:
+                p = p.split(':',1)
+            elif '=' in p:
+                p = p.split('=',1)
+            params[p[0]] = check(p[1])
+    params['n_features'], params['l_seqs'], params['n_classes'] = np.shape(X)[-2], np.shape(X)[-1], np.shape(Y)[-1]
+    if '--keep_modelparams' in sys.argv:
+        params['keepmodel'] = True
+
+    # pwms are scanned once for all sequences and shared with all folds, p-value cutoffs are computed for the
+    # windows of l_kernels that are scanned
+    pwm_out = None
+    if pwms is not None:
+        if motpval is not None:
+            motcut = params['motif_cutoff'] = pwmset_thresholds(pwms, params.get('l_kernels', 7), pvalue = motpval)
+        pwm_out = pwm_scan(X, pwms, targetlen = params.get('l_kernels', 7), motif_cutoff = motcut, verbose = True)
+
+    if '--split_outclasses' in sys.argv:
+        testclasses = np.genfromtxt(sys.argv[sys.argv.index('--split_outclasses')+1], dtype = str)
+        tsort = []
+        for exp in experiments:
+            tsort.append(list(testclasses[:,0]).index(exp))
+        testclasses = testclasses[tsort][:,1]
+    else:
+        testclasses = np.zeros(len(Y[0]), dtype = np.int8).astype(str)
+
+    # one job for every fold of every repeat, outnames as in cnn_model.py with the seed of the repeat
+    jobs = []
+    for s, seed in enumerate(seeds):
+        for fold in range(n_folds):
+            trainset, testset, valset = create_sets(len(X), folds, fold, seed = seed, Yclass = Yclass, genenames = names)
+            modelparams = params.copy()
+            modelparams['seed'] = seed
+            modelparams['outname'] = outname + '-'+str(fold) + ('s'+str(seed) if len(seeds) > 1 else '')
+            jobs.append({'id': len(jobs), 'params': modelparams, 'trainset': trainset, 'valset': valset, 'testset': testset, 'repeat': s, 'fold': fold, 'lines': ['seed : '+str(seed), 'fold : '+str(fold)]})
+
+    n_workers, n_threads = 0, None
+    if '--n_workers' in sys.argv:
+        n_workers = int(sys.argv[sys.argv.index('--n_workers')+1])
+        if len(sys.argv) > sys.argv.index('--n_workers')+2 and '--' not in sys.argv[sys.argv.index('--n_workers')+2]:
+            n_threads = int(sys.argv[sys.argv.index('--n_workers')+2])
+    print('Training', len(jobs), 'folds with', max(1, n_workers), 'processes')
+
+    pool = job_pool(n_workers = n_workers, n_threads = n_threads, X = X, Y = Y, weights = weights, pwm_out = pwm_out)
+    ctrlfile = open(outname + '_cv-ctrl.txt', 'w')
+    for key in params:
+        if key == 'fixed_kernels' and params[key] is not None:
+            ctrlfile.write(key+' : '+str(len(params[key]))+'\n')
+        else:
+            ctrlfile.write(key+' : '+str(params[key])+'\n')
+
+    # --run_registry path registers every fold in an sqlite file, see run_registry.py
+    registry = None
+    if '--run_registry' in sys.argv:
+        registry = open_registry(sys.argv[sys.argv.index('--run_registry')+1])
+        datahash = data_hash(X, Y)
+    
+    # out-of-fold predictions of every repeat, nan for sequences that were in no test set
+    oof = np.ones((len(seeds),) + np.shape(Y)) * np.nan
+    modelnames = []
+    def write_result(result):
+        job = jobs[result['id']]
+        write_ctrl(ctrlfile, job['lines'], result)
+        if result['success']:
+            print('Finished', result['outname'])
+            oof[job['repeat'], job['testset']] = result['Y_pred']
+            modelnames.append(result['outname'])
+            Y_pred, Ytest = result['Y_pred'], Y[job['testset']]
+            if '--norm2output' in sys.argv:
+                Y_pred, Ytest = Y_pred*outnorm[job['testset']], Ytest*outnorm[job['testset']]
+            elif '--norm2outputclass' in sys.argv:
+                Y_pred, Ytest = Y_pred*outnorm, Ytest*outnorm
+            save_performance(Y_pred, Ytest, testclasses, experiments, names[job['testset']], result['outname'], sys.argv)
+            if registry is not None:
+                finished = time.time()
+                hashes = {'data': datahash, 'trainset': data_hash(job['trainset']), 'valset': data_hash(job['valset']), 'testset': data_hash(job['testset'])}
+                register_run(registry, result['outname'], result['params'], saveloss = result['saveloss'], metrics = class_metrics(Y_pred, Ytest, testclasses), experiments = experiments, hashes = hashes, started = finished - result['time'], finished = finished, epochs = result['epochs'])
+
+    for job in jobs:
+        pool.submit({key: value for key, value in job.items() if key not in ['lines', 'repeat', 'fold']})
+        if n_workers == 0:
+            write_result(pool.get())
+    for result in pool.collect():
+        write_result(result)
+    pool.close()
+    ctrlfile.close()
+
+    # ensemble is the mean over the out-of-fold predictions of all repeats
+    predicted = np.where(~np.isnan(oof).all(axis = (0, 2)))[0]
+    if len(predicted) == 0:
+        print('No fold was trained successfully')
+        sys.exit()
+    Y_ens = np.nanmean(oof[:, predicted], axis = 0)
+    Ytest = Y[predicted]
+    if '--norm2output' in sys.argv:
+        Y_ens, Ytest = Y_ens*outnorm[predicted], Ytest*outnorm[predicted]
+    elif '--norm2outputclass' in sys.argv:
+        Y_ens, Ytest = Y_ens*outnorm, Ytest*outnorm
+    print('Ensemble of', len(seeds), 'repeats for', len(predicted), 'sequences')
+    print_averages(Y_ens, Ytest, testclasses, sys.argv)
+    save_performance(Y_ens, Ytest, testclasses, experiments, names[predicted], outname+'_ensemble', sys.argv)
+    np.savez_compressed(outname+'_cvpredictions.npz', names = names, experiments = experiments, oof = oof, ensemble = Y_ens, predicted = predicted, models = np.array(modelnames))
+    if '--save_predictions' in sys.argv:
+        np.savetxt(outname+'_ensemble_pred.txt', np.append(names[predicted][:, None], Y_ens, axis = 1), fmt = '%s')
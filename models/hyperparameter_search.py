@@ -14,50 +14,18 @@ import time
 import torch
 import torch.nn as nn
 import cnn_model
+from cost_model import model_costs, config_costs, available_memory
 from scipy.spatial.distance import cdist
 from scipy.stats import pearsonr, cosine
 
-def compute_memory(model, batchsize, n_feataures, l_sequence):
-    input_ = torch.rand(batchsize, n_features, l_sequence)
-    totalmemory = batchsize*n_features*l_sequence*32
-    for param_tensor in model.state_dict():
-        totalmemory += np.prod(model.state_dict()[param_tensor].size())*32
-    
-    all_layers = []
-    def remove_sequential(network):
-        for layer in network.children():
-            if type(layer) == nn.Sequential: # if sequential layer, apply recursively to layers in sequential layer
-                remove_sequential(layer)
-            if list(layer.children()) == []: # if leaf node, add it to list
-                all_layers.append(layer)       
-                
-    remove_sequential(model)
-    for layer in all_layers:
-        input_size = input_.size()
-        layer_dict = layer.state_dict()
-        if 'weight' in layer_dict:
-            required_input_size = layer_dict['weight'].size(dim = 1)
-        else:
-            required_input_size = input_size[1]
-        if required_input_size != input_size[1]:
-            input_ = torch.flatten(input_, start_dim = 1)
-            
-        input_ = layer(input_)
-        out_size = np.array(input_.size())
-        totalmemory += np.prod(out_size)*32*2
-    totalmemory/=8e6
-    return totalmemory
-
-
+# Memory in MB (2**20 bytes, like available_memory) that training of model with batchsize needs, estimated with a shape-only forward pass on the meta device
+def compute_memory(model, batchsize, n_features, l_sequence):
+    return model_costs(model, batchsize = batchsize, n_features = n_features, l_seqs = l_sequence)['peak']/2**20
 
 
 # Assess space on gpu and whether another model can be trained on it
 def get_free_gpu(model):
-    os.system('nvidia-smi -q -d Memory |grep -A4 GPU|grep Used >tmp')
-    memory_used = np.array([int(x.split()[2]) for x in open('tmp', 'r').readlines()])
-    os.system('nvidia-smi -q -d Memory |grep -A4 GPU|grep Total >tmp')
-    memory_total = np.array([int(x.split()[2]) for x in open('tmp', 'r').readlines()])
-    memory_available = memory_total - memory_used - 6000 
+    memory_available = available_memory('cuda') - 6000
     required_memory = compute_memory(model, model.batchsize, model.n_features, model.l_seqs)
     for m, avail in enumerate(memory_available):
         if required_memory < avail:
@@ -84,6 +52,10 @@ def combinations(i, n):
 
 
 from output import save_performance
+from job_scheduler import job_pool, write_ctrl, pack_workers
+from results_store import class_metrics
+from run_registry import open_registry, register_run, data_hash
+from search_strategies import successive_halving, tpe_search, population_based_training
 
 
 if __name__ == '__main__':
@@ -263,143 +235,152 @@ if __name__ == '__main__':
     for key in params:
         ctrlfile.write(key+' : '+str(params[key])+'\n')
     
-    # Train the reference model
-    
+    # The reference model and all combinations of the grid search are collected as jobs first
+    jobs = []
     modelparams = params.copy()
     if modelparams['fixed_kernels'] is None:
         modelparams['outname'] = outname
     else:
         modelparams['outname'] = outname + pwmoutname
-    
-    try:
-        model = cnn_model.cnn(**modelparams)
-        modelname = model.outname
-    except Exception as err:
-        print(err, type(err))
-        err = str(err)
-        ctrlfile.write(err+'\n\n')
-        if os.path.isfile(modelname+'_model_params.dat'):
-            os.remove(modelname+'_model_params.dat')
-        success = False
-    else:
-        success = True
-    modelname = model.outname
-    if success:
-        print('Started')
-        try:
-            model.fit(X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights)
-        except Exception as err:
-            print(err, type(err))
-            err = str(err)
-            ctrlfile.write(err+'\n\n')
-            if os.path.isfile(modelname+'_model_params.dat'):
-                os.remove(modelname+'_model_params.dat')
-            if os.path.isfile(modelname+'_parameter.pth'):
-                os.remove(modelname+'_parameter.pth')
-            if os.path.isfile(modelname+'_params0.pth'):
-                os.remove(modelname+'_params0.pth')
-            success = False
-        else:
-            success = True
-        if success:
-            ctrlfile.write('Results:'+'\n'+str(model.validation_loss)+'(val) '+model.validation_loss+'(train) '+model.loss_function+'(val) '+model.loss_function+ '(train) Epochs\n'+' '.join(np.around(model.saveloss,3).astype(str))+'\n\n')
-            Y_pred = model.predict(X[testset])
-            save_performance(Y_pred, Y[testset], testclasses, experiments, names[testset], model.outname, sys.argv)
-            #outwrite.write(Y_pred, Y[testset], names[testset], experiments, model.outname, testclasses)
-    
-    #model = cnn_model.cnn(**modelparams)
-    #model.fit(X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights)
-    
-    #ctrlfile.write('Results:'+'\n'+model.validation_loss+'(val) '+model.loss_function+'(val) '+model.validation_loss+'(train) '+model.loss_function+ '(train) Epochs\n'+' '.join(np.around(model.saveloss,3).astype(str))+'\n\n')
-    
-    #Y_pred = model.predict(X[testset])
-    #outwrite.write(Y_pred, Y[testset], names[testset], experiments, model.outname, testclasses)
-    
-    for search_along in range(1, n_varying_parameter+1):
-        hypercomb = combinations(search_along, len(n_hyper))
-        gsize = 0
-        for hyp in hypercomb:
-            gsize += np.prod(n_hyper[hyp])
-        print('Total number of models for gridsearch of size', search_along, 'is', gsize)
-        hyperkeys = np.array(list(hyperparameter.keys()))
-        hypervalues = list(hyperparameter.values())
-        comb = 0
-        ac = 0
-        #clear = 0
-        while True:
-            hyp = hypercomb[comb]
-            choskeys = hyperkeys[hyp]
-            print('\nSearch along', choskeys)
-            allcombos = list(itertools.product(*[hypervalues[h] for h in hyp]))
-            acomb = allcombos[ac]
-            modelparams = params.copy()
-            modelparams['outname'] = outname
-            for h in range(len(acomb)):
-                modelparams[choskeys[h]] = acomb[h]
-                print(choskeys[h], ':', acomb[h])
-                ctrlfile.write(choskeys[h]+' : '+str(acomb[h])+'\n')   
-            
-            for h in range(len(acomb)):
-                if choskeys[h] == 'fixed_kernels' and acomb[h] is not None:
-                    modelparams[choskeys[h]] = pwms
-                    modelparams['outname'] = modelparams['outname'] + pwmoutname
+    jobs.append({'id': 0, 'params': modelparams, 'lines': []})
+    
+    memory_limit = None
+    # --checkpoint minutes saves the training state of every model every minutes, so that a restarted search continues them
+    fit_kwargs = {}
+    if '--checkpoint' in sys.argv:
+        fit_kwargs['checkpoint_minutes'] = float(sys.argv[sys.argv.index('--checkpoint')+1])
+    jobs[0]['fit_kwargs'] = fit_kwargs
+    
+    # Adds the job for a configuration, dictionary with the values of the varied hyperparameters
+    # The job id is part of the outname, so that configurations whose parameters are not all in the file names,
+    # f.e. seed or patience, do not share their files and checkpoints
+    def make_job(config):
+        modelparams = params.copy()
+        modelparams['outname'] = outname+'-job'+str(len(jobs))
+        lines = []
+        for key, value in config.items():
+            modelparams[key] = value
+            lines.append(key+' : '+str(value))
+        for key, value in config.items():
+            if key == 'fixed_kernels' and value is not None:
+                modelparams[key] = pwms
+                modelparams['outname'] = modelparams['outname'] + pwmoutname
+        jobs.append({'id': len(jobs), 'params': modelparams, 'lines': lines, 'trainset': trainset, 'valset': valset, 'testset': testset, 'memory_limit': memory_limit, 'fit_kwargs': fit_kwargs})
+        return {key: value for key, value in jobs[-1].items() if key != 'lines'}
+    
+    # --tpe n_trials n_startup replaces the grid with n_trials configurations from a tree-structured Parzen estimator
+    # over the values in --hyper_parameter, the first n_startup (default 10) are random, --pbt also replaces the grid
+    gridsearch = '--tpe' not in sys.argv and '--pbt' not in sys.argv
+    if gridsearch:
+        for search_along in range(1, n_varying_parameter+1):
+            hypercomb = combinations(search_along, len(n_hyper))
+            gsize = 0
+            for hyp in hypercomb:
+                gsize += np.prod(n_hyper[hyp])
+            print('Total number of models for gridsearch of size', search_along, 'is', gsize)
+            hyperkeys = np.array(list(hyperparameter.keys()))
+            hypervalues = list(hyperparameter.values())
+            for hyp in hypercomb:
+                choskeys = hyperkeys[hyp]
+                for acomb in itertools.product(*[hypervalues[h] for h in hyp]):
+                    make_job(dict(zip(choskeys, acomb)))
+    
+    # --n_workers n_workers n_threads trains the jobs in parallel processes that share X and Y memory-mapped,
+    # with n_threads torch threads each (default: all cores divided by n_workers). Without it, jobs are trained one after another
+    # --n_workers auto n_threads packs as many workers onto the cores as fit into memory with the largest configuration
+    n_workers, n_threads = 0, None
+    if '--n_workers' in sys.argv:
+        n_workers = sys.argv[sys.argv.index('--n_workers')+1]
+        if n_workers != 'auto':
+            n_workers = int(n_workers)
+        if len(sys.argv) > sys.argv.index('--n_workers')+2 and '--' not in sys.argv[sys.argv.index('--n_workers')+2]:
+            n_threads = int(sys.argv[sys.argv.index('--n_workers')+2])
+    
+    # Parameters, activation memory, FLOPs and the peak memory of training are estimated for every configuration
+    # on the meta device. --memory_limit MB rejects configurations with a larger peak before they start, memory is
+    # given in MB of 2**20 bytes, the unit of available_memory, nvidia-smi and /proc/meminfo,
+    # with --n_workers auto the limit is the available memory divided by the number of workers
+    if '--memory_limit' in sys.argv or n_workers == 'auto':
+        memory = available_memory(params['device'])
+        memory = memory[int(params['device'].split(':')[-1])] - 6000 if 'cuda' in params['device'] else memory[0]
+        peaks = []
+        for job in jobs:
             try:
-                model = cnn_model.cnn(**modelparams)
-                modelname = model.outname
+                costs = config_costs(job['params'], n_data = len(trainset))
             except Exception as err:
-                print(err, type(err))
-                err = str(err)
-                ctrlfile.write(err+'\n\n')
-                if os.path.isfile(modelname+'_model_params.dat'):
-                    os.remove(modelname+'_model_params.dat')
-                success = False
-            else:
-                success = True
-            modelname = model.outname
-            if success:
-                print('Started')
-                try:
-                    model.fit(X[trainset], Y[trainset], XYval = [X[valset], Y[valset]], sample_weights = weights)
-                except Exception as err:
-                    print(err, type(err))
-                    err = str(err)
-                    ctrlfile.write(err+'\n\n')
-                    if os.path.isfile(modelname+'_model_params.dat'):
-                        os.remove(modelname+'_model_params.dat')
-                    if os.path.isfile(modelname+'_parameter.pth'):
-                        os.remove(modelname+'_parameter.pth')
-                    if os.path.isfile(modelname+'_params0.pth'):
-                        os.remove(modelname+'_params0.pth')
-                    success = False
-                else:
-                    success = True
-                if success:
-                    ctrlfile.write('Results:'+'\n'+model.validation_loss+'(val) '+model.validation_loss+'(train) '+model.loss_function+'(val) '+model.loss_function+ '(train) Epochs\n'+' '.join(np.around(model.saveloss,3).astype(str))+'\n\n')
-                    Y_pred = model.predict(X[testset])
-                    save_performance(Y_pred, Y[testset], testclasses, experiments, names[testset], model.outname, sys.argv)
-                    #outwrite.write(Y_pred*outnorm, Y[testset]*outnorm, names[testset], experiments, model.outname, testclasses)
-            
-            ac += 1
-            if ac == len(allcombos):
-                ac = 0
-                comb += 1
-            if comb == len(hypercomb):
-                break
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-
-
-
+                print('Cost estimate failed for', job['lines'], err)
+                continue
+            print('Model', job['id'], ' '.join(job['lines']), 'parameters', costs['parameters'], 'activations/sample', round(costs['activation_bytes']/2**20, 3), 'MB FLOPs/sample', costs['flops'], 'peak', round(costs['peak']/2**20, 1), 'MB')
+            peaks.append(costs['peak']/2**20)
+        if '--memory_limit' in sys.argv:
+            memory_limit = float(sys.argv[sys.argv.index('--memory_limit')+1])
+        if n_workers == 'auto':
+            fitting = [peak for peak in peaks if peak <= min(memory, memory_limit if memory_limit is not None else memory)]
+            n_workers = pack_workers(np.amax(fitting) if len(fitting) > 0 else 0, memory, n_threads = 1 if n_threads is None else n_threads)
+            if memory_limit is None:
+                memory_limit = memory/n_workers
+        elif memory_limit is None:
+            memory_limit = memory/max(1, n_workers)
+        print('Memory limit per model', round(memory_limit, 1), 'MB')
+        for job in jobs:
+            job['memory_limit'] = memory_limit
+    if gridsearch:
+        print('Training', len(jobs), 'models with', max(1, n_workers), 'processes')
+    
+    pool = job_pool(n_workers = n_workers, n_threads = n_threads, X = X, Y = Y, weights = weights)
+    
+    # --run_registry path registers every finished model in an sqlite file, see run_registry.py
+    registry = None
+    if '--run_registry' in sys.argv:
+        registry = open_registry(sys.argv[sys.argv.index('--run_registry')+1])
+        hashes = {'data': data_hash(X, Y), 'trainset': data_hash(trainset), 'valset': data_hash(valset), 'testset': data_hash(testset)}
+    
+    # ctrl file and performance are written by the main process in the order in which the models finish
+    def write_result(result):
+        job = jobs[result['id']]
+        for line in job['lines']:
+            print(line)
+        write_ctrl(ctrlfile, job['lines'], result)
+        if result['success']:
+            save_performance(result['Y_pred'], Y[testset], testclasses, experiments, names[testset], result['outname'], sys.argv)
+            if registry is not None:
+                finished = time.time()
+                register_run(registry, result['outname'], result['params'], saveloss = result['saveloss'], metrics = class_metrics(result['Y_pred'], Y[testset], testclasses), experiments = experiments, hashes = hashes, started = finished - result['time'], finished = finished, epochs = result['epochs'])
+    
+    for job in jobs:
+        job['trainset'], job['valset'], job['testset'] = trainset, valset, testset
+    
+    # --asha min_epochs eta trains all configurations for min_epochs, promotes the best 1/eta of every rung to eta times more epochs
+    # and stops the others, the validation loss of every rung is written to _asha.txt
+    if '--asha' in sys.argv:
+        min_epochs = int(sys.argv[sys.argv.index('--asha')+1])
+        eta = 3
+        if len(sys.argv) > sys.argv.index('--asha')+2 and '--' not in sys.argv[sys.argv.index('--asha')+2]:
+            eta = int(sys.argv[sys.argv.index('--asha')+2])
+        successive_halving(pool, jobs, min_epochs, eta = eta, max_epochs = params.get('epochs', 1000), tablefile = outname+'_asha.txt', on_final = write_result)
+    elif '--pbt' in sys.argv:
+        # --pbt n_members interval fraction trains a population of random configurations in segments of interval epochs,
+        # after every segment members in the bottom fraction (default 0.25) copy the weights of a member in the top fraction
+        # and continue with its perturbed hyperparameters, every segment is written to _pbt.txt
+        n_members = int(sys.argv[sys.argv.index('--pbt')+1])
+        interval = int(sys.argv[sys.argv.index('--pbt')+2])
+        fraction = 0.25
+        if len(sys.argv) > sys.argv.index('--pbt')+3 and '--' not in sys.argv[sys.argv.index('--pbt')+3]:
+            fraction = float(sys.argv[sys.argv.index('--pbt')+3])
+        population_based_training(pool, hyperparameter, make_job, n_members, interval, max_epochs = params.get('epochs', 1000), fraction = fraction, tablefile = outname+'_pbt.txt', on_final = write_result)
+    elif '--tpe' in sys.argv:
+        n_trials = int(sys.argv[sys.argv.index('--tpe')+1])
+        n_startup = 10
+        if len(sys.argv) > sys.argv.index('--tpe')+2 and '--' not in sys.argv[sys.argv.index('--tpe')+2]:
+            n_startup = int(sys.argv[sys.argv.index('--tpe')+2])
+        print('TPE search with', n_trials, 'trials')
+        tpe_search(pool, hyperparameter, make_job, n_trials, n_startup = n_startup, jobs = [{key: value for key, value in jobs[0].items() if key != 'lines'}], tablefile = outname+'_tpe.txt', on_final = write_result)
+    else:
+        for job in jobs:
+            pool.submit({key: value for key, value in job.items() if key != 'lines'})
+            if n_workers == 0:
+                write_result(pool.get())
+        for result in pool.collect():
+            write_result(result)
+    pool.close()
+    ctrlfile.close()
@@ -0,0 +1,270 @@
+# incremental.py
+# Incremental forward pass for sequences that change at few positions, f.e. during sequence design
+# The activations of every layer in the convolution and pooling stack (first convolution, modelstart, dilated convolutions)
+# are kept for the current sequence. If bases change, only the window of each layer's output that lies in the
+# receptive field of the changed positions is recomputed. All following layers (attention, flatten, fully connected)
+# are run on the entire updated activation with cnn.forward_from.
+# ism_loss scores all single base mutants of the current sequence in the same way: every batch of mutants only computes
+# the receptive field of its mutated positions and takes all other activations from the current sequence.
+# Layers that are not known to be local are recomputed entirely, so that the output is always the same as model.forward
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from modules import pooling_layer, Padded_Conv1d, Padded_AvgPool1d, Residual_convolution, Res_Conv1d, Kernel_linear, EXPmax, POWmax
+from ism import can_update_convolution, ism_positions, ism_batch_mutants, ism_batchsize, sequence_loss, ism_loss
+
+
+pointwise_layers = (nn.GELU, nn.ReLU, nn.Sigmoid, nn.Tanh, nn.Identity, nn.Threshold, EXPmax, POWmax, Kernel_linear)
+# only pointwise if not in training mode
+eval_pointwise_layers = (nn.Dropout, nn.BatchNorm1d)
+
+
+def single_value(value):
+    if isinstance(value, tuple) or isinstance(value, list):
+        return value[0]
+    return value
+
+
+# Returns kernel_size, stride, dilation and left padding of layers that compute every output from a window of the input
+# Returns None for layers that are not local or not supported
+def window_parameters(layer):
+    if isinstance(layer, nn.Conv1d):
+        if isinstance(layer.padding, str) or layer.padding_mode != 'zeros':
+            return None
+        return layer.kernel_size[0], layer.stride[0], layer.dilation[0], layer.padding[0]
+    if isinstance(layer, Padded_Conv1d):
+        if layer.padding is not None and layer.padding_mode != 'constant':
+            return None
+        pad = 0 if layer.padding is None else layer.padding[0]
+        return single_value(layer.kernel_size), single_value(layer.stride), single_value(layer.dilation), pad
+    if isinstance(layer, nn.MaxPool1d):
+        if layer.ceil_mode or layer.return_indices:
+            return None
+        return single_value(layer.kernel_size), single_value(layer.stride), single_value(layer.dilation), single_value(layer.padding)
+    if isinstance(layer, nn.AvgPool1d):
+        if layer.ceil_mode:
+            return None
+        return single_value(layer.kernel_size), single_value(layer.stride), 1, single_value(layer.padding)
+    if isinstance(layer, Padded_AvgPool1d):
+        pad = layer.padding[0] if layer.gopad else 0
+        return layer.kernel_size, layer.stride, layer.dilation, pad
+    if isinstance(layer, nn.ZeroPad2d):
+        if layer.padding[2] != 0 or layer.padding[3] != 0:
+            return None
+        return 1, 1, 1, layer.padding[0]
+    return None
+
+
+# Slice of x along the last axis from start to end, entries outside of x are filled with value
+def padded_slice(x, start, end, value = 0.):
+    l = x.size(-1)
+    xs = x[..., max(start, 0):min(end, l)]
+    if start < 0 or end > l:
+        xs = F.pad(xs, (max(-start, 0), max(end - l, 0)), value = value)
+    return xs
+
+
+# Output of a local layer at positions oa to ob, computed from the window of the input x that is needed for them
+def window_output(layer, x, oa, ob, params):
+    k, s, d, pad = params
+    ia, ib = oa*s - pad, (ob-1)*s - pad + d*(k-1) + 1
+    if isinstance(layer, nn.Conv1d):
+        return F.conv1d(padded_slice(x, ia, ib), layer.weight, layer.bias, stride = s, dilation = d, groups = layer.groups)
+    if isinstance(layer, Padded_Conv1d):
+        value = 0. if layer.value is None else layer.value
+        return layer.conv1d(padded_slice(x, ia, ib, value = value))
+    if isinstance(layer, nn.MaxPool1d):
+        return F.max_pool1d(padded_slice(x, ia, ib, value = -float('inf')), k, stride = s, dilation = d)
+    if isinstance(layer, nn.AvgPool1d):
+        xs = F.avg_pool1d(padded_slice(x, ia, ib), k, stride = s)
+        if not layer.count_include_pad:
+            xs = xs/F.avg_pool1d(padded_slice(torch.ones_like(x[:1,:1]), ia, ib), k, stride = s)
+        return xs
+    if isinstance(layer, Padded_AvgPool1d):
+        xs = F.conv2d(padded_slice(x, ia, ib).unsqueeze(1), layer.weight, stride = layer.stride, dilation = layer.dilation)
+        return (xs/layer.norm[..., oa:ob]).squeeze(1)
+    if isinstance(layer, nn.ZeroPad2d):
+        return padded_slice(x, ia, ib)
+
+
+def is_empty(rng):
+    return rng is not None and rng[0] >= rng[1]
+
+
+def hull(rnga, rngb):
+    if rnga is None or rngb is None:
+        return None
+    if is_empty(rnga):
+        return rngb
+    if is_empty(rngb):
+        return rnga
+    return (min(rnga[0], rngb[0]), max(rnga[1], rngb[1]))
+
+
+class incremental_forward(nn.Module):
+    def __init__(self, model):
+        super(incremental_forward, self).__init__()
+        self.model = model
+        self.supported = can_update_convolution(model)
+        self.cache = {}
+        self.pred = None
+        # number of mutants in the batch while ism_loss runs, the cache is only read then
+        self.n_mutants = None
+
+    # Full forward pass that stores the activations of all layers in the convolution stack
+    def forward(self, x):
+        self.cache = {}
+        with torch.no_grad():
+            if not self.supported:
+                self.pred = self.model.forward(x)
+            else:
+                self.pred = self.run_stack(x, None)
+        return self.pred
+
+    # Prediction for x, which differs from the last sequence only at positions
+    def update(self, x, positions):
+        if self.pred is None or not self.supported:
+            return self.forward(x)
+        positions = np.atleast_1d(positions)
+        if len(positions) == 0:
+            return self.pred
+        with torch.no_grad():
+            self.pred = self.run_stack(x, (int(np.amin(positions)), int(np.amax(positions))+1))
+        return self.pred
+
+    # Change in loss for every single base mutant of x (1, 4, L), the last sequence given to forward or update, to target
+    # Returns the same as ism.ism_loss: ismloss (4, L), the loss and the prediction of x
+    # Mutants are sorted by position, so that the mutants in a batch only change a small window of the sequence,
+    # batches cover about sqrt(L) positions unless batchsize is given, larger windows recompute most of the sequence
+    def ism_loss(self, x, target, loss, max_memory = 1024, batchsize = None):
+        x = torch.as_tensor(x, dtype = torch.float).detach()
+        if self.pred is None or not self.supported:
+            return ism_loss(self.model, x, target, loss, max_memory = max_memory, batchsize = batchsize)
+        target = torch.as_tensor(target, dtype = torch.float).reshape(1, -1)
+        pos, obase, nbase = ism_positions(x[0])
+        order = np.argsort(pos, kind = 'stable')
+        pos, nbase = pos[order], nbase[order]
+        if batchsize is None:
+            batchsize = min(ism_batchsize(self.model, x, max_memory = max_memory), (x.size(-2)-1)*int(np.ceil(np.sqrt(x.size(-1)))))
+        preds = []
+        try:
+            with torch.no_grad():
+                for b in range(0, len(pos), batchsize):
+                    mutants = ism_batch_mutants(x, np.zeros(len(pos[b:b+batchsize]), dtype = int), pos[b:b+batchsize], nbase[b:b+batchsize])
+                    self.n_mutants = len(mutants)
+                    preds.append(self.run_stack(mutants, (int(pos[b]), int(pos[b:b+batchsize][-1])+1)))
+        finally:
+            self.n_mutants = None
+        with torch.no_grad():
+            mloss = sequence_loss(loss, torch.cat(preds, dim = 0), target).cpu().numpy()
+            refloss = sequence_loss(loss, self.pred, target).cpu().numpy()
+        ismloss = np.zeros(tuple(x.size()[1:]))
+        ismloss[nbase, pos] = mloss - refloss[0]
+        return ismloss, refloss[0], self.pred[0]
+
+    def run_stack(self, x, rng):
+        pred, rng = self.run(self.model.convolutions, x, rng, 'convolutions')
+        pred, rng = self.run(self.model.modelstart, pred, rng, 'modelstart')
+        if self.model.dilated_convolutions > 0:
+            pred, rng = self.run(self.model.convolution_layers, pred, rng, 'convolution_layers')
+        if is_empty(rng):
+            return self.pred if self.n_mutants is None else self.pred.expand((self.n_mutants,) + tuple(self.pred.size()[1:]))
+        return self.model.forward_from(pred, start = 2)
+
+    # Computes output of layer for input x, in which only positions rng[0] to rng[1] changed since the last call
+    # rng is None for a full forward pass. Returns the output and the range of positions in the output that changed
+    def run(self, layer, x, rng, key):
+        if isinstance(layer, nn.Sequential):
+            for name, child in layer.named_children():
+                x, rng = self.run(child, x, rng, key+'.'+name)
+            return x, rng
+        if isinstance(layer, Res_Conv1d):
+            return self.run_res_conv(layer, x, rng, key)
+        if isinstance(layer, Residual_convolution):
+            if layer.compute_residual:
+                return self.run(layer.rconv, x, rng, key+'.rconv')
+            return x, rng
+        if isinstance(layer, pooling_layer):
+            if layer.mean_pooling and layer.max_pooling:
+                xa, rnga = self.run(layer.poola, x, rng, key+'.poola')
+                xb, rngb = self.run(layer.poolb, x, rng, key+'.poolb')
+                rng = hull(rnga, rngb)
+                if rng is None:
+                    return self.store(key, torch.cat((xa, xb), dim = -2), None)
+                y = self.output(key)
+                if not is_empty(rng):
+                    y[..., rng[0]:rng[1]] = torch.cat((xa[..., rng[0]:rng[1]], xb[..., rng[0]:rng[1]]), dim = -2)
+                return y, rng
+            return self.run(layer.pool, x, rng, key+'.pool')
+
+        if rng is None:
+            return self.store(key, layer(x), None)
+        if is_empty(rng):
+            return self.cached(key), rng
+
+        if isinstance(layer, pointwise_layers) or (isinstance(layer, eval_pointwise_layers) and not layer.training):
+            y = self.output(key)
+            y[..., rng[0]:rng[1]] = layer(x[..., rng[0]:rng[1]])
+            return y, rng
+
+        params = window_parameters(layer)
+        if params is None:
+            # not a local layer, entire output needs to be updated
+            y = layer(x)
+            return self.store(key, y, (0, y.size(-1)))
+
+        k, s, d, pad = params
+        y = self.output(key)
+        oa = max(0, int(np.ceil((rng[0] + pad - d*(k-1))/s)))
+        ob = min(y.size(-1), int(np.floor((rng[1] - 1 + pad)/s)) + 1)
+        if oa < ob:
+            y[..., oa:ob] = window_output(layer, x, oa, ob, params)
+        return y, (oa, ob)
+
+    # Follows Res_Conv1d.forward
+    def run_res_conv(self, layer, x, rng, key):
+        res0, rng0 = x, rng
+        res, rngres = x, rng
+        pred, rngpred = x, rng
+        for name, item in layer.convlayers.items():
+            if "Residuallayer" in name:
+                residual, rngresidual = self.run(item, res, rngres, key+'.'+name)
+                res, rngres = pred, rngpred
+                pred, rngpred = self.add(pred, rngpred, residual, rngresidual, key+'.add'+name)
+            else:
+                pred, rngpred = self.run(item, pred, rngpred, key+'.'+name)
+        if layer.residual_entire is not None:
+            residual, rngresidual = self.run(layer.residual_entire, res0, rng0, key+'.residual_entire')
+            pred, rngpred = self.add(pred, rngpred, residual, rngresidual, key+'.addresidual_entire')
+        return pred, rngpred
+
+    def add(self, xa, rnga, xb, rngb, key):
+        rng = hull(rnga, rngb)
+        if rng is None:
+            return self.store(key, xa + xb, None)
+        if is_empty(rng):
+            return self.cached(key), rng
+        y = self.output(key)
+        y[..., rng[0]:rng[1]] = xa[..., rng[0]:rng[1]] + xb[..., rng[0]:rng[1]]
+        return y, rng
+
+    # Outputs are copied because some layers return their input, which is changed in place later on
+    # Outputs of mutants are not stored
+    def store(self, key, y, rng):
+        if self.n_mutants is not None:
+            return y, rng
+        self.cache[key] = y.clone()
+        return self.cache[key], rng
+
+    # Stored output of the current sequence, for every mutant while ism_loss runs
+    def cached(self, key):
+        if self.n_mutants is None:
+            return self.cache[key]
+        return self.cache[key].expand((self.n_mutants,) + tuple(self.cache[key].size()[1:]))
+
+    # Output that is changed at the updated positions, the stored output itself or a copy for the mutants
+    def output(self, key):
+        if self.n_mutants is None:
+            return self.cache[key]
+        return self.cached(key).clone()
@@ -31,7 +31,11 @@ def load_parameters(model, PATH, translate_dict = None, allow_reduction = False,
                     ntens[:state_dict[name].size(dim = 0)] = state_dict[name]
                 elif cstate_dict[name0].size(dim = 0) <= state_dict[name].size(dim = 0) and ((cstate_dict[name0].size(dim = -1) == state_dict[name].size(dim = -1)) or ((len(cstate_dict[name0].size()) ==1) and (len(state_dict[name].size())==1))):
                     ntens = state_dict[name][:cstate_dict[name0].size(dim = 0)]
-                cstate_dict[name0] = ntens
+                # tensors that cannot be sliced into each other keep their initialization
+                if ntens is not None:
+                    cstate_dict[name0] = ntens
+                else:
+                    print('Not loaded', name0, 'with size', tuple(state_dict[name].size()))
             
     model.load_state_dict(cstate_dict)
     
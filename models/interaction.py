@@ -0,0 +1,183 @@
+# interaction.py
+# Interactions between motifs in sequences, measured only between positions of candidate segments,
+# f.e. the motifs that find_pwms detects in saliency maps.
+# pairwise_ism: double mutations, epistasis = f(x_ij) - f(x_i) - f(x_j) + f(x)
+# integrated_hessians: second order of integrated gradients (Janizek et al. 2021), interaction of position i and j is
+#     (x_i-x'_i)(x_j-x'_j) * integral over alpha and beta of alpha*beta*d2f/dx_idx_j(x' + alpha*beta*(x-x'))
+# Mutants of many sequences are evaluated in the same batches, and the number of model evaluations is limited by
+# budget, pairs of mutations are sampled if all pairs would exceed it.
+# interaction_tables converts the results of all sequences into numeric tables that can be saved without pickle.
+import numpy as np
+import torch
+import torch.nn as nn
+import sys, os
+from ism import ism_batchsize, memory_per_sequence
+from attribution import attribution_objective
+
+
+# Positions in segments and the index of the segment that they belong to
+def segment_positions(segments):
+    positions = [np.arange(start, end+1) for start, end in segments]
+    if len(positions) == 0:
+        return np.array([], dtype = int), np.array([], dtype = int)
+    return np.concatenate(positions), np.concatenate([np.ones(len(pos), dtype = int)*s for s, pos in enumerate(positions)])
+
+
+# Generates mutants of seqs (N, 4, L) with up to two changed positions
+# pos1 and pos2 are -1 if the position should not be changed
+def double_mutants(seqs, sid, pos1, nbase1, pos2, nbase2):
+    mutants = seqs[torch.as_tensor(sid, dtype = torch.long)]
+    for pos, nbase in [[pos1, nbase1], [pos2, nbase2]]:
+        change = np.where(pos >= 0)[0]
+        if len(change) > 0:
+            change, cpos, cbase = [torch.as_tensor(c, dtype = torch.long) for c in [change, pos[change], nbase[change]]]
+            mutants[change, :, cpos] = 0
+            mutants[change, cbase, cpos] = 1
+    return mutants
+
+
+# Objective for all mutants, evaluated in batches
+def evaluate_mutants(model, seqs, mutations, batchsize, tracks = None, target = None, loss = None):
+    sid, pos1, nbase1, pos2, nbase2 = mutations
+    values = []
+    with torch.no_grad():
+        for b in range(0, len(sid), batchsize):
+            mutants = double_mutants(seqs, sid[b:b+batchsize], pos1[b:b+batchsize], nbase1[b:b+batchsize], pos2[b:b+batchsize], nbase2[b:b+batchsize])
+            values.append(attribution_objective(model.forward(mutants), tracks = tracks, target = target, loss = loss).cpu().numpy())
+    return np.concatenate(values)
+
+
+# Pairwise ISM between positions of different segments for all seqs (N, 4, L)
+# segments is a list with the (start, end) of the segments for every sequence
+# budget: maximum number of model evaluations per sequence, including the sequence itself and its 3 single mutants per
+# position in segments, which are always evaluated; the double mutants fill the rest and are sampled uniformly if they exceed it
+# Returns for every sequence the mean epistasis between segments (n_segments, n_segments),
+# and the epistasis between positions as array with pos_i, base_i, pos_j, base_j, epistasis
+def pairwise_ism(model, seqs, segments, budget = 10000, tracks = None, target = None, loss = None, max_memory = 1024, seed = None):
+    rng = np.random.RandomState(seed)
+    seqs = torch.Tensor(np.array(seqs))
+    npseqs = seqs.numpy()
+    l = seqs.size(-1)
+    mutations = [[] for i in range(5)]
+    nsingle, ndouble = [], []
+    for s in range(len(seqs)):
+        positions, segid = segment_positions(segments[s])
+        obase = np.argmax(npseqs[s], axis = 0)
+        # all single mutants at positions of segments, and the sequence itself
+        spos = np.repeat(positions, 3)
+        sbase = (np.repeat(obase[positions], 3) + np.tile(np.arange(1,4), len(positions))) % 4
+        # all pairs of positions in different segments
+        pi, pj = np.triu_indices(len(positions), k = 1)
+        pi, pj = pi[segid[pi] != segid[pj]], pj[segid[pi] != segid[pj]]
+        n_pairs = len(pi)*9
+        if budget < 1 + len(spos):
+            raise ValueError('budget '+str(budget)+' is smaller than the '+str(1 + len(spos))+' evaluations of sequence '+str(s)+' and its single mutants')
+        n_sample = min(n_pairs, budget - len(spos) - 1)
+        pairs = np.sort(rng.choice(n_pairs, n_sample, replace = False)) if n_sample < n_pairs else np.arange(n_pairs)
+        # pair index to single mutant index for each of the two positions
+        mi, mj = pi[pairs//9]*3 + (pairs%9)//3, pj[pairs//9]*3 + (pairs%9)%3
+        nsingle.append(len(spos))
+        ndouble.append([mi, mj])
+        for m, values in enumerate([np.ones(1 + len(spos) + len(mi), dtype = int)*s, np.concatenate([[-1], spos, spos[mi]]), np.concatenate([[0], sbase, sbase[mi]]), np.concatenate([-np.ones(1+len(spos), dtype = int), spos[mj]]), np.concatenate([np.zeros(1+len(spos), dtype = int), sbase[mj]])]):
+            mutations[m].append(values)
+    mutations = [np.concatenate(m) for m in mutations]
+    batchsize = ism_batchsize(model, seqs[:1], max_memory = max_memory)
+    if target is not None:
+        target = torch.Tensor(np.array(target)).reshape(1, -1)
+    values = evaluate_mutants(model, seqs, mutations, batchsize, tracks = tracks, target = target, loss = loss)
+
+    seg_interactions, pos_interactions = [], []
+    start = 0
+    for s in range(len(seqs)):
+        positions, segid = segment_positions(segments[s])
+        spos = np.repeat(positions, 3)
+        sbase = (np.repeat(np.argmax(npseqs[s], axis = 0)[positions], 3) + np.tile(np.arange(1,4), len(positions))) % 4
+        mi, mj = ndouble[s]
+        fref = values[start]
+        fsingle = values[start+1:start+1+nsingle[s]]
+        fdouble = values[start+1+nsingle[s]:start+1+nsingle[s]+len(mi)]
+        start += 1 + nsingle[s] + len(mi)
+        epistasis = fdouble - fsingle[mi] - fsingle[mj] + fref
+        nseg = len(segments[s])
+        seg_inter, seg_count = np.zeros((nseg, nseg)), np.zeros((nseg, nseg))
+        np.add.at(seg_inter, (segid[mi//3], segid[mj//3]), epistasis)
+        np.add.at(seg_count, (segid[mi//3], segid[mj//3]), 1)
+        seg_inter, seg_count = seg_inter + seg_inter.T, seg_count + seg_count.T
+        seg_inter[seg_count > 0] /= seg_count[seg_count > 0]
+        seg_interactions.append(seg_inter)
+        pos_interactions.append(np.array([spos[mi], sbase[mi], spos[mj], sbase[mj], epistasis]).T)
+    return seg_interactions, pos_interactions
+
+
+# Integrated hessians between positions of different segments for all seqs (N, 4, L) to baseline (zeros if None)
+# Integral is approximated with steps x steps points for alpha and beta
+# One row of the hessian for every position in the segments, if rows x steps**2 exceeds budget, steps is reduced
+# and positions are sampled if a single step exceeds it
+# Returns for every sequence the sum of interactions between segments (n_segments, n_segments), and interactions between positions (n_positions, n_positions)
+def integrated_hessians(model, seqs, segments, baseline = None, steps = 8, budget = 10000, tracks = None, target = None, loss = None, max_memory = 1024, seed = None):
+    rng = np.random.RandomState(seed)
+    seqs = torch.Tensor(np.array(seqs))
+    if baseline is None:
+        baseline = torch.zeros_like(seqs[0])
+    baseline = torch.Tensor(np.array(baseline))
+    if target is not None:
+        target = torch.Tensor(np.array(target)).reshape(1, -1)
+    # backward of backward pass needs more memory
+    batchsize = max(1, int(max_memory * 2**20/(5*memory_per_sequence(model, seqs[:1]))))
+    seg_interactions, pos_interactions = [], []
+    for s in range(len(seqs)):
+        positions, segid = segment_positions(segments[s])
+        nsteps = steps
+        while len(positions)*nsteps**2 > budget and nsteps > 1:
+            nsteps -= 1
+        rows = np.arange(len(positions))
+        if len(positions)*nsteps**2 > budget:
+            rows = np.sort(rng.choice(len(positions), max(1, budget), replace = False))
+        alphas = (torch.arange(nsteps, dtype = torch.float) + 0.5)/nsteps
+        # alpha * beta for all points of the grid and their weight alpha*beta/steps**2
+        ab = (alphas[:, None] * alphas[None, :]).flatten()
+        diff = seqs[s] - baseline
+        hessian = np.zeros((len(rows), len(positions)))
+        # all combinations of row and grid point
+        combis = [(r, k) for r in range(len(rows)) for k in range(len(ab))]
+        for b in range(0, len(combis), batchsize):
+            bc = np.array(combis[b:b+batchsize])
+            points = baseline[None] + ab[bc[:,1]][:, None, None] * diff[None]
+            points.requires_grad = True
+            objective = attribution_objective(model.forward(points), tracks = tracks, target = target, loss = loss)
+            grad = torch.autograd.grad(torch.sum(objective), points, create_graph = True)[0]
+            # directional derivative along x_i - x'_i at the position of the row
+            rowpos = torch.as_tensor(positions[rows[bc[:,0]]], dtype = torch.long)
+            direction = torch.sum(grad[torch.arange(len(bc)), :, rowpos] * diff[:, rowpos].T, dim = 1)
+            grad2 = torch.autograd.grad(torch.sum(direction), points)[0]
+            inter = (torch.sum(grad2[..., positions] * diff[None, :, positions], dim = 1) * (ab[bc[:,1]]/len(ab))[:, None]).detach()
+            # first order term on the diagonal, so that the sum of all entries is f(x) - f(x') if all positions are included
+            inter[torch.arange(len(bc)), torch.as_tensor(rows[bc[:,0]], dtype = torch.long)] += direction.detach()/len(ab)
+            np.add.at(hessian, bc[:,0], inter.numpy())
+        pos_inter = np.zeros((len(positions), len(positions)))
+        pos_inter[rows] = hessian
+        nseg = len(segments[s])
+        seg_inter = np.zeros((nseg, nseg))
+        np.add.at(seg_inter, (segid[:, None].repeat(len(positions), axis = 1), segid[None, :].repeat(len(positions), axis = 0)), pos_inter)
+        seg_inter[np.arange(nseg), np.arange(nseg)] = 0
+        seg_interactions.append(seg_inter)
+        pos_interactions.append(pos_inter)
+    return seg_interactions, pos_interactions
+
+
+# Numeric tables of the results of pairwise_ism (pairwise) or integrated_hessians for seqs with ids seqids, the first column is the id
+# segments: id, segment, start, end; seg_interactions: id, segment_i, segment_j, interaction
+# pos_interactions: id, pos_i, base_i, pos_j, base_j, epistasis for pairwise_ism, id, pos_i, pos_j, interaction for integrated_hessians
+def interaction_tables(seqids, segments, seg_interactions, pos_interactions, pairwise = True):
+    segtable, segtinter, postinter = [np.zeros((0, 4))], [np.zeros((0, 4))], [np.zeros((0, 6 if pairwise else 4))]
+    for sid, segs, seg_inter, pos_inter in zip(seqids, segments, seg_interactions, pos_interactions):
+        segtable.append(np.array([[sid, g, start, end] for g, (start, end) in enumerate(segs)]).reshape(-1, 4))
+        si, sj = np.indices(np.shape(seg_inter))
+        segtinter.append(np.array([np.ones(si.size)*sid, si.flatten(), sj.flatten(), np.array(seg_inter).flatten()]).T)
+        if pairwise:
+            postinter.append(np.append(np.ones((len(pos_inter), 1))*sid, np.reshape(pos_inter, (-1, 5)), axis = 1))
+        else:
+            positions = segment_positions(segs)[0]
+            pi, pj = np.indices(np.shape(pos_inter))
+            postinter.append(np.array([np.ones(pi.size)*sid, positions[pi.flatten()], positions[pj.flatten()], np.array(pos_inter).flatten()]).T)
+    return {'segments': np.concatenate(segtable).astype(int), 'seg_interactions': np.concatenate(segtinter), 'pos_interactions': np.concatenate(postinter)}
@@ -1,4 +1,5 @@
 from functions import dist_measures
+from motif_export import pfm2iupac, write_meme_file
 import numpy as np
 import sys, os
 from scipy.spatial.distance import cdist
@@ -54,13 +55,15 @@ def compute_importance(model, in_test, out_test, activation_measure = 'euclidean
 
 def kernel_to_ppm(kernels, kernel_bias = None, bk_freq = None):
     n_kernel, n_input, l_kernel = np.shape(kernels)
+    # kernels can share memory with the model parameters, they are copied instead of changed in place
+    kernels = np.array(kernels, dtype = float)
     if kernel_bias is not None:
-        kernels += kernel_bias[:,None,None]
+        kernels = kernels + kernel_bias[:,None,None]
     if bk_freq is None:
         bk_freq = np.ones(n_input)*np.log2(1./float(n_input))
     elif isinstance(bk_freq, float) or isinstance(bk_freq, int):
         bk_freq = np.ones(n_input)*np.log2(1./float(bk_freq))
-    kernels -= bk_freq[None,:,None]
+    kernels = kernels - bk_freq[None,:,None]
     ppms = 2.**kernels
     ppms = ppms/np.sum(ppms, axis = 1)[:,None, :]
     return ppms
@@ -77,62 +80,3 @@ def parameter_importance(ypred, y, coef_, inputs):
     return z_scores
 
 
-def pfm2iupac(pwms, bk_freq = None):
-    hash = {'A':16, 'C':8, 'G':4, 'T':2}
-    dictionary = {'A':16, 'C':8, 'G':4, 'T':2, 'R':20, 'Y':10, 'S':12, 'W':18, 'K':6, 'M':24, 'B':14, 'D':22, 'H':26, 'V':28, 'N':0}
-    res = dict((v,k) for k,v in dictionary.items())
-    n_nts = len(pwms[0])
-    if bk_freq is None:
-        bk_freq = (1./float(n_nts))*np.ones(n_nts)
-    else:
-        bk_freq = bk_freq*np.ones(n_nts)
-    motifs = []
-    for pwm in pwms:
-        m = ''
-        for p in pwm.T:
-            score = 0
-            for i in range(len(p)):
-                if p[i] > bk_freq[i]:
-                    score += list(hash.values())[i]
-            m += res[score]
-        motifs.append(m)
-    return np.array(motifs)
-        
-def write_meme_file(pwm, pwmname, alphabet, output_file_path):
-    """[summary]
-    write the pwm to a meme file
-    Args:
-        pwm ([np.array]): n_filters * 4 * motif_length
-        output_file_path ([type]): [description]
-    """
-    n_filters = len(pwm)
-    print(n_filters)
-    meme_file = open(output_file_path, "w")
-    meme_file.write("MEME version 4 \n")
-    meme_file.write("ALPHABET= "+alphabet+" \n")
-    meme_file.write("strands: + -\n")
-
-    print("Saved PWM File as : {}".format(output_file_path))
-
-    for i in range(0, n_filters):
-        if np.sum(pwm[i]) > 0:
-            meme_file.write("\n")
-            meme_file.write("MOTIF %s \n" % pwmname[i])
-            meme_file.write(
-                "letter-probability matrix: alength= "+str(len(alphabet))+" w= %d \n"
-                % np.count_nonzero(np.sum(pwm[i], axis=0))
-            )
-        
-        for j in range(0, np.shape(pwm[i])[-1]):
-            if np.sum(pwm[i][:, j]) > 0:
-                for a in range(len(alphabet)):
-                    if a < len(alphabet)-1:
-                        meme_file.write(str(pwm[i][ a, j])+ "\t")
-                    else:
-                        meme_file.write(str(pwm[i][ a, j])+ "\n")
-
-    meme_file.close()
-
-
-
-
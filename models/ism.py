@@ -0,0 +1,169 @@
+# ism.py
+# Batched in silico mutagenesis (ISM)
+# All 3*L single base mutants of a one-hot encoded sequence are generated with index arithmetic
+# and run through the model in chunks that fit into a given memory budget.
+# For models of class cnn, the first convolution is not recomputed for every mutant. Instead the output of the
+# reference sequence is reused and only the window of l_kernels positions that covers the mutated base is updated.
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# Returns base and position of every entry that can be mutated in seq (4, L), and the base that is currently at that position
+# Same order as np.where(seq == 0)
+def ism_positions(seq):
+    if isinstance(seq, torch.Tensor):
+        seq = seq.detach().cpu().numpy()
+    nbase, pos = np.where(seq == 0)
+    obase = np.argmax(seq, axis = 0)[pos]
+    return pos, obase, nbase
+
+
+# Same as ism_positions for a set of sequences (N, 4, L), also returns the index of the sequence for every mutant
+def ism_batch_positions(seqs):
+    if isinstance(seqs, torch.Tensor):
+        seqs = seqs.detach().cpu().numpy()
+    sid, nbase, pos = np.where(seqs == 0)
+    obase = np.argmax(seqs, axis = 1)[sid, pos]
+    return sid, pos, obase, nbase
+
+
+# Generate one-hot encoded mutants of seq (4, L) with nbase at pos, all at once with advanced indexing
+def ism_mutants(seq, pos, nbase):
+    return ism_batch_mutants(seq.unsqueeze(0), np.zeros(len(pos), dtype = int), pos, nbase)
+
+
+# Generate mutants of the sequences sid in seqs (N, 4, L) with nbase at pos
+def ism_batch_mutants(seqs, sid, pos, nbase):
+    sid, pos, nbase = [torch.as_tensor(p, dtype = torch.long, device = seqs.device) for p in [sid, pos, nbase]]
+    mutants = seqs[sid]
+    ind = torch.arange(len(pos), device = seqs.device)
+    mutants[ind, :, pos] = 0
+    mutants[ind, nbase, pos] = 1
+    return mutants
+
+
+# Upper bound of the memory in bytes that a single sequence x (1, 4, L) needs during a forward pass
+# Sums the output of all modules since intermediate outputs may not be released before the end of the forward pass
+# Models that run other models, f.e. model_ensemble, give their own estimate
+def memory_per_sequence(model, x):
+    if hasattr(model, 'memory_per_sequence'):
+        return model.memory_per_sequence(x)
+    sizes = [x.numel()*x.element_size()]
+    def hook(module, inp, out):
+        if isinstance(out, torch.Tensor):
+            sizes.append(out.numel()*out.element_size())
+    handles = [module.register_forward_hook(hook) for module in model.modules() if len(list(module.children())) == 0]
+    with torch.no_grad():
+        model.forward(x)
+    for handle in handles:
+        handle.remove()
+    return np.sum(sizes)
+
+
+# Number of sequences that are run through the model at once to stay below max_memory (in MB)
+def ism_batchsize(model, x, max_memory = 1024):
+    return max(1, int(max_memory * 2**20/memory_per_sequence(model, x)))
+
+
+# Checks if the output of the first convolution can be updated in place of running the entire model
+def can_update_convolution(model):
+    if not hasattr(model, 'forward_from') or not hasattr(model, 'convolutions'):
+        return False
+    if model.num_kernels == 0 or model.fixed_kernels is not None or not isinstance(model.convolutions, nn.Conv1d):
+        return False
+    return model.convolutions.stride[0] == 1 and model.convolutions.dilation[0] == 1 and model.convolutions.padding_mode == 'zeros'
+
+
+# Output of the first convolution for mutants from the output of the reference ref_conv
+# ref_conv is either (num_kernels, L_out) for mutants of a single sequence, or (n_mutants, num_kernels, L_out)
+# Change of base obase to nbase at pos only affects the outputs pos + padding - l_kernels + 1 to pos + padding
+def update_convolution(conv, ref_conv, pos, obase, nbase):
+    pos, obase, nbase = [torch.as_tensor(p, dtype = torch.long, device = ref_conv.device) for p in [pos, obase, nbase]]
+    weight = conv.weight.detach()
+    l_kernel, padding, l_out = weight.size(-1), conv.padding[0], ref_conv.size(-1)
+    # difference of kernel weights for new and old base, reversed so that entry k is added to output pos + padding - l_kernel + 1 + k
+    wdiff = torch.flip(torch.transpose(weight[:, nbase] - weight[:, obase], 0, 1), dims = [-1])
+    # pad output with l_kernel on both sides so that the window never reaches outside
+    out = F.pad(ref_conv, (l_kernel, l_kernel))
+    if out.dim() == 2:
+        out = out.unsqueeze(0).repeat(len(pos), 1, 1)
+    index = (pos + padding + 1)[:, None] + torch.arange(l_kernel, device = ref_conv.device)[None, :]
+    out.scatter_add_(2, index.unsqueeze(1).expand(-1, weight.size(0), -1), wdiff)
+    return out[..., l_kernel:l_kernel + l_out]
+
+
+# Predictions for all single base mutants of seq (4, L), and the prediction of seq itself
+# Returns predictions of mutants, prediction of seq, and pos, obase, nbase of the mutants
+def ism_predict(model, seq, max_memory = 1024, batchsize = None, incremental = True):
+    seq = torch.as_tensor(seq, dtype = torch.float)
+    if seq.dim() == 2:
+        seq = seq.unsqueeze(0)
+    preds, ref_preds, sid, pos, obase, nbase = ism_batch_predict(model, seq[:1], max_memory = max_memory, batchsize = batchsize, incremental = incremental)
+    return preds, ref_preds[0], pos, obase, nbase
+
+
+# Predictions for all single base mutants of a set of sequences seqs (N, 4, L), mutants of different sequences share batches
+# Returns predictions of mutants, predictions of seqs, and sid, pos, obase, nbase of the mutants
+def ism_batch_predict(model, seqs, max_memory = 1024, batchsize = None, incremental = True):
+    seqs = torch.as_tensor(seqs, dtype = torch.float).detach()
+    sid, pos, obase, nbase = ism_batch_positions(seqs)
+    incremental = incremental and can_update_convolution(model)
+    with torch.no_grad():
+        if batchsize is None:
+            batchsize = ism_batchsize(model, seqs[:1], max_memory = max_memory)
+        if incremental:
+            ref_conv = torch.cat([model.convolutions(seqs[b:b+batchsize]) for b in range(0, len(seqs), batchsize)], dim = 0)
+            ref_preds = torch.cat([model.forward_from(ref_conv[b:b+batchsize]) for b in range(0, len(seqs), batchsize)], dim = 0)
+        else:
+            ref_preds = torch.cat([model.forward(seqs[b:b+batchsize]) for b in range(0, len(seqs), batchsize)], dim = 0)
+        preds = []
+        for b in range(0, len(pos), batchsize):
+            if incremental:
+                cconv = update_convolution(model.convolutions, ref_conv[sid[b:b+batchsize]], pos[b:b+batchsize], obase[b:b+batchsize], nbase[b:b+batchsize])
+                preds.append(model.forward_from(cconv))
+            else:
+                preds.append(model.forward(ism_batch_mutants(seqs, sid[b:b+batchsize], pos[b:b+batchsize], nbase[b:b+batchsize])))
+        preds = torch.cat(preds, dim = 0)
+    return preds, ref_preds, sid, pos, obase, nbase
+
+
+# Mean loss per sequence with reduction none
+def sequence_loss(loss, pred, target):
+    reduction = loss.reduction
+    loss.reduction = 'none'
+    if target.size(0) == 1:
+        target = target.expand(len(pred), -1)
+    sloss = loss(pred, target)
+    loss.reduction = reduction
+    if sloss.dim() > 1:
+        sloss = torch.mean(sloss, axis = 1)
+    return sloss
+
+
+# Change in loss for every single base mutant of seq (4, L) to target
+# Returns ismloss (4, L) with mutant loss - loss of seq, zero at bases in seq, and the loss and prediction of seq
+def ism_loss(model, seq, target, loss, max_memory = 1024, batchsize = None, incremental = True):
+    seq = torch.as_tensor(seq, dtype = torch.float)
+    if seq.dim() == 2:
+        seq = seq.unsqueeze(0)
+    ismloss, refloss, ref_preds = ism_batch_loss(model, seq[:1], target, loss, max_memory = max_memory, batchsize = batchsize, incremental = incremental)
+    return ismloss[0], refloss[0], ref_preds[0]
+
+
+# Change in loss for every single base mutant of all seqs (N, 4, L) to targets, either one target for all (n_classes) or (N, n_classes)
+# Returns ismloss (N, 4, L), the losses (N) and predictions of seqs
+def ism_batch_loss(model, seqs, targets, loss, max_memory = 1024, batchsize = None, incremental = True):
+    targets = torch.as_tensor(targets, dtype = torch.float)
+    targets = targets.reshape(-1, targets.size(-1))
+    preds, ref_preds, sid, pos, obase, nbase = ism_batch_predict(model, seqs, max_memory = max_memory, batchsize = batchsize, incremental = incremental)
+    with torch.no_grad():
+        if targets.size(0) > 1:
+            mloss = sequence_loss(loss, preds, targets[sid]).cpu().numpy()
+        else:
+            mloss = sequence_loss(loss, preds, targets).cpu().numpy()
+        refloss = sequence_loss(loss, ref_preds, targets).cpu().numpy()
+    ismloss = np.zeros(tuple(np.shape(seqs)))
+    ismloss[sid, nbase, pos] = mloss - refloss[sid]
+    return ismloss, refloss, ref_preds
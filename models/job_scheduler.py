@@ -0,0 +1,192 @@
+# job_scheduler.py
+# Local scheduler to train many cnn configurations at once in a pool of worker processes
+# The data is written once as .npy files into shared memory (/dev/shm if available) and every worker opens it memory-mapped,
+# so that workers share the same pages instead of receiving copies of X and Y with every job.
+# Every worker limits torch to n_threads, so that n_workers * n_threads matches the cores of the node.
+# Jobs are dictionaries with the model parameters and the indices of the sets; results are collected in the
+# main process through a queue, which writes the ctrl file and the performance files.
+import numpy as np
+import sys, os
+import time
+import queue
+import shutil
+import tempfile
+import multiprocessing as mp
+
+# Data of the worker process, opened once by init_worker
+shared_data = {}
+# Thread pools of the numerical libraries, read once when numpy or torch are imported
+thread_variables = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+# Writes arrays to .npy files in a new directory in shared memory and returns their paths
+def share_arrays(tmpdir = None, **arrays):
+    if tmpdir is None and os.path.isdir('/dev/shm'):
+        tmpdir = '/dev/shm'
+    datadir = tempfile.mkdtemp(prefix = 'drgjobs', dir = tmpdir)
+    datafiles = {}
+    for key, value in arrays.items():
+        if value is None:
+            datafiles[key] = None
+            continue
+        datafiles[key] = os.path.join(datadir, key+'.npy')
+        np.save(datafiles[key], np.asarray(value))
+    return datafiles, datadir
+
+
+# Opens the shared arrays memory-mapped and limits the threads of torch in the worker,
+# the threads of numpy are limited by the environment that job_pool starts the workers with
+def init_worker(datafiles, n_threads = None):
+    if n_threads is not None:
+        import torch
+        torch.set_num_threads(n_threads)
+    shared_data.clear()
+    for key, value in datafiles.items():
+        if isinstance(value, str):
+            shared_data[key] = np.load(value, mmap_mode = 'r')
+        else:
+            shared_data[key] = value
+
+
+# Removes files that a failed model leaves behind
+def remove_model_files(modelname):
+    if modelname is None:
+        return
+    for ending in ['_model_params.dat', '_parameter.pth', '_params0.pth']:
+        if os.path.isfile(modelname+ending):
+            os.remove(modelname+ending)
+
+
+# Trains cnn_model.cnn(**job['params']) on the shared data and predicts the test set
+# job: id, params, trainset, valset, testset, optional fit_kwargs for model.fit, f.e. epoch_budget, memory_limit in MB (2**20 bytes),
+# and init_parameters, a file with parameters that the model is initialized with
+# If the shared data contains pwm_out, the pwm scans of all sequences, they are used instead of scanning in every job
+# Returns dictionary with id, success, err, outname, hyperparameters as strings, saveloss, loss names, predictions of the test set,
+# and if the model was paused by epoch_budget, the number of trained epochs and the validation loss of the last epoch
+def train_job(job):
+    import cnn_model
+    from init import load_parameters
+    from results_store import model_params
+    X, Y, weights = shared_data['X'], shared_data['Y'], shared_data.get('weights')
+    result = {'id': job['id'], 'success': False, 'err': None, 'outname': None, 'saveloss': None, 'Y_pred': None, 'time': time.time()}
+    try:
+        model = cnn_model.cnn(**job['params'])
+        result['outname'], result['params'] = model.outname, model_params(model)
+        result['validation_loss'], result['loss_function'] = str(model.validation_loss), str(model.loss_function)
+    except Exception as err:
+        print(err, type(err))
+        result['err'] = str(err)
+        remove_model_files(result['outname'])
+        return result
+    # configurations whose estimated peak memory (MB) is above the memory_limit of the job are not trained
+    if job.get('memory_limit') is not None:
+        from cost_model import model_costs
+        peak = model_costs(model, n_data = len(job['trainset']))['peak']/2**20
+        if peak > job['memory_limit']:
+            result['err'] = 'Estimated memory '+str(round(peak, 1))+' MB exceeds limit of '+str(round(job['memory_limit'], 1))+' MB'
+            print(result['err'])
+            remove_model_files(result['outname'])
+            return result
+    print('Started', model.outname)
+    trainset, valset, testset = job['trainset'], job['valset'], job['testset']
+    try:
+        # weights of another model, f.e. from population-based training, tensors with different sizes are sliced
+        if job.get('init_parameters') is not None:
+            load_parameters(model, job['init_parameters'], allow_reduction = True)
+        sample_weights = None if weights is None else np.array(weights[trainset])
+        fit_kwargs = dict(job.get('fit_kwargs', {}))
+        # pwm scans of all sequences that were computed once in the main process
+        pwm_out = shared_data.get('pwm_out')
+        if pwm_out is not None:
+            fit_kwargs['pwm_out'], fit_kwargs['pwm_outval'] = np.array(pwm_out[trainset]), np.array(pwm_out[valset])
+        model.fit(np.array(X[trainset]), np.array(Y[trainset]), XYval = [np.array(X[valset]), np.array(Y[valset])], sample_weights = sample_weights, **fit_kwargs)
+        result['saveloss'] = np.array(model.saveloss)
+        if testset is not None:
+            result['Y_pred'] = model.predict(np.array(X[testset]), pwm_out = None if pwm_out is None else np.array(pwm_out[testset]))
+    except Exception as err:
+        print(err, type(err))
+        result['err'] = str(err)
+        remove_model_files(result['outname'])
+        return result
+    result['success'] = True
+    result['paused'], result['epochs'] = getattr(model, 'paused', False), getattr(model, 'epochs_trained', None)
+    result['last_loss'] = getattr(model, 'last_loss', None)
+    result['time'] = time.time() - result['time']
+    return result
+
+
+# Number of workers with n_threads each that fit onto n_cores and into memory (MB) if every worker needs up to peak MB
+def pack_workers(peak, memory, n_cores = None, n_threads = 1):
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    n_workers = max(1, int(n_cores/max(1, n_threads)))
+    if peak > 0:
+        n_workers = min(n_workers, int(memory/peak))
+    return max(1, n_workers)
+
+
+# Pool of worker processes with shared data, jobs are submitted with submit and results returned by get in the order they finish
+# n_workers = 0 runs every job in the main process when it is submitted
+class job_pool():
+    def __init__(self, n_workers = None, n_threads = None, tmpdir = None, **arrays):
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        if n_threads is None:
+            n_threads = max(1, int(os.cpu_count()/max(1, n_workers)))
+        self.n_workers, self.n_threads = n_workers, n_threads
+        self.results = queue.Queue()
+        self.pending = 0
+        if n_workers > 0:
+            self.datafiles, self.datadir = share_arrays(tmpdir = tmpdir, **arrays)
+            # spawned workers import numpy and torch with the main module before init_worker runs, so the thread
+            # variables are set in the environment that they inherit and restored for the main process afterwards
+            environ = {var: os.environ.get(var) for var in thread_variables}
+            os.environ.update({var: str(n_threads) for var in thread_variables})
+            try:
+                self.pool = mp.get_context('spawn').Pool(n_workers, initializer = init_worker, initargs = (self.datafiles, n_threads))
+            finally:
+                for var, value in environ.items():
+                    if value is None:
+                        os.environ.pop(var, None)
+                    else:
+                        os.environ[var] = value
+        else:
+            self.datafiles, self.datadir, self.pool = None, None, None
+            init_worker(arrays)
+
+    # Submits func(job) to the pool, func has to be importable by the workers
+    def submit(self, job, func = train_job):
+        self.pending += 1
+        if self.pool is None:
+            self.results.put(func(job))
+        else:
+            self.pool.apply_async(func, (job,), callback = self.results.put, error_callback = lambda err: self.results.put({'id': job['id'], 'success': False, 'err': str(err)}))
+
+    # Next finished result, blocks until one is available
+    def get(self):
+        result = self.results.get()
+        self.pending -= 1
+        return result
+
+    # Generator over results of all submitted jobs
+    def collect(self):
+        while self.pending > 0:
+            yield self.get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.datadir is not None:
+            shutil.rmtree(self.datadir, ignore_errors = True)
+
+
+# Writes the result of a job into the ctrl file in the format of hyperparameter_search.py, the lines of the job come first
+def write_ctrl(ctrlfile, lines, result):
+    for line in lines:
+        ctrlfile.write(line+'\n')
+    if result['success']:
+        ctrlfile.write('Results:'+'\n'+result['validation_loss']+'(val) '+result['validation_loss']+'(train) '+result['loss_function']+'(val) '+result['loss_function']+ '(train) Epochs\n'+' '.join(np.around(result['saveloss'],3).astype(str))+'\n\n')
+    else:
+        ctrlfile.write(str(result['err'])+'\n\n')
+    ctrlfile.flush()
@@ -9,7 +9,8 @@ from scipy.spatial.distance import cdist
 from joblib import Parallel, delayed
 from functools import reduce
 from functions import mse, correlation
-from data_processing import create_outname, check, numbertype, manipulate_input, readin, create_sets
+from data_processing import create_outname, check, numbertype, manipulate_input, readin, create_sets, read_pwm
+from motif_scanning import pfm_logodds, scan_sequences, hit_features
 from output import save_performance, print_averages, plot_scatter
 from torch_regression import torch_Regression
 
@@ -642,6 +643,16 @@ if __name__ == '__main__':
         outname = sys.argv[sys.argv.index('--outdir')+1] + os.path.split(outname)[1]
 
     
+    # one-hot encoded sequences are scanned with log-odds pwms and the hits of every pwm with p-value below pvalue are used as features
+    # f.e. --pwm_hits pwms.txt 1e-4 count, measure is count, max or sum of scores of the hits
+    if '--pwm_hits' in sys.argv:
+        pfms, rbpnames = read_pwm(sys.argv[sys.argv.index('--pwm_hits')+1])
+        hitpval = float(sys.argv[sys.argv.index('--pwm_hits')+2])
+        hitmeasure = sys.argv[sys.argv.index('--pwm_hits')+3]
+        hits = scan_sequences(X, pfm_logodds(pfms), pvalue = hitpval)
+        X, features = hit_features(hits, len(X), len(pfms), measure = hitmeasure), np.array(rbpnames)
+        outname += '_pwmhits'+str(hitpval)+hitmeasure
+    
     X, features = manipulate_input(X, features, sys.argv)
     
     # use a random number of samples from the entire data set to test model
@@ -0,0 +1,166 @@
+# model_ensemble.py
+# Runs a set of trained cnn models, f.e. from different folds or initializations, together as one model.
+# Members are loaded from their _model_params.dat and _parameter.pth files. Members with identical architecture
+# are grouped and every group runs in one vectorized forward pass (vmap_ensemble from seed_ensemble.py), every
+# batch of inputs is created once and given to all groups.
+# forward returns the mean over all members, so that the ensemble can replace a single model in the design, ism
+# and attribution code, and predict returns the mean, the variance and the predictions of every member.
+# Usage:
+# python model_ensemble.py model1_model_params.dat,model2_model_params.dat sequences.fasta --outname ens --save_members
+# or a text file with one _model_params.dat per line instead of the comma separated list
+import numpy as np
+import sys, os
+import torch
+import torch.nn as nn
+from data_processing import readinfasta, quick_onehot, check
+from cnn_model import cnn
+from train import load_model
+from results_store import model_params
+from seed_ensemble import vmap_ensemble
+from ism import memory_per_sequence
+
+# Parameters of cnn that do not change the forward pass of a trained model and are ignored when members are grouped
+training_params = ['seed', 'outname', 'lr', 'kernel_lr', 'adjust_lr', 'epochs', 'patience', 'batchsize', 'optimizer', 'optim_params', 'verbose', 'checkval', 'init_epochs', 'writeloss', 'write_steps', 'device', 'load_previous', 'init_adjust', 'keepmodel', 'generate_paramfile', 'add_outname', 'restart', 'loss_function', 'validation_loss', 'warm_start', 'hot_start', 'hot_alpha', 'l1_kernel', 'l2reg_last', 'l1reg_last', 'shift_sequence', 'random_shift', 'reverse_sign', 'smooth_onehot', 'param_file', 'paused', 'epochs_trained']
+
+
+# Loads the cnn of a _model_params.dat file with the weights of its _parameter.pth, without writing any files
+def load_member(paramfile, device = 'cpu', **kwargs):
+    parameterfile = paramfile.replace('model_params.dat', 'parameter.pth')
+    params = {}
+    for line in open(paramfile, 'r').readlines():
+        if line[0] != '_' and line[:7] != 'outname' and ':' in line:
+            p = line.strip().replace(' ', '').split(':',1)
+            params[p[0]] = check(p[1])
+    params.update(kwargs)
+    params['device'] = device
+    params['outname'], params['add_outname'], params['generate_paramfile'] = paramfile.replace('_model_params.dat', ''), False, False
+    model = cnn(**params)
+    load_model(model, parameterfile, device)
+    return model
+
+
+# Models that can run in the same vectorized forward pass have the same parameters and tensor shapes
+def architecture_key(model):
+    params = model_params(model)
+    shapes = [(name, tuple(tensor.size())) for name, tensor in model.state_dict().items()]
+    return str(sorted([(key, value) for key, value in params.items() if key not in training_params])) + str(shapes)
+
+
+class model_ensemble(nn.Module):
+    def __init__(self, models, names = None):
+        super(model_ensemble, self).__init__()
+        self.n_members = len(models)
+        self.names = names if names is not None else [getattr(model, 'outname', str(m)) for m, model in enumerate(models)]
+        keys = [architecture_key(model) for model in models]
+        ukeys = list(dict.fromkeys(keys))
+        # indices of the members in every group, groups with one member run the model itself
+        self.groups = [np.where(np.array(keys) == key)[0] for key in ukeys]
+        runners = []
+        for group in self.groups:
+            if len(group) == 1:
+                runners.append(models[group[0]])
+            else:
+                runners.append(vmap_ensemble([models[m] for m in group]))
+        self.runners = nn.ModuleList(runners)
+        # position of every member in the concatenated outputs of the groups
+        self.order = np.argsort(np.concatenate(self.groups))
+        for param in self.parameters():
+            param.requires_grad = False
+        self.eval()
+        # attributes of a single model that design and ism code use
+        model = models[0]
+        self.n_features, self.l_seqs, self.n_classes = model.n_features, model.l_seqs, model.n_classes
+        self.device, self.batchsize = model.device, model.batchsize
+        self.fixed_kernels, self.num_kernels = None, model.num_kernels
+        self.tracks = None
+        print('Ensemble of', self.n_members, 'models in', len(self.groups), 'groups')
+
+    # Restricts the outputs of all members to tracks, replaces the selection of classifier weights of a single model
+    def select_tracks(self, tracks):
+        self.tracks = torch.as_tensor(np.array(tracks), dtype = torch.long)
+        self.n_classes = len(tracks)
+
+    # Memory in bytes of the forward pass of all members for one sequence x (1, 4, L), used by ism.ism_batchsize
+    # Vectorized groups run the copy of their first member in base for every member of the group
+    def memory_per_sequence(self, x):
+        memory = 0
+        for group, runner in zip(self.groups, self.runners):
+            member = runner if len(group) == 1 else runner.base[0]
+            memory += len(group)*memory_per_sequence(member, x)
+        return memory
+
+    # Predictions of all members (n_members, N, n_classes) for one batch
+    def members_forward(self, x, xadd = None):
+        preds = []
+        for group, runner in zip(self.groups, self.runners):
+            if len(group) == 1:
+                preds.append(runner(x, xadd = xadd).unsqueeze(0))
+            else:
+                preds.append(runner(x, xadd = xadd))
+        preds = torch.cat(preds, dim = 0)[torch.as_tensor(self.order)]
+        if self.tracks is not None:
+            preds = preds[..., self.tracks.to(preds.device)]
+        return preds
+
+    # Mean over all members, so that the ensemble can be used instead of a single model
+    def forward(self, x, xadd = None, **kwargs):
+        return torch.mean(self.members_forward(x, xadd = xadd), dim = 0)
+
+    # Mean, variance and predictions of every member for X, every batch of X is sent to the device once
+    def predict(self, X, pwm_out = None, batchsize = None, device = None):
+        if device is None:
+            device = self.device
+        if batchsize is None:
+            batchsize = self.batchsize if self.batchsize is not None else 256
+        self.eval()
+        self.to(device)
+        members = None
+        with torch.no_grad():
+            for b in range(0, len(X), batchsize):
+                x = torch.Tensor(np.array(X[b:b+batchsize], dtype = float)).to(device)
+                xadd = None if pwm_out is None else torch.Tensor(np.array(pwm_out[b:b+batchsize])).to(device)
+                pred = self.members_forward(x, xadd = xadd).cpu().numpy()
+                if members is None:
+                    members = np.zeros((self.n_members, len(X)) + np.shape(pred)[2:], dtype = pred.dtype)
+                members[:, b:b+batchsize] = pred
+        return np.mean(members, axis = 0), np.var(members, axis = 0), members
+
+
+# Ensemble from a list of _model_params.dat files, a comma separated string of them or a text file with one per line
+def load_ensemble(paramfiles, device = 'cpu', **kwargs):
+    if isinstance(paramfiles, str):
+        if ',' in paramfiles:
+            paramfiles = paramfiles.split(',')
+        elif not paramfiles.endswith('model_params.dat'):
+            paramfiles = [line.strip() for line in open(paramfiles, 'r').readlines() if line.strip() != '' and line[0] != '#']
+        else:
+            paramfiles = [paramfiles]
+    models = [load_member(paramfile, device = device, **kwargs) for paramfile in paramfiles]
+    return model_ensemble(models, names = [paramfile.replace('_model_params.dat', '') for paramfile in paramfiles])
+
+
+if __name__ == '__main__':
+    predictors = sys.argv[1]
+    names, seqs = readinfasta(sys.argv[2])
+    seqs, nts = quick_onehot(seqs)
+    seqs = np.transpose(seqs, axes = (0,2,1))
+
+    device = 'cpu'
+    if '--gpu' in sys.argv:
+        device = sys.argv[sys.argv.index('--gpu')+1]
+    ensemble = load_ensemble(predictors, device = device, verbose = False)
+
+    outname = os.path.splitext(sys.argv[2])[0]+'_ensemble'+str(ensemble.n_members)
+    if '--outname' in sys.argv:
+        outname = sys.argv[sys.argv.index('--outname')+1]
+
+    batchsize = None
+    if '--batchsize' in sys.argv:
+        batchsize = int(sys.argv[sys.argv.index('--batchsize')+1])
+
+    mean, var, members = ensemble.predict(seqs, batchsize = batchsize, device = device)
+    np.savetxt(outname+'_pred.txt', np.append(names[:, None], mean.reshape(len(mean), -1), axis = 1), fmt = '%s')
+    np.savetxt(outname+'_var.txt', np.append(names[:, None], var.reshape(len(var), -1), axis = 1), fmt = '%s')
+    if '--save_members' in sys.argv:
+        np.savez_compressed(outname+'_members.npz', names = names, models = np.array(ensemble.names), members = members)
+    print(outname+'_pred.txt')
@@ -0,0 +1,219 @@
+# motif_clustering.py
+# Clustering of large sets of motifs (f.e. kernels of many CV folds and seeds) without a dense N x N similarity matrix
+# 1. knn_graph keeps the k most similar motifs within radius for every motif from the blocks of motif_similarity,
+#    or only from candidates of a motif_index for very large sets
+# 2. graph_clustering merges motifs along the edges of this graph: single linkage are the connected components of edges
+#    below the threshold, complete and average linkage are agglomerative with a heap that only contains edges of the graph.
+#    Pairs without an edge are treated as distance radius.
+# 3. consensus_ppms aligns all members of all clusters to the seed of their cluster at once, same as combine_pwms
+import numpy as np
+import sys, os
+import heapq
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+from motif_similarity import similarity_blocks, prepare_ppms, pair_similarity
+from motif_index import motif_index
+
+
+# Keeps the k entries with the smallest distance in every row of the concatenated candidates
+def merge_nearest(best, candidates, k):
+    values = [np.concatenate([b, c], axis = 1) for b, c in zip(best, candidates)]
+    keep = np.argpartition(values[0], min(k, values[0].shape[1])-1, axis = 1)[:, :k]
+    return [np.take_along_axis(v, keep, axis = 1) for v in values]
+
+
+# Sparse graph of the k nearest motifs with distance (1-correlation) below radius, computed in blocks from compare_ppms' measure
+# If n_candidates, exact similarities are only computed for the n_candidates motifs that motif_index finds for every motif,
+# otherwise for all pairs
+# Returns dictionary with rows, cols, distance, log_pvalues and offsets of all edges, edges are symmetric and offsets[j,i] = -offsets[i,j]
+def knn_graph(ppms, k = 30, radius = 0.5, min_sim = 5, padding = 0.25, infocont = False, bk_freq = 0.25, non_zero_elements = False, n_candidates = None, max_memory = 1024, verbose = False):
+    n = len(ppms)
+    k = max(1, min(k, n-1))
+    best = [np.ones((n, k))*np.inf, -np.ones((n, k), dtype = int), np.zeros((n, k)), np.zeros((n, k), dtype = int)]
+    if n_candidates is not None:
+        index = motif_index(ppms, width = min_sim, padding = 0. if padding is None else padding, min_sim = min_sim)
+        cand = index.candidates(ppms, n_candidates = n_candidates + 1)
+        tid, rid = np.repeat(np.arange(n), [len(c) for c in cand]), np.concatenate(cand)
+        tid, rid = tid[tid != rid], rid[tid != rid]
+        # pairs in both directions are only computed once, offsets of the reverse direction are negative
+        pairs = np.unique(np.minimum(tid, rid)*n + np.maximum(tid, rid))
+        tid, rid = pairs//n, pairs%n
+        if infocont and padding is not None:
+            padding = max(0, np.log2(padding/bk_freq))
+        prepared = prepare_ppms(ppms, padding = padding, infocont = infocont, bk_freq = bk_freq)
+        lmax = prepared['values'].shape[1]
+        chunk = max(1, int(max_memory * 2**20/(8*24*(2*lmax+1))))
+        corr, logp, offs = [np.concatenate(c) for c in zip(*[pair_similarity(prepared, prepared, tid[c:c+chunk], rid[c:c+chunk], min_sim = min_sim, padding = padding, non_zero_elements = non_zero_elements) for c in range(0, len(tid), chunk)])]
+        keep = corr < radius
+        tid, rid, corr, logp, offs = tid[keep], rid[keep], corr[keep], logp[keep], offs[keep]
+        rows, cols = np.concatenate([tid, rid]), np.concatenate([rid, tid])
+        corr, logp, offs = np.concatenate([corr, corr]), np.concatenate([logp, logp]), np.concatenate([offs, -offs])
+        # k nearest for every row
+        order = np.lexsort((corr, rows))
+        rows, cols, corr, logp, offs = rows[order], cols[order], corr[order], logp[order], offs[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < k
+        for bb, values in zip(best, [corr, cols, logp, offs]):
+            bb[rows[keep], rank[keep]] = values[keep]
+    else:
+        for a, b, c, d, corr, logp, offs in similarity_blocks(ppms, ppms, one_half = True, min_sim = min_sim, padding = padding, infocont = infocont, bk_freq = bk_freq, non_zero_elements = non_zero_elements, max_memory = max_memory):
+            if verbose:
+                print(b, c)
+            rows, cols = np.arange(a, b)[:, None], np.arange(c, d)[None, :]
+            upper = cols > rows
+            dist = np.where(upper & (corr < radius), corr, np.inf)
+            cand = [dist, cols + np.zeros_like(rows), logp, offs]
+            for s, e, block in [[a, b, cand], [c, d, [dist.T, (rows + np.zeros_like(cols)).T, logp.T, -offs.T]]]:
+                best_block = merge_nearest([bb[s:e] for bb in best], block, k)
+                for bb, nb in zip(best, best_block):
+                    bb[s:e] = nb
+    valid = np.isfinite(best[0])
+    rows, cols = np.where(valid)[0], best[1][valid]
+    dist, logp, offs = best[0][valid], best[2][valid], best[3][valid]
+    # union of nearest neighbors in both directions
+    rows, cols, dist, logp, offs = np.concatenate([rows, cols]), np.concatenate([cols, rows]), np.concatenate([dist, dist]), np.concatenate([logp, logp]), np.concatenate([offs, -offs])
+    edges, unique = np.unique(rows*n + cols, return_index = True)
+    return {'n': n, 'rows': rows[unique], 'cols': cols[unique], 'distance': dist[unique], 'log_pvalues': logp[unique], 'offsets': offs[unique], 'radius': radius}
+
+
+def save_graph(outfile, graph):
+    np.savez_compressed(outfile, **graph)
+
+
+def load_graph(infile):
+    obj = np.load(infile)
+    graph = {key: obj[key] for key in obj.files}
+    graph['n'], graph['radius'] = int(graph['n']), float(graph['radius'])
+    return graph
+
+
+# Cluster labels from the edges of graph that are below distance_threshold
+# linkage: single, complete or average, same merging criterion as AgglomerativeClustering with distance_threshold
+def graph_clustering(graph, linkage = 'complete', distance_threshold = 0.3):
+    n = graph['n']
+    below = graph['distance'] < distance_threshold
+    if linkage == 'single':
+        adjacency = csr_matrix((np.ones(np.sum(below)), (graph['rows'][below], graph['cols'][below])), shape = (n, n))
+        return connected_components(adjacency, directed = False)[1]
+    if linkage not in ['complete', 'average']:
+        print(linkage, 'not a valid linkage for graph clustering')
+        sys.exit()
+    radius = graph['radius']
+    # for every cluster: neighbor -> [sum of known distances (max for complete), number of known pairs]
+    neighbors = [{} for i in range(n)]
+    for i, j, dist in zip(graph['rows'], graph['cols'], graph['distance']):
+        neighbors[i][j] = [dist, 1]
+    size = np.ones(n, dtype = int)
+    active = np.ones(n, dtype = bool)
+    merged_into = np.arange(n)
+
+    def link(i, j):
+        value, count = neighbors[i][j]
+        if linkage == 'complete':
+            return value if count == size[i]*size[j] else radius
+        return (value + radius*(size[i]*size[j] - count))/(size[i]*size[j])
+
+    heap = [(link(i, j), i, j) for i in range(n) for j in neighbors[i] if i < j]
+    heap = [h for h in heap if h[0] < distance_threshold]
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        dist, i, j = heapq.heappop(heap)
+        if not active[i] or not active[j] or j not in neighbors[i] or link(i, j) != dist:
+            continue
+        # merge j into i
+        active[j] = False
+        merged_into[j] = i
+        del neighbors[i][j]
+        del neighbors[j][i]
+        for x in set(neighbors[i]) | set(neighbors[j]):
+            vi, ci = neighbors[i].get(x, [0, 0])
+            vj, cj = neighbors[j].get(x, [0, 0])
+            if linkage == 'complete':
+                value = max(vi, vj)
+            else:
+                value = vi + vj
+            neighbors[i][x] = [value, ci + cj]
+            neighbors[x][i] = [value, ci + cj]
+            if j in neighbors[x]:
+                del neighbors[x][j]
+        neighbors[j] = {}
+        size[i] += size[j]
+        for x in neighbors[i]:
+            d = link(i, x)
+            if d < distance_threshold:
+                heapq.heappush(heap, (d, min(i, x), max(i, x)))
+    # follow merges to the cluster that is still active
+    labels = np.copy(merged_into)
+    while True:
+        update = merged_into[labels]
+        if np.array_equal(update, labels):
+            break
+        labels = update
+    return np.unique(labels, return_inverse = True)[1]
+
+
+# Consensus ppms of clusters, aligned to the member with the largest sum of similarity to the other members (as combine_pwms)
+# similarity and offsets are dense (N, N) arrays or the log_pvalues and offsets of a graph from knn_graph
+# Members without an edge to the seed are aligned through the shortest path of edges within the cluster
+# method: sum or mean of the overlapping rows, maxnorm divides by the largest row sum, otherwise every row is normalized
+# remove_low removes flanking rows with a sum below remove_low, normalize_single also normalizes clusters with a single member
+def consensus_ppms(pwms, clusters, similarity = None, offsets = None, graph = None, maxnorm = True, remove_low = 0.5, method = 'sum', normalize_single = True):
+    n = len(pwms)
+    lengths = np.array([len(pwm) for pwm in pwms])
+    unclusters, clusters = np.unique(clusters, return_inverse = True)
+    if graph is not None:
+        same = clusters[graph['rows']] == clusters[graph['cols']]
+        rows, cols = graph['rows'][same], graph['cols'][same]
+        simsum = np.bincount(rows, weights = graph['log_pvalues'][same], minlength = n)
+    else:
+        simsum = np.sum(similarity * (clusters[:, None] == clusters[None, :]), axis = 1)
+    # seed is the first member with the largest sum
+    order = np.lexsort((np.arange(n), -simsum, clusters))
+    seeds = order[np.r_[0, np.where(np.diff(clusters[order]) != 0)[0] + 1]]
+    # offset of every member to the seed of its cluster
+    if graph is not None:
+        off = np.zeros(n, dtype = int)
+        # bfs from virtual node n that is connected to all seeds
+        adjacency = csr_matrix((np.concatenate([np.ones(len(rows)), np.ones(len(seeds))]), (np.concatenate([rows, np.ones(len(seeds), dtype = int)*n]), np.concatenate([cols, seeds]))), shape = (n+1, n+1))
+        edge_offsets = csr_matrix((graph['offsets'][same].astype(float), (rows, cols)), shape = (n, n)).todok()
+        bfs, predecessors = breadth_first_order(adjacency, n, directed = True, return_predecessors = True)
+        for m in bfs[1:]:
+            if predecessors[m] != n:
+                off[m] = off[predecessors[m]] + int(edge_offsets[m, predecessors[m]])
+    else:
+        off = offsets[np.arange(n), seeds[clusters]]
+        off[seeds] = 0
+    # frame of every cluster
+    start = np.minimum(np.minimum.reduceat((off)[np.argsort(clusters, kind = 'stable')], np.r_[0, np.cumsum(np.bincount(clusters))[:-1]]), 0)
+    end = np.maximum.reduceat((off+lengths)[np.argsort(clusters, kind = 'stable')], np.r_[0, np.cumsum(np.bincount(clusters))[:-1]])
+    frame_start = np.r_[0, np.cumsum(end - start)[:-1]]
+    # all rows of all members are added at once, the seed first and then the other members as in combine_pwms
+    isseed = np.zeros(n, dtype = bool)
+    isseed[seeds] = True
+    members = np.lexsort((np.arange(n), ~isseed))
+    member = np.repeat(members, lengths[members])
+    row = np.arange(np.sum(lengths)) - np.repeat(np.r_[0, np.cumsum(lengths[members])[:-1]], lengths[members])
+    target = frame_start[clusters[member]] + off[member] - start[clusters[member]] + row
+    frames = np.zeros((np.sum(end - start), np.shape(pwms[0])[-1]))
+    counts = np.zeros(len(frames))
+    np.add.at(frames, target, np.concatenate([np.array(pwms[m], dtype = float) for m in members], axis = 0))
+    np.add.at(counts, target, 1)
+    if method == 'mean':
+        frames[counts > 0] /= counts[counts > 0][:, None]
+    comb_pwms = []
+    nmembers = np.bincount(clusters)
+    for u in range(len(unclusters)):
+        if nmembers[u] == 1 and not normalize_single:
+            comb_pwms.append(pwms[seeds[u]])
+            continue
+        seed = frames[frame_start[u]:frame_start[u] + end[u] - start[u]]
+        if maxnorm:
+            seed = seed/np.amax(np.sum(seed,axis = 1))
+        else:
+            seed = seed/np.sum(seed,axis = 1)[:, None]
+        if remove_low > 0:
+            edges = np.where(np.sum(seed, axis = 1)>remove_low)[0]
+            if len(edges) > 0:
+                seed = seed[edges[0]:edges[-1]+1]
+        comb_pwms.append(seed)
+    return comb_pwms
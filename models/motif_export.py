@@ -0,0 +1,127 @@
+# motif_export.py
+# Export of many motifs at once, f.e. tens of thousands of kernel PPMs from cnn_model.py --convertedkernel_ppms
+# IUPAC codes are looked up from a bitmask of the bases above background for all positions of all motifs at once,
+# MEME, JASPAR and HOMER files are formatted with a single string formatting per motif and written in one call.
+# ppms are lists or arrays of matrices (4, L) as in write_meme_file of interpret_cnn, or (L, 4) with transpose = True
+import numpy as np
+import sys, os
+
+# Bitmask A=16, C=8, G=4, T=2 of bases above background to IUPAC code
+iupac_codes = {'A':16, 'C':8, 'G':4, 'T':2, 'R':20, 'Y':10, 'S':12, 'W':18, 'K':6, 'M':24, 'B':14, 'D':22, 'H':26, 'V':28, 'N':0}
+iupac_table = np.array(['N']*32)
+iupac_table[list(iupac_codes.values())] = list(iupac_codes.keys())
+iupac_table[30] = 'N'
+
+
+# All motifs as one matrix (sum of L, n_nts) and their lengths
+def stack_ppms(ppms, transpose = False):
+    ppms = [np.array(ppm) for ppm in ppms]
+    if not transpose:
+        ppms = [ppm.T for ppm in ppms]
+    lengths = np.array([len(ppm) for ppm in ppms], dtype = int)
+    if len(ppms) == 0:
+        return np.zeros((0, 4)), lengths
+    return np.concatenate(ppms, axis = 0), lengths
+
+
+# IUPAC codes of all positions of the stacked motifs (sum of L, n_nts) as one string
+def iupac_string(values, bk_freq = None):
+    n_nts = np.shape(values)[1]
+    if bk_freq is None:
+        bk_freq = (1./float(n_nts))*np.ones(n_nts)
+    else:
+        bk_freq = bk_freq*np.ones(n_nts)
+    scores = np.dot((values[:, :4] > bk_freq[:4]).astype(int), np.array([16, 8, 4, 2]))
+    return ''.join(iupac_table[scores])
+
+
+def split_string(string, lengths):
+    ends = np.cumsum(lengths)
+    return np.array([string[e-l:e] for e, l in zip(ends, lengths)])
+
+
+# IUPAC code of every motif, positions are coded by the bases with frequency above bk_freq
+def pfm2iupac(pwms, bk_freq = None, transpose = False):
+    values, lengths = stack_ppms(pwms, transpose = transpose)
+    return split_string(iupac_string(values, bk_freq = bk_freq), lengths)
+
+
+# Values of all motifs as text with rowfmt for every position, only positions with sum > 0 are kept
+# Numbers are written as str() of the single values, floats of lower precision are converted by numpy to keep their short representation
+def format_blocks(values, lengths, rowfmt):
+    keep = np.sum(values, axis = 1) > 0
+    strings = values if values.dtype == np.float64 else values.astype(str)
+    ends = np.cumsum(lengths)
+    blocks, widths = [], []
+    for e, l in zip(ends, lengths):
+        rows = strings[e-l:e][keep[e-l:e]]
+        blocks.append((rowfmt * len(rows)) % tuple(rows.ravel().tolist()))
+        widths.append(len(rows))
+    return blocks, np.array(widths, dtype = int)
+
+
+# MEME file of pwms (n_filters, len(alphabet), L), motifs that are all zero are skipped
+def write_meme_file(pwm, pwmname, alphabet, output_file_path, transpose = False):
+    values, lengths = stack_ppms(pwm, transpose = transpose)
+    blocks, widths = format_blocks(values, lengths, '\t'.join(['%s']*len(alphabet)) + '\n')
+    print(len(lengths))
+    print("Saved PWM File as : {}".format(output_file_path))
+    text = ["MEME version 4 \nALPHABET= "+alphabet+" \nstrands: + -\n"]
+    for i in np.where(widths > 0)[0]:
+        text.append("\nMOTIF %s \nletter-probability matrix: alength= %d w= %d \n" % (pwmname[i], len(alphabet), widths[i]) + blocks[i])
+    with open(output_file_path, 'w') as meme_file:
+        meme_file.write(''.join(text))
+
+
+# JASPAR file of pwms with one row per base, counts scales the probabilities f.e. to the number of sites
+def write_jaspar_file(pwm, pwmname, output_file_path, alphabet = 'ACGT', counts = None, transpose = False):
+    values, lengths = stack_ppms(pwm, transpose = transpose)
+    if counts is not None:
+        values = np.around(values * counts).astype(int)
+    strings = values.astype(str)
+    ends = np.cumsum(lengths)
+    text = []
+    for i, (e, l) in enumerate(zip(ends, lengths)):
+        rows = strings[e-l:e].T
+        rowfmt = '%s  [ ' + ' '.join(['%s']*l) + ' ]\n'
+        text.append('>%s %s\n' % (pwmname[i], pwmname[i]) + ''.join([rowfmt % ((a,) + tuple(row)) for a, row in zip(alphabet, rows)]))
+    with open(output_file_path, 'w') as jaspar_file:
+        jaspar_file.write(''.join(text))
+
+
+# Log-odds detection threshold of HOMER motifs, fraction of the maximal log-odds score of every motif
+def homer_thresholds(values, lengths, fraction = 0.6, bk_freq = 0.25, pseudo = 0.001):
+    logodds = np.amax(np.log((values + pseudo)/bk_freq), axis = 1)
+    return fraction * np.bincount(np.repeat(np.arange(len(lengths)), lengths), weights = logodds, minlength = len(lengths))
+
+
+# HOMER file of pwms with the IUPAC consensus as motif ID and one row of base probabilities per position
+def write_homer_file(pwm, pwmname, output_file_path, thresholds = None, fraction = 0.6, bk_freq = 0.25, transpose = False):
+    values, lengths = stack_ppms(pwm, transpose = transpose)
+    consensus = split_string(iupac_string(values, bk_freq = bk_freq), lengths)
+    if thresholds is None:
+        thresholds = homer_thresholds(values, lengths, fraction = fraction, bk_freq = bk_freq)
+    blocks, widths = format_blocks(values, lengths, '\t'.join(['%s']*np.shape(values)[1]) + '\n')
+    text = ['>%s\t%s\t%.6f\n' % (consensus[i], pwmname[i], thresholds[i]) + blocks[i] for i in np.where(widths > 0)[0]]
+    with open(output_file_path, 'w') as homer_file:
+        homer_file.write(''.join(text))
+
+
+motif_extensions = {'meme': '.meme', 'jaspar': '.jaspar', 'homer': '.motif'}
+
+# Writes pwms in all formats (meme, jaspar, homer) to outname + _ppms + extension
+def write_motif_files(pwm, pwmname, outname, formats = ['meme'], alphabet = 'ACGT', transpose = False):
+    files = []
+    for form in formats:
+        if form not in motif_extensions:
+            print(form, 'not a valid motif format')
+            sys.exit()
+        outfile = outname+'_ppms'+motif_extensions[form]
+        if form == 'meme':
+            write_meme_file(pwm, pwmname, alphabet, outfile, transpose = transpose)
+        elif form == 'jaspar':
+            write_jaspar_file(pwm, pwmname, outfile, alphabet = alphabet, transpose = transpose)
+        elif form == 'homer':
+            write_homer_file(pwm, pwmname, outfile, transpose = transpose)
+        files.append(outfile)
+    return files
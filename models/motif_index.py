@@ -0,0 +1,157 @@
+# motif_index.py
+# Index of a motif database (f.e. CIS-BP or JASPAR pfms from read_pwm) to find the best matching motifs without comparing to all of them
+# Every database motif is represented by all its windows of length width (offset augmentation), each window is flattened,
+# centered and normalized so that the inner product between two windows is their Pearson correlation.
+# Windows of a query are searched against the windows of the database with faiss (if installed) or a matrix product,
+# motifs with the most similar windows are candidates, and candidates are re-ranked with the exact measure of compare_ppms.
+# Indices are saved as .npz next to the database file and only rebuilt if the database changes.
+import numpy as np
+import sys, os
+from motif_similarity import prepare_ppms, block_similarity
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+# Normalized windows (n_windows, width*4) of all ppms and the index of the motif that every window belongs to
+# Motifs shorter than width are padded on both sides with padding
+def window_embeddings(ppms, width = 5, padding = 0.):
+    windows, motif = [], []
+    for p, ppm in enumerate(ppms):
+        ppm = np.array(ppm, dtype = float)
+        if len(ppm) < width:
+            left = int((width - len(ppm))/2)
+            ppm = np.concatenate([np.ones((left, 4))*padding, ppm, np.ones((width - len(ppm) - left, 4))*padding], axis = 0)
+        win = np.lib.stride_tricks.sliding_window_view(ppm, width, axis = 0).transpose(0,2,1).reshape(-1, width*4)
+        windows.append(win)
+        motif.append(np.ones(len(win), dtype = int)*p)
+    windows = np.concatenate(windows, axis = 0)
+    windows = windows - np.mean(windows, axis = 1)[:, None]
+    norm = np.linalg.norm(windows, axis = 1)
+    windows[norm > 0] /= norm[norm > 0][:, None]
+    return windows.astype(np.float32), np.concatenate(motif)
+
+
+class motif_index(object):
+    def __init__(self, ppms, names = None, width = 5, padding = 0., min_sim = 5, hnsw = 32):
+        self.ppms = [np.array(ppm, dtype = float) for ppm in ppms]
+        self.names = np.array(names) if names is not None else np.arange(len(ppms)).astype(str)
+        self.width, self.padding, self.min_sim, self.hnsw = width, padding, min_sim, hnsw
+        self.embeddings, self.window_motif = window_embeddings(self.ppms, width = width, padding = padding)
+        self.prepared = prepare_ppms(self.ppms, padding = padding)
+        self.build_search()
+
+    # faiss graph index for inner products if available, otherwise windows are searched with a matrix product
+    def build_search(self, searchfile = None):
+        self.search = None
+        if faiss is not None:
+            if searchfile is not None and os.path.isfile(searchfile):
+                self.search = faiss.read_index(searchfile)
+            else:
+                self.search = faiss.IndexHNSWFlat(self.embeddings.shape[1], self.hnsw, faiss.METRIC_INNER_PRODUCT)
+                self.search.add(self.embeddings)
+
+    def save(self, outfile):
+        lengths = np.array([len(ppm) for ppm in self.ppms])
+        np.savez_compressed(outfile, ppms = np.concatenate(self.ppms, axis = 0), lengths = lengths, names = self.names, embeddings = self.embeddings, window_motif = self.window_motif, params = np.array([self.width, self.padding, self.min_sim, self.hnsw], dtype = float))
+        if self.search is not None:
+            faiss.write_index(self.search, os.path.splitext(outfile)[0]+'.faiss')
+
+    @classmethod
+    def load(cls, infile):
+        obj = np.load(infile, allow_pickle = True)
+        index = cls.__new__(cls)
+        index.ppms = np.split(obj['ppms'], np.cumsum(obj['lengths'])[:-1], axis = 0)
+        index.names = obj['names']
+        width, index.padding, min_sim, hnsw = obj['params']
+        index.width, index.min_sim, index.hnsw = int(width), int(min_sim), int(hnsw)
+        index.embeddings, index.window_motif = obj['embeddings'], obj['window_motif']
+        index.prepared = prepare_ppms(index.ppms, padding = index.padding)
+        index.build_search(searchfile = os.path.splitext(infile)[0]+'.faiss')
+        return index
+
+    # Most similar database windows for every query window, returns scores and indices of windows (n_queries, k)
+    def search_windows(self, queries, k, mask = None):
+        if self.search is not None and mask is None:
+            self.search.hnsw.efSearch = max(self.search.hnsw.efSearch, k)
+            return self.search.search(queries, k)
+        windows = np.arange(len(self.embeddings)) if mask is None else np.where(mask[self.window_motif])[0]
+        k = min(k, len(windows))
+        scores = np.dot(queries, self.embeddings[windows].T)
+        top = np.argpartition(-scores, k-1, axis = 1)[:, :k]
+        return np.take_along_axis(scores, top, axis = 1), windows[top]
+
+    # Candidate motifs for every query ppm, ranked by the best correlation between their windows
+    # mask (n_motifs) restricts the search to a subset of the database
+    def candidates(self, ppms, n_candidates = 100, mask = None, batchsize = 16):
+        if self.search is None:
+            return self.exhaustive_candidates(ppms, n_candidates = n_candidates, mask = mask, batchsize = batchsize)
+        candidates = []
+        for ppm in ppms:
+            queries, qmotif = window_embeddings([ppm], width = self.width, padding = self.padding)
+            scores, windows = self.search_windows(queries, n_candidates*4, mask = mask)
+            valid = windows >= 0
+            motifs, scores = self.window_motif[windows[valid]], scores[valid]
+            best = np.ones(len(self.ppms))*-np.inf
+            np.maximum.at(best, motifs, scores)
+            ncand = min(n_candidates, np.sum(best > -np.inf))
+            candidates.append(np.argsort(-best, kind = 'stable')[:ncand])
+        return candidates
+
+    # Without faiss, the windows of batchsize queries are compared to all windows at once,
+    # and the best window of every database motif is determined before the candidates are selected
+    def exhaustive_candidates(self, ppms, n_candidates = 100, mask = None, batchsize = 16):
+        windows = np.arange(len(self.embeddings)) if mask is None else np.where(mask[self.window_motif])[0]
+        wmotif = self.window_motif[windows]
+        first = np.r_[0, np.where(np.diff(wmotif) != 0)[0] + 1]
+        motifs = wmotif[first]
+        embeddings = self.embeddings[windows]
+        n_candidates = min(n_candidates, len(motifs))
+        candidates = []
+        for b in range(0, len(ppms), batchsize):
+            queries, qmotif = window_embeddings(ppms[b:b+batchsize], width = self.width, padding = self.padding)
+            scores = np.maximum.reduceat(np.dot(queries, embeddings.T), first, axis = 1)
+            scores = np.maximum.reduceat(scores, np.r_[0, np.where(np.diff(qmotif) != 0)[0] + 1], axis = 0)
+            top = np.argpartition(-scores, n_candidates-1, axis = 1)[:, :n_candidates]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis = 1), axis = 1, kind = 'stable'), axis = 1)
+            candidates.extend(list(motifs[top]))
+        return candidates
+
+    # Top k database motifs for every query ppm after exact re-ranking of candidates with compare_ppms' measure
+    # Returns indices, 1-correlation, log p-values and offsets (n_queries, k), sorted by log p-value, -1 if less than k candidates
+    def query(self, ppms, k = 10, n_candidates = 100, mask = None, padding = None, min_sim = None, non_zero_elements = False):
+        padding = self.padding if padding is None else padding
+        min_sim = self.min_sim if min_sim is None else min_sim
+        ids = -np.ones((len(ppms), k), dtype = int)
+        correlation, log_pvalues, offsets = np.ones((len(ppms), k))*2., np.ones((len(ppms), k))*-np.inf, np.zeros((len(ppms), k), dtype = int)
+        prepared = self.prepared if padding == self.padding else prepare_ppms(self.ppms, padding = padding)
+        for q, cand in enumerate(self.candidates(ppms, n_candidates = max(k, n_candidates), mask = mask)):
+            corr, logp, offs = block_similarity(prepare_ppms([ppms[q]], padding = padding), {key: value[cand] for key, value in prepared.items()}, min_sim = min_sim, padding = padding, non_zero_elements = non_zero_elements)
+            order = np.argsort(-logp[0], kind = 'stable')[:k]
+            ids[q, :len(order)], correlation[q, :len(order)], log_pvalues[q, :len(order)], offsets[q, :len(order)] = cand[order], corr[0, order], logp[0, order], offs[0, order]
+        return ids, correlation, log_pvalues, offsets
+
+    # Same output as compare_ppms(ppms, database, one_half = False) for the top k motifs,
+    # all other entries have correlation 2 (1-r with r=-1), log p-value fill_logp and offset 0
+    def query_matrix(self, ppms, k = 10, n_candidates = 100, mask = None, fill_logp = 0, **kwargs):
+        ids, corr, logp, offs = self.query(ppms, k = k, n_candidates = n_candidates, mask = mask, **kwargs)
+        correlation, log_pvalues, offsets = np.ones((len(ppms), len(self.ppms)))*2., np.ones((len(ppms), len(self.ppms)))*fill_logp, np.zeros((len(ppms), len(self.ppms)), dtype = int)
+        rows, cols = np.where(ids >= 0)
+        correlation[rows, ids[rows, cols]], log_pvalues[rows, ids[rows, cols]], offsets[rows, ids[rows, cols]] = corr[rows, cols], logp[rows, cols], offs[rows, cols]
+        log_pvalues[np.isinf(log_pvalues)] = fill_logp
+        return correlation, log_pvalues, offsets
+
+
+# Loads the index of database pwmfile from indexfile, or builds and saves it if it does not exist or is older than pwmfile
+def database_index(pwmfile, ppms, names = None, indexfile = None, width = 5, padding = 0., min_sim = 5):
+    if indexfile is None:
+        indexfile = os.path.splitext(pwmfile)[0]+'_motifindex.npz'
+    if os.path.isfile(indexfile) and os.path.getmtime(indexfile) >= os.path.getmtime(pwmfile):
+        index = motif_index.load(indexfile)
+        if len(index.ppms) == len(ppms) and index.width == width and index.padding == padding and np.array_equal(np.concatenate(index.ppms), np.concatenate(ppms)):
+            return index
+    index = motif_index(ppms, names = names, width = width, padding = padding, min_sim = min_sim)
+    index.save(indexfile)
+    return index
@@ -0,0 +1,134 @@
+# motif_scanning.py
+# Scanning of one-hot encoded sequences (N, 4, L) with PFMs as log-odds matrices against background frequencies
+# The distribution of scores of every motif on background sequence is computed exactly by dynamic programming over
+# the positions of the motif with scores discretized to 1/resolution, so that scores can be converted to p-values and
+# p-values to score thresholds for every motif.
+# Both strands are scanned with one batched convolution of all motifs and their reverse complements, and only hits above
+# the threshold of their motif are returned as sparse lists (seq, motif, pos, strand, score, p-value).
+# pfms are lists of matrices (4, L) as returned by read_pwm, with bases in order ACGT
+import numpy as np
+import sys, os
+import torch
+import torch.nn.functional as F
+
+
+# Log2-odds matrices (4, L) of pfms against background frequencies bk_freq (4) with pseudo count pseudo
+def pfm_logodds(pfms, bk_freq = None, pseudo = 0.01):
+    if bk_freq is None:
+        bk_freq = np.ones(4)*0.25
+    bk_freq = np.array(bk_freq, dtype = float)
+    logodds = []
+    for pfm in pfms:
+        pfm = np.array(pfm, dtype = float) + pseudo
+        pfm = pfm/np.sum(pfm, axis = 0)
+        logodds.append(np.log2(pfm/bk_freq[:, None]))
+    return logodds
+
+
+# Score tables of all motifs: for every motif the offset of the smallest discretized score and the probability
+# to reach at least every discretized score in a random sequence from bk_freq
+# The distribution is built position by position, every position shifts the distribution by the score of each base
+def score_tables(logodds, bk_freq = None, resolution = 100):
+    if bk_freq is None:
+        bk_freq = np.ones(4)*0.25
+    offsets, survival = [], []
+    for lo in logodds:
+        scores = np.around(np.array(lo)*resolution).astype(int)
+        mins = np.amin(scores, axis = 0)
+        shifted = scores - mins[None, :]
+        dist = np.ones(1)
+        for p in range(np.shape(shifted)[1]):
+            ndist = np.zeros(len(dist) + np.amax(shifted[:, p]))
+            for b in range(4):
+                ndist[shifted[b, p]:shifted[b, p]+len(dist)] += bk_freq[b]*dist
+            dist = ndist
+        offsets.append(np.sum(mins))
+        survival.append(np.minimum(1., np.cumsum(dist[::-1])[::-1]))
+    return {'resolution': resolution, 'offsets': np.array(offsets, dtype = int), 'survival': survival}
+
+
+# p-values of scores for motifs (arrays of equal shape)
+def score_pvalues(scores, motifs, tables):
+    scores, motifs = np.array(scores, dtype = float), np.array(motifs, dtype = int)
+    pvalues = np.ones(np.shape(scores))
+    for m in np.unique(motifs):
+        mask = motifs == m
+        survival = tables['survival'][m]
+        index = np.around(scores[mask]*tables['resolution']).astype(int) - tables['offsets'][m]
+        pvalues[mask] = np.where(index >= len(survival), 0., survival[np.clip(index, 0, len(survival)-1)])
+    return pvalues
+
+
+# Smallest score of every motif whose p-value is at most pvalue
+def pvalue_thresholds(tables, pvalue = 1e-4):
+    thresholds = np.zeros(len(tables['offsets']))
+    for m, survival in enumerate(tables['survival']):
+        index = np.where(survival <= pvalue)[0]
+        index = index[0] if len(index) > 0 else len(survival)
+        thresholds[m] = (index + tables['offsets'][m] - 0.5)/tables['resolution']
+    return thresholds
+
+
+# All motifs padded on the right to the longest motif (n_motifs, 4, max_len) and their lengths
+def stack_motifs(logodds):
+    lengths = np.array([np.shape(lo)[1] for lo in logodds], dtype = int)
+    weights = np.zeros((len(logodds), 4, np.amax(lengths)))
+    for m, lo in enumerate(logodds):
+        weights[m, :, :lengths[m]] = lo
+    return weights, lengths
+
+
+# Scans sequences (N, 4, L) for all motifs on both strands and returns hits with score >= threshold of their motif
+# thresholds are scores (n_motifs) or computed from pvalue with the score tables
+# Returns dictionary with arrays seq, motif, pos, strand (1 forward, -1 reverse), score and pvalue of all hits, sorted by sequence
+def scan_sequences(sequences, logodds, pvalue = 1e-4, thresholds = None, tables = None, bk_freq = None, both_strands = True, batchsize = 512, device = 'cpu'):
+    if tables is None:
+        tables = score_tables(logodds, bk_freq = bk_freq)
+    if thresholds is None:
+        thresholds = pvalue_thresholds(tables, pvalue = pvalue)
+    weights, lengths = stack_motifs(logodds)
+    n_motifs, max_len = len(lengths), np.shape(weights)[-1]
+    strands = np.ones(n_motifs, dtype = int)
+    if both_strands:
+        # reverse complement of ACGT matrices reverses bases and positions
+        rcweights = np.zeros(np.shape(weights))
+        for m, l in enumerate(lengths):
+            rcweights[m, :, :l] = weights[m, ::-1, :l][:, ::-1]
+        weights = np.concatenate([weights, rcweights], axis = 0)
+        strands = np.append(strands, -strands)
+    motifid = np.arange(len(weights)) % n_motifs
+    weights = torch.Tensor(weights).to(device)
+    n_seqs, seqlen = np.shape(sequences)[0], np.shape(sequences)[-1]
+    # windows of motifs that reach beyond the end of the sequence can never pass their threshold
+    cuts = np.where(np.arange(seqlen)[None, :] <= seqlen - lengths[motifid][:, None], thresholds[motifid][:, None], np.inf)
+    cuts = torch.Tensor(cuts).to(device)
+    hits = {'seq': [], 'motif': [], 'pos': [], 'strand': [], 'score': []}
+    with torch.no_grad():
+        for b in range(0, n_seqs, batchsize):
+            batch = torch.Tensor(np.array(sequences[b:b+batchsize], dtype = float)).to(device)
+            scores = F.conv1d(F.pad(batch, (0, max_len - 1)), weights)
+            found = torch.nonzero((scores >= cuts[None]).view(-1)).view(-1)
+            hits['score'].append(scores.view(-1)[found].cpu().numpy())
+            seq, mot, pos = np.unravel_index(found.cpu().numpy(), tuple(scores.shape))
+            hits['seq'].append(seq + b)
+            hits['motif'].append(motifid[mot])
+            hits['pos'].append(pos)
+            hits['strand'].append(strands[mot])
+    hits = {key: np.concatenate(value) if len(value) > 0 else np.array([], dtype = int) for key, value in hits.items()}
+    hits['pvalue'] = score_pvalues(hits['score'], hits['motif'], tables)
+    return hits
+
+
+# Dense motif features (n_seqs, n_motifs) from hits: number of hits ('count'), best score ('max') or sum of scores ('sum')
+def hit_features(hits, n_seqs, n_motifs, measure = 'count'):
+    features = np.zeros((n_seqs, n_motifs))
+    if measure == 'count':
+        np.add.at(features, (hits['seq'], hits['motif']), 1)
+    elif measure == 'sum':
+        np.add.at(features, (hits['seq'], hits['motif']), hits['score'])
+    elif measure == 'max':
+        np.maximum.at(features, (hits['seq'], hits['motif']), np.maximum(hits['score'], 0))
+    else:
+        print(measure, 'not a valid hit measure')
+        sys.exit()
+    return features
@@ -0,0 +1,202 @@
+# motif_similarity.py
+# Pearson correlation between PPMs at all offsets for all pairs of motifs, same measure as the pairwise loop in compare_ppms
+# All motifs are padded into one array (N, Lmax, 4). The correlation at every offset only depends on the sums n, Sx, Sy, Sxx, Syy, Sxy
+# over the rows that are compared. Sums that depend on the overlap of two motifs are computed for all pairs and offsets
+# with one matrix product between the motifs and the sliding windows (unfold) of the padded reference motifs.
+# Rows in which both motifs are padding are not compared, as the mask in compare_ppms does.
+# Pairs are computed in blocks that fit into max_memory, and can be written into memory mapped files for N > 10k.
+import numpy as np
+import sys, os
+from scipy.special import betainc
+
+
+# Padded values, lengths and prefix sums of rows for all ppms
+# padrow are rows that are equal to padding, zeros are entries that are zero
+def prepare_ppms(ppms, padding = 0.25, infocont = False, bk_freq = 0.25):
+    lengths = np.array([len(ppm) for ppm in ppms], dtype = int)
+    lmax = max(1, np.amax(lengths)) if len(lengths) > 0 else 1
+    values = np.zeros((len(ppms), lmax, 4))
+    for p, ppm in enumerate(ppms):
+        ppm = np.array(ppm, dtype = float)
+        if infocont:
+            with np.errstate(divide = 'ignore'):
+                ppm = np.log2(ppm/bk_freq)
+            ppm[ppm<0] = 0
+        values[p, :len(ppm)] = ppm
+    present = np.arange(lmax)[None, :] < lengths[:, None]
+    padrow = np.zeros((len(ppms), lmax))
+    if padding is not None:
+        padrow = (present & np.all(values == padding, axis = -1)).astype(float)
+    zeros = (present[..., None] & (values == 0)).astype(float)
+    prefix = lambda x: np.concatenate([np.zeros((len(x), 1)), np.cumsum(x, axis = 1)], axis = 1)
+    return {'lengths': lengths, 'values': values, 'padrow': padrow, 'zeros': zeros,
+            'csum': prefix(np.sum(values, axis = -1)), 'csqsum': prefix(np.sum(values**2, axis = -1)),
+            'cpad': prefix(padrow), 'czero': prefix(np.sum(zeros, axis = -1))}
+
+
+def subset_ppms(prepared, start, end):
+    return {key: value[start:end] for key, value in prepared.items()}
+
+
+# Sum over rows of test (N, Lt, C) times rows of ref (M, Lr, C) for all offsets i = -Lt to Lr of test to ref
+# Returns (N, M, Lt+Lr+1)
+def offset_products(test, ref):
+    n, lt, c = np.shape(test)
+    m, lr = np.shape(ref)[:2]
+    padded = np.pad(ref, ((0,0), (lt, lt), (0,0)))
+    # (M, Lr+Lt+1, C, Lt), window o starts at position o-Lt of ref
+    windows = np.lib.stride_tricks.sliding_window_view(padded, lt, axis = 1)
+    prod = np.dot(np.transpose(test, axes = (0,2,1)).reshape(n, -1), windows.reshape(m*(lr+lt+1), -1).T)
+    return prod.reshape(n, m, lr+lt+1)
+
+
+# Sum of rows start to end from prefix sums (N, L+1) with start and end of shape (N, M, O)
+def range_sum(prefix, start, end):
+    n, m, o = np.shape(start)
+    gather = lambda index: np.take_along_axis(prefix, index.reshape(n, -1), axis = 1).reshape(n, m, o)
+    return gather(end) - gather(start)
+
+
+# Sum over rows of the pairs of test (P, Lt, C) and ref (P, Lr, C) for all offsets i = -Lt to Lr, returns (P, Lt+Lr+1)
+def pair_products(test, ref):
+    p, lt, c = np.shape(test)
+    lr = np.shape(ref)[1]
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(ref, ((0,0), (lt, lt), (0,0))), lt, axis = 1)
+    return np.einsum('pcj,pocj->po', np.transpose(test, axes = (0,2,1)), windows)
+
+
+# Correlation, log p-value and offset of the best offset for all pairs of prepared test and ref motifs
+# Returns 1-correlation, -sign(r)*log10(p), and offsets (N, M), log p-values of identical motifs are inf as in pearsonr
+def block_similarity(test, ref, min_sim = 5, padding = 0.25, non_zero_elements = False):
+    lt, lr = test['values'].shape[1], ref['values'].shape[1]
+    flip = lambda x: np.transpose(x, axes = (1,0,2))
+    tsum = lambda key, start, end: range_sum(test[key], start, end)
+    rsum = lambda key, start, end: flip(range_sum(ref[key], flip(start), flip(end)))
+    ttotal, rtotal = lambda key: test[key][:, -1][:, None, None], lambda key: ref[key][:, -1][None, :, None]
+    product = lambda key: offset_products(test[key] if test[key].ndim == 3 else test[key][..., None], ref[key] if ref[key].ndim == 3 else ref[key][..., None])
+    return offset_similarity(test['lengths'][:, None, None], ref['lengths'][None, :, None], np.arange(-lt, lr+1)[None, None, :], lt, lr, tsum, rsum, ttotal, rtotal, product, min_sim = min_sim, padding = padding, non_zero_elements = non_zero_elements)
+
+
+# Same as block_similarity for the pairs of test motifs tid and ref motifs rid, returns arrays of length of tid
+def pair_similarity(test, ref, tid, rid, min_sim = 5, padding = 0.25, non_zero_elements = False):
+    lt, lr = test['values'].shape[1], ref['values'].shape[1]
+    gather = lambda prefix, start, end: np.take_along_axis(prefix, end, axis = 1) - np.take_along_axis(prefix, start, axis = 1)
+    tsum = lambda key, start, end: gather(test[key][tid], start, end)
+    rsum = lambda key, start, end: gather(ref[key][rid], start, end)
+    ttotal, rtotal = lambda key: test[key][tid, -1][:, None], lambda key: ref[key][rid, -1][:, None]
+    product = lambda key: pair_products(test[key][tid] if test[key].ndim == 3 else test[key][tid][..., None], ref[key][rid] if ref[key].ndim == 3 else ref[key][rid][..., None])
+    return offset_similarity(test['lengths'][tid][:, None], ref['lengths'][rid][:, None], np.arange(-lt, lr+1)[None, :], lt, lr, tsum, rsum, ttotal, rtotal, product, min_sim = min_sim, padding = padding, non_zero_elements = non_zero_elements)
+
+
+# Correlation at all offsets offs from the lengths lp and lq of the motifs, their sums over ranges of rows (tsum, rsum),
+# their total sums (ttotal, rtotal) and the sum of products of their rows at all offsets (product), and the best offset
+def offset_similarity(lp, lq, offs, lt, lr, tsum, rsum, ttotal, rtotal, product, min_sim = 5, padding = 0.25, non_zero_elements = False):
+    valid = (offs >= np.minimum(0, -lp+min_sim)) & (offs <= lq - np.minimum(lp, min_sim))
+    # rows of test and rows of ref that overlap at every offset
+    ja, jb = np.maximum(0, -offs), np.minimum(lp, lq-offs)
+    ka, kb = np.maximum(0, offs), np.minimum(lq, lp+offs)
+    ja, ka = ja + np.zeros_like(jb), ka + np.zeros_like(kb)
+    jb, kb = np.maximum(ja, jb), np.maximum(ka, kb)
+    ja, jb, ka, kb = np.minimum(ja, lt), np.minimum(jb, lt), np.minimum(ka, lr), np.minimum(kb, lr)
+    overlap = jb - ja
+    trsum, rrsum = lambda key: tsum(key, ja, jb), lambda key: rsum(key, ka, kb)
+    sxy = product('values')
+    sx_ov, sxx_ov, sy_ov, syy_ov = trsum('csum'), trsum('csqsum'), rrsum('csum'), rrsum('csqsum')
+    st, stt = ttotal('csum'), ttotal('csqsum')
+    sr, srr = rtotal('csum'), rtotal('csqsum')
+    if padding is None:
+        n, sx, sxx, sy, syy = 4.*overlap, sx_ov, sxx_ov, sy_ov, syy_ov
+        if non_zero_elements:
+            n = n - product('zeros')
+    else:
+        # rows outside of the overlap are compared to padding
+        n = 4.*(lp + lq - overlap)
+        sx, sxx = st + 4*padding*(lq-overlap), stt + 4*padding**2*(lq-overlap)
+        sy, syy = sr + 4*padding*(lp-overlap), srr + 4*padding**2*(lp-overlap)
+        sxy = sxy + padding*(st - sx_ov) + padding*(sr - sy_ov)
+        # rows in which both are padding
+        excluded = product('padrow') + ttotal('cpad') - trsum('cpad') + rtotal('cpad') - rrsum('cpad')
+        n = n - 4*excluded
+        sx, sy = sx - 4*padding*excluded, sy - 4*padding*excluded
+        sxx, syy, sxy = sxx - 4*padding**2*excluded, syy - 4*padding**2*excluded, sxy - 4*padding**2*excluded
+        if non_zero_elements:
+            bothzero = product('zeros')
+            if padding == 0:
+                bothzero = bothzero + ttotal('czero') - trsum('czero') + rtotal('czero') - rrsum('czero') - 4*excluded
+            n = n - bothzero
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = (n*sxy - sx*sy)/np.sqrt((n*sxx - sx**2)*(n*syy - sy**2))
+        r = np.clip(r, -1., 1.)
+        r[np.abs(r) > 1.-1e-12] = np.sign(r[np.abs(r) > 1.-1e-12])
+    valid = valid & (n >= 2)
+    # p-values are only computed for offsets that can have the best score. For positive r, the score increases with r and n,
+    # for negative r it decreases with |r| and n. Offsets are sorted by n, and an offset can only be the best if its r is
+    # larger than r of all offsets with larger (or smaller for negative r) n. nan correlations are the best as in np.argmax.
+    group = np.where(np.isnan(r), 2, (r > 0).astype(int))
+    group[~valid] = -1
+    rk = np.nan_to_num(r, nan = 0.)
+    offs = offs + np.zeros_like(r, dtype = int)
+    order = np.lexsort((offs, -rk, -np.where(r > 0, n, -n), -group), axis = -1)
+    group, rk = np.take_along_axis(group, order, axis = -1), np.take_along_axis(rk, order, axis = -1)
+    previous = np.concatenate([-np.ones(rk.shape[:-1] + (1,))*np.inf, np.maximum.accumulate(rk, axis = -1)[..., :-1]], axis = -1)
+    front = (group == group[..., :1]) & (group >= 0) & ((rk > previous) | (np.absolute(rk) == 1.) | (rk == 0) | (group == 2))
+    candidates = tuple(np.where(front)[:-1]) + (order[front],)
+    scores = -np.ones(np.shape(r))*np.inf
+    nc, rc = n[candidates], r[candidates]
+    ab = np.maximum(nc/2. - 1., 1e-8)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        pval = np.where(nc > 2, 2*betainc(ab, ab, np.clip(0.5*(1.-np.abs(rc)), 0, 0.5)), 1.)
+        scores[candidates] = -np.sign(rc)*np.log10(np.minimum(pval, 1.))
+    best = np.argmax(scores, axis = -1)[..., None]
+    correlation = 1. - np.take_along_axis(r, best, axis = -1)[..., 0]
+    log_pvalues = np.take_along_axis(scores, best, axis = -1)[..., 0]
+    offsets = np.take_along_axis(offs, best, axis = -1)[..., 0]
+    return correlation, log_pvalues, offsets
+
+
+# Number of motifs per block so that the arrays of a block (block_size, block_size, offsets) stay below max_memory (MB)
+def similarity_blocksize(lmax, max_memory = 1024):
+    return max(1, int(np.sqrt(max_memory * 2**20/(8*24*(2*lmax+1)))))
+
+
+# Generator over blocks of pairs, yields rows start, end, columns start, end, and correlation, log p-values and offsets of the block
+# If one_half, only blocks with pairs above the diagonal are computed
+def similarity_blocks(ppms, ppms_ref, one_half = False, min_sim = 5, padding = 0.25, infocont = False, bk_freq = 0.25, non_zero_elements = False, block_size = None, max_memory = 1024):
+    if infocont and padding is not None:
+        padding = max(0, np.log2(padding/bk_freq))
+    test, ref = prepare_ppms(ppms, padding = padding, infocont = infocont, bk_freq = bk_freq), prepare_ppms(ppms_ref, padding = padding, infocont = infocont, bk_freq = bk_freq)
+    if block_size is None:
+        block_size = similarity_blocksize(max(test['values'].shape[1], ref['values'].shape[1]), max_memory = max_memory)
+    for a in range(0, len(ppms), block_size):
+        b = min(a+block_size, len(ppms))
+        for c in range(a if one_half else 0, len(ppms_ref), block_size):
+            d = min(c+block_size, len(ppms_ref))
+            yield (a, b, c, d) + block_similarity(subset_ppms(test, a, b), subset_ppms(ref, c, d), min_sim = min_sim, padding = padding, non_zero_elements = non_zero_elements)
+
+
+# Correlation (1-r), log p-values and offsets between all ppms and ppms_ref, same as the loop over pairs in compare_ppms
+# If one_half, ppms_ref are the same motifs as ppms and only pairs above the diagonal are computed and mirrored, diagonal is zero
+# If outfile is given, arrays are memory mapped files outfile+'_correlation.npy', '_log_pvalues.npy', '_offsets.npy'
+def ppm_similarity(ppms, ppms_ref, one_half = False, min_sim = 5, padding = 0.25, infocont = False, bk_freq = 0.25, non_zero_elements = False, block_size = None, max_memory = 1024, outfile = None, verbose = False):
+    shape = (len(ppms), len(ppms_ref))
+    if outfile is not None:
+        correlation, log_pvalues, offsets = [np.lib.format.open_memmap(outfile+'_'+name+'.npy', mode = 'w+', dtype = dtype, shape = shape) for name, dtype in [['correlation', float], ['log_pvalues', float], ['offsets', int]]]
+        for arr in [correlation, log_pvalues, offsets]:
+            arr[:] = 0
+    else:
+        correlation, log_pvalues, offsets = np.zeros(shape, dtype = float), np.zeros(shape, dtype = float), np.zeros(shape, dtype = int)
+    for a, b, c, d, corr, logp, offs in similarity_blocks(ppms, ppms_ref, one_half = one_half, min_sim = min_sim, padding = padding, infocont = infocont, bk_freq = bk_freq, non_zero_elements = non_zero_elements, block_size = block_size, max_memory = max_memory):
+        if verbose:
+            print(b, c)
+        if one_half:
+            upper = np.arange(c, d)[None, :] > np.arange(a, b)[:, None]
+            for arr, values, sign in [[correlation, corr, 1], [log_pvalues, logp, 1], [offsets, offs, -1]]:
+                block = np.array(arr[a:b, c:d])
+                block[upper] = values[upper]
+                arr[a:b, c:d] = block
+                block = np.array(arr[c:d, a:b])
+                block[upper.T] = sign*values.T[upper.T]
+                arr[c:d, a:b] = block
+        else:
+            correlation[a:b, c:d], log_pvalues[a:b, c:d], offsets[a:b, c:d] = corr, logp, offs
+    return correlation, log_pvalues, offsets
@@ -0,0 +1,130 @@
+# occurrence_statistics.py
+# Statistics of motif occurrences in many sequences, f.e. motif clusters in start and optimized sequences of a design run
+# Occurrences are collected once in a sparse (sequences x motif clusters) count matrix.
+# Enrichment between two sets of sequences and co-occurrence of all pairs of clusters are tested with one-sided
+# Fisher's exact tests, computed as hypergeometric tail probabilities for all tables at once,
+# and corrected for multiple testing with Benjamini-Hochberg.
+import numpy as np
+import sys, os
+from scipy.sparse import coo_matrix
+from scipy.special import gammaln
+
+
+# Sparse matrix (n_seqs, n_clusters) with the number of occurrences of every cluster in every sequence
+def occurrence_matrix(seqids, clusters, n_seqs = None, n_clusters = None):
+    seqids, clusters = np.array(seqids, dtype = int), np.array(clusters, dtype = int)
+    if n_seqs is None:
+        n_seqs = np.amax(seqids) + 1 if len(seqids) > 0 else 0
+    if n_clusters is None:
+        n_clusters = np.amax(clusters) + 1 if len(clusters) > 0 else 0
+    return coo_matrix((np.ones(len(seqids)), (seqids, clusters)), shape = (n_seqs, n_clusters)).tocsr()
+
+
+# Log probabilities of the hypergeometric distribution, k successes in N draws from M with n successes
+def hypergeom_logpmf(k, M, n, N):
+    lcomb = lambda a, b: gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+    return lcomb(n, k) + lcomb(M - n, N - k) - lcomb(M, N)
+
+
+# Sum of probabilities from k into direction (+1 or -1) until the terms vanish, all k have to be on the side of
+# the mode into which the terms decrease. The ratio of consecutive terms is used instead of evaluating every term
+def hypergeom_sum(k, M, n, N, direction, eps = 1e-17):
+    low, high = np.maximum(0, N - (M - n)), np.minimum(n, N)
+    term = np.where((k >= low) & (k <= high), np.exp(hypergeom_logpmf(np.clip(k, low, high), M, n, N)), 0.)
+    total = term.copy()
+    x = k.astype(float)
+    active = np.where((term > 0) & (x + direction >= low) & (x + direction <= high))[0]
+    while len(active) > 0:
+        xa, Ma, na, Na = x[active], M[active], n[active], N[active]
+        if direction > 0:
+            ratio = (na - xa)*(Na - xa)/((xa + 1)*(Ma - na - Na + xa + 1))
+        else:
+            ratio = xa*(Ma - na - Na + xa)/((na - xa + 1)*(Na - xa + 1))
+        term[active] *= ratio
+        total[active] += term[active]
+        x[active] += direction
+        keep = (term[active] > eps*total[active]) & (x[active] + direction >= low[active]) & (x[active] + direction <= high[active])
+        active = active[keep]
+    return total
+
+
+# Upper tail P(X >= k) and lower tail P(X <= k) of the hypergeometric distribution for arrays of k, M, n, N
+# Tails are summed away from the mode, the tail that contains the mode is one minus the opposite tail
+def hypergeom_tails(k, M, n, N):
+    k, M, n, N = np.broadcast_arrays(*[np.array(x, dtype = float) for x in [k, M, n, N]])
+    k, M, n, N = [x.flatten() for x in [k, M, n, N]]
+    valid = (M >= 0) & (n >= 0) & (N >= 0) & (n <= M) & (N <= M)
+    upper, lower = np.ones(len(k))*np.nan, np.ones(len(k))*np.nan
+    mode = np.floor((n + 1)*(N + 1)/(M + 2))
+    above = valid & (k > mode)
+    below = valid & (k <= mode)
+    for mask, start, direction, tail in [[above, k, 1, upper], [below, k - 1, -1, upper], [valid & (k < mode), k, -1, lower], [valid & (k >= mode), k + 1, 1, lower]]:
+        idx = np.where(mask)[0]
+        if len(idx) > 0:
+            tail[idx] = hypergeom_sum(start[idx], M[idx], n[idx], N[idx], direction)
+    upper[below] = 1. - upper[below]
+    lower[valid & (k >= mode)] = 1. - lower[valid & (k >= mode)]
+    return np.clip(upper, 0, 1), np.clip(lower, 0, 1)
+
+
+# One-sided p-values of Fisher's exact test for tables [[a, b], [c, d]] (arrays of equal shape)
+# greater tests for odds ratios > 1, less for odds ratios < 1, same as scipy.stats.fisher_exact
+def fisher_tails(a, b, c, d):
+    a, b, c, d = [np.array(x, dtype = int) for x in [a, b, c, d]]
+    greater, less = hypergeom_tails(a, a + b + c + d, a + b, a + c)
+    invalid = (a < 0) | (b < 0) | (c < 0) | (d < 0)
+    greater[invalid.flatten()], less[invalid.flatten()] = np.nan, np.nan
+    return greater.reshape(np.shape(a)), less.reshape(np.shape(a))
+
+
+# Benjamini-Hochberg adjusted p-values for pvalues of any shape, nan are ignored
+def fdr_correction(pvalues):
+    pvalues = np.array(pvalues, dtype = float)
+    qvalues = np.ones(np.shape(pvalues)) * np.nan
+    valid = ~np.isnan(pvalues)
+    p = pvalues[valid]
+    order = np.argsort(p)
+    q = p[order] * len(p)/np.arange(1, len(p)+1)
+    q = np.minimum.accumulate(q[::-1])[::-1]
+    qvalid = np.ones(len(p))
+    qvalid[order] = np.minimum(q, 1)
+    qvalues[valid] = qvalid
+    return qvalues
+
+
+# Enrichment of every cluster in sequences of foreground versus background (boolean masks over the rows of occurrences)
+# Returns the number of sequences with the cluster in both sets, log2 odds ratio, p-values for enrichment and depletion, and q-values of the two-sided test
+def enrichment_tests(occurrences, foreground, background, pseudo = 0.5):
+    present = (occurrences > 0).astype(int)
+    nfg = np.array(present[np.where(foreground)[0]].sum(axis = 0)).flatten()
+    nbg = np.array(present[np.where(background)[0]].sum(axis = 0)).flatten()
+    a, b, c, d = nfg, np.sum(foreground) - nfg, nbg, np.sum(background) - nbg
+    greater, less = fisher_tails(a, b, c, d)
+    logodds = np.log2((a + pseudo)*(d + pseudo)/((b + pseudo)*(c + pseudo)))
+    qvalues = fdr_correction(np.minimum(1, 2*np.minimum(greater, less)))
+    return nfg, nbg, logodds, greater, less, qvalues
+
+
+# Co-occurrence of all pairs of clusters (i <= j) in the sequences of mask with at least min_occurrence occurrences
+# Number of sequences with both clusters comes from one sparse product, for i == j it is the number of sequences with
+# more than one occurrence of i. Tables are [[n_i - n_ij, n_ij], [N - n_i - n_j + n_ij, n_j - n_ij]] as in
+# sequence_importance_motif_statistics.py, so that less tests for co-occurrence and greater for exclusion
+# Returns pairs (n_pairs, 2), n_i, n_j, n_ij, p-values for greater and less, score log10(greater) - log10(less), and q-values
+def cooccurrence_tests(occurrences, mask = None, min_occurrence = 2, clusters = None):
+    if mask is not None:
+        occurrences = occurrences[np.where(mask)[0]]
+    n_seqs = occurrences.shape[0]
+    counts = np.array(occurrences.sum(axis = 0)).flatten()
+    tested = np.where(counts >= min_occurrence)[0] if clusters is None else np.array(clusters, dtype = int)
+    occurrences = occurrences[:, tested]
+    present = (occurrences > 0).astype(int)
+    nseq = np.array(present.sum(axis = 0)).flatten()
+    both = (present.T @ present).toarray()
+    both[np.arange(len(tested)), np.arange(len(tested))] = np.array((occurrences > 1).sum(axis = 0)).flatten()
+    i, j = np.triu_indices(len(tested))
+    ni, nj, nij = nseq[i], nseq[j], both[i, j]
+    greater, less = fisher_tails(ni - nij, nij, n_seqs - ni - nj + nij, nj - nij)
+    with np.errstate(divide = 'ignore'):
+        score = np.log10(greater) - np.log10(less)
+    qvalues = fdr_correction(np.minimum(1, 2*np.minimum(greater, less)))
+    return np.array([tested[i], tested[j]]).T, ni, nj, nij, greater, less, score, qvalues
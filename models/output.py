@@ -368,7 +368,7 @@ def add_params_to_outname(outname, ndict):
     if ndict['l2reg_last'] > 0:
         outname += '_l2'+str(ndict['l2reg_last'])
     if ndict['l1_kernel'] > 0:
-        outname += '_l1k'+str(ndict['l2reg_last'])
+        outname += '_l1k'+str(ndict['l1_kernel'])
     if ndict['dropout'] > 0.:
         outname += '_do'+str(ndict['dropout'])
     if ndict['batch_norm']:
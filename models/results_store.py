@@ -0,0 +1,159 @@
+# results_store.py
+# Columnar store for the results of many training runs of cnn_model.py
+# Every run is written as one compressed shard <run>.npz into the store directory with its hyperparameters,
+# per-class metrics, kernel weights, PPMs, IUPAC motifs, kernel importance and impact.
+# index.npz collects the hyperparameters and mean metrics of all shards as columns (runs x parameters), so that
+# runs can be selected with vectorized filters without opening thousands of files.
+# Shards are only written by their own run and the index is updated from new or changed shards when it is read,
+# so runs that finish at the same time do not have to lock the index.
+import numpy as np
+import sys, os
+from functions import correlation, mse
+
+
+# Writes arrays to outfile with a temporary file first, so that readers never see a partially written file
+def atomic_savez(outfile, **arrays):
+    tmpfile = outfile + '.tmp' + str(os.getpid()) + '.npz'
+    np.savez_compressed(tmpfile, **arrays)
+    os.replace(tmpfile, outfile)
+
+
+# Hyperparameters of a model as strings, same values that are written into _model_params.dat
+def model_params(model):
+    params = {}
+    for key, value in model.__dict__.items():
+        if key[0] == '_' or key in ['kwargs', 'saveloss', 'pwm_out']:
+            continue
+        if str(key) == 'fixed_kernels' and value is not None:
+            value = len(value)
+        if isinstance(value, np.ndarray) and value.size > 100:
+            continue
+        if value is None or isinstance(value, (bool, int, float, str, list, tuple, np.ndarray, np.integer, np.floating)):
+            params[key] = str(value)
+    return params
+
+
+# Correlation distance and mse for every experiment, named after the files of save_performance
+# Experiments that are not in class tclass are nan in the metrics of tclass
+def class_metrics(Y_pred, Ytest, testclasses):
+    metrics = {}
+    if len(np.shape(Ytest)) > 2:
+        Ytest, Y_pred = np.sum(Ytest, axis = -1), np.sum(Y_pred, axis = -1)
+    for tclass in np.unique(testclasses):
+        consider = np.where(testclasses == tclass)[0]
+        for name, values in [['exper_corr_tcl', correlation(Ytest[:,consider], Y_pred[:,consider], axis = 0)], ['exper_mse_tcl', mse(Ytest[:,consider], Y_pred[:,consider], axis = 0)]]:
+            metric = np.ones(len(testclasses))*np.nan
+            metric[consider] = values
+            metrics[name+str(tclass)] = metric
+    return metrics
+
+
+# Writes the results of one run into the store, run is the base name of the outname of the model
+# ppms can be a list of ppms with different lengths
+def store_run(storedir, outname, params, experiments = None, metrics = None, kernels = None, ppms = None, motifnames = None, iupac = None, importance = None, impact = None):
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir, exist_ok = True)
+    run = os.path.split(outname)[1]
+    arrays = {'run': np.array(run), 'outname': np.array(outname), 'param_names': np.array(list(params.keys()), dtype = str), 'param_values': np.array(list(params.values()), dtype = str)}
+    if metrics is not None:
+        arrays['metric_names'] = np.array(list(metrics.keys()), dtype = str)
+        arrays['metrics'] = np.array(list(metrics.values()), dtype = float).reshape(len(metrics), -1)
+    if ppms is not None:
+        arrays['ppm_lengths'] = np.array([len(ppm) for ppm in ppms], dtype = int)
+        arrays['ppms'] = np.concatenate([np.array(ppm, dtype = float) for ppm in ppms], axis = 0)
+    for key, value in [['experiments', experiments], ['kernels', kernels], ['motifnames', motifnames], ['iupac', iupac], ['importance', importance], ['impact', impact]]:
+        if value is not None:
+            arrays[key] = np.array(value)
+    atomic_savez(os.path.join(storedir, run + '.npz'), **arrays)
+    return os.path.join(storedir, run + '.npz')
+
+
+def shard_files(storedir):
+    return np.sort([f for f in os.listdir(storedir) if f.endswith('.npz') and f != 'index.npz' and '.tmp' not in f])
+
+
+# Index of all runs in storedir as columns:
+# run, shard, mtime (n_runs), param_names (n_params), params (n_runs, n_params) as strings with 'None' for missing parameters,
+# metric_names (n_metrics), metrics (n_runs, n_metrics) mean of every metric over experiments
+# Only shards that are new or changed since the last index are read
+def read_index(storedir, update = True):
+    indexfile = os.path.join(storedir, 'index.npz')
+    index = {'run': np.array([], dtype = str), 'shard': np.array([], dtype = str), 'mtime': np.array([]), 'param_names': np.array([], dtype = str), 'params': np.zeros((0,0), dtype = str), 'metric_names': np.array([], dtype = str), 'metrics': np.zeros((0,0))}
+    if os.path.isfile(indexfile):
+        obj = np.load(indexfile)
+        index = {key: obj[key] for key in index}
+    if not update:
+        return index
+    shards = shard_files(storedir)
+    mtimes = np.array([os.path.getmtime(os.path.join(storedir, shard)) for shard in shards])
+    known = dict(zip(index['shard'], index['mtime']))
+    changed = np.array([shard not in known or known[shard] != mtime for shard, mtime in zip(shards, mtimes)], dtype = bool)
+    if not changed.any() and len(shards) == len(index['shard']):
+        return index
+    # keep unchanged rows and read the new shards
+    keep = np.isin(index['shard'], shards[~changed])
+    rows = [{'run': r, 'shard': s, 'mtime': m, 'params': dict(zip(index['param_names'], p)), 'metrics': dict(zip(index['metric_names'], v))} for r, s, m, p, v in zip(index['run'][keep], index['shard'][keep], index['mtime'][keep], index['params'][keep], index['metrics'][keep])]
+    for shard, mtime in zip(shards[changed], mtimes[changed]):
+        obj = np.load(os.path.join(storedir, shard))
+        metrics = {}
+        if 'metrics' in obj.files:
+            metrics = dict(zip(obj['metric_names'], np.nanmean(obj['metrics'], axis = 1)))
+        rows.append({'run': str(obj['run']), 'shard': shard, 'mtime': mtime, 'params': dict(zip(obj['param_names'], obj['param_values'])), 'metrics': metrics})
+    rows = [rows[i] for i in np.argsort([row['shard'] for row in rows], kind = 'stable')]
+    param_names = np.unique(np.concatenate([list(row['params'].keys()) for row in rows] + [[]])).astype(str)
+    metric_names = np.unique(np.concatenate([list(row['metrics'].keys()) for row in rows] + [[]])).astype(str)
+    index = {'run': np.array([row['run'] for row in rows], dtype = str), 'shard': np.array([row['shard'] for row in rows], dtype = str), 'mtime': np.array([row['mtime'] for row in rows], dtype = float), 'param_names': param_names, 'metric_names': metric_names}
+    index['params'] = np.array([[row['params'].get(p, 'None') for p in param_names] for row in rows], dtype = str).reshape(len(rows), len(param_names))
+    index['metrics'] = np.array([[row['metrics'].get(m, np.nan) for m in metric_names] for row in rows], dtype = float).reshape(len(rows), len(metric_names))
+    atomic_savez(indexfile, **index)
+    return index
+
+
+# Column of parameter name for all runs
+def param_column(index, name):
+    if name not in index['param_names']:
+        return np.array(['None']*len(index['run']))
+    return index['params'][:, list(index['param_names']).index(name)]
+
+
+# Boolean mask of runs whose name starts with prefix and whose parameters match all filters
+# filters are values (compared as strings) or lists of allowed values, f.e. select_runs(index, num_kernels = [100, 200], lr = 0.001)
+def select_runs(index, prefix = None, **filters):
+    mask = np.ones(len(index['run']), dtype = bool)
+    if prefix is not None:
+        mask &= np.char.startswith(index['run'], prefix)
+    for name, value in filters.items():
+        values = value if isinstance(value, (list, tuple, np.ndarray)) else [value]
+        mask &= np.isin(param_column(index, name), np.array(values).astype(str))
+    return mask
+
+
+# Array key of all runs in mask, None for runs that do not contain it
+# ppms are returned as list of ppms for every run
+def load_runs(storedir, index, mask, key):
+    values = []
+    for shard in index['shard'][mask]:
+        obj = np.load(os.path.join(storedir, shard))
+        if key == 'ppms' and 'ppms' in obj.files:
+            values.append(np.split(obj['ppms'], np.cumsum(obj['ppm_lengths'])[:-1], axis = 0))
+        elif key in obj.files:
+            values.append(obj[key])
+        else:
+            values.append(None)
+    return values
+
+
+# Values of metric for every experiment of the runs in mask, experiments with nan are removed
+def load_metric(storedir, index, mask, metric):
+    performance, experiments = [], []
+    for shard in index['shard'][mask]:
+        obj = np.load(os.path.join(storedir, shard))
+        if 'metrics' not in obj.files or metric not in obj['metric_names']:
+            performance.append(np.array([]))
+            experiments.append(np.array([], dtype = str))
+            continue
+        values = obj['metrics'][list(obj['metric_names']).index(metric)]
+        valid = ~np.isnan(values)
+        performance.append(values[valid])
+        experiments.append(obj['experiments'][valid] if 'experiments' in obj.files else np.arange(len(values))[valid].astype(str))
+    return performance, experiments
@@ -0,0 +1,179 @@
+# run_registry.py
+# Registry of training runs in one SQLite file, f.e. runs.sqlite in the output directory.
+# Every run is a row with its outname, timings, trained epochs, the saveloss of fit_model and the hashes of the data
+# and of the train, validation and test sets. Hyperparameters, mean and per-experiment metrics and the files of a run
+# are rows of their own tables, which are indexed by name and value, so that runs can be selected and sorted by
+# parameters and metrics with one query instead of parsing file names or globbing for _model_params.dat files.
+# Hyperparameters are stored as strings like in _model_params.dat and results_store.py.
+# Many processes can register runs at the same time, sqlite serializes the writes; the file should be on a local
+# file system because locking on network file systems is unreliable.
+import numpy as np
+import sys, os
+import time
+import socket
+import hashlib
+import sqlite3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, run TEXT UNIQUE, outname TEXT, host TEXT, command TEXT, started REAL, finished REAL, duration REAL, epochs INTEGER,
+    val_loss REAL, val_loss_train REAL, loss_val REAL, loss_train REAL, best_epoch INTEGER, data_hash TEXT, trainset_hash TEXT, valset_hash TEXT, testset_hash TEXT);
+CREATE TABLE IF NOT EXISTS params (run_id INTEGER, name TEXT, value TEXT, PRIMARY KEY (run_id, name));
+CREATE INDEX IF NOT EXISTS params_value ON params (name, value, run_id);
+CREATE TABLE IF NOT EXISTS metrics (run_id INTEGER, name TEXT, mean REAL, PRIMARY KEY (run_id, name));
+CREATE INDEX IF NOT EXISTS metrics_mean ON metrics (name, mean, run_id);
+CREATE TABLE IF NOT EXISTS metric_values (run_id INTEGER, name TEXT, experiment TEXT, value REAL, PRIMARY KEY (run_id, name, experiment));
+CREATE TABLE IF NOT EXISTS artifacts (run_id INTEGER, kind TEXT, path TEXT, PRIMARY KEY (run_id, kind));
+'''
+
+# Endings of the files that cnn_model.py writes for a run, registered as artifacts if they exist
+artifact_endings = ['_model_params.dat', '_parameter.pth', '_loss.txt', '_pred.txt', '_taylor_importance.txt', '_kernel_ppms.meme', '_kernel_importance.dat', '_kernel_impact.dat', '_exper_corr_tcl0.txt', '_exper_mse_tcl0.txt']
+
+
+# Connection to the registry, path is the sqlite file or a directory that gets runs.sqlite
+def open_registry(path):
+    if os.path.isdir(path) or path.endswith(os.sep):
+        os.makedirs(path, exist_ok = True)
+        path = os.path.join(path, 'runs.sqlite')
+    conn = sqlite3.connect(path, timeout = 120)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(schema)
+    return conn
+
+
+# Hash of arrays, f.e. X and Y of the data set or the indices of the training set
+def data_hash(*arrays):
+    sha = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            continue
+        array = np.ascontiguousarray(array)
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+# Files of a run that exist, artifacts can add other files as {kind: path}
+def run_artifacts(outname, artifacts = None):
+    files = {os.path.splitext(ending)[0].strip('_'): outname+ending for ending in artifact_endings if os.path.isfile(outname+ending)}
+    if artifacts is not None:
+        files.update(artifacts)
+    return files
+
+
+# Registers a run or replaces the run with the same name, run is the base name of the outname
+# params are the hyperparameters, f.e. results_store.model_params(model), saveloss from fit_model,
+# metrics from results_store.class_metrics with the values of every experiment, hashes with keys data, trainset, valset, testset
+def register_run(conn, outname, params, saveloss = None, metrics = None, experiments = None, hashes = None, started = None, finished = None, epochs = None, artifacts = None, command = None):
+    run = os.path.split(outname)[1]
+    if finished is None:
+        finished = time.time()
+    if command is None:
+        command = ' '.join(sys.argv)
+    losses = [None]*5 if saveloss is None else [None if np.isnan(float(s)) else float(s) for s in saveloss]
+    hashes = {} if hashes is None else hashes
+    with conn:
+        old = conn.execute('SELECT run_id FROM runs WHERE run = ?', (run,)).fetchone()
+        if old is not None:
+            for table in ['runs', 'params', 'metrics', 'metric_values', 'artifacts']:
+                conn.execute('DELETE FROM '+table+' WHERE run_id = ?', old)
+        cur = conn.execute('INSERT INTO runs (run, outname, host, command, started, finished, duration, epochs, val_loss, val_loss_train, loss_val, loss_train, best_epoch, data_hash, trainset_hash, valset_hash, testset_hash) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                           (run, outname, socket.gethostname(), command, started, finished, None if started is None else finished - started, None if epochs is None else int(epochs),
+                            losses[0], losses[1], losses[2], losses[3], None if losses[4] is None else int(losses[4]), hashes.get('data'), hashes.get('trainset'), hashes.get('valset'), hashes.get('testset')))
+        run_id = cur.lastrowid
+        conn.executemany('INSERT INTO params VALUES (?,?,?)', [(run_id, str(name), str(value)) for name, value in params.items()])
+        if metrics is not None:
+            if experiments is None:
+                experiments = np.arange(len(list(metrics.values())[0])).astype(str)
+            for name, values in metrics.items():
+                values = np.array(values, dtype = float)
+                valid = ~np.isnan(values)
+                conn.execute('INSERT INTO metrics VALUES (?,?,?)', (run_id, name, float(np.mean(values[valid])) if valid.any() else None))
+                conn.executemany('INSERT INTO metric_values VALUES (?,?,?,?)', [(run_id, name, str(exp), float(value)) for exp, value in zip(np.array(experiments)[valid], values[valid])])
+        conn.executemany('INSERT INTO artifacts VALUES (?,?,?)', [(run_id, kind, path) for kind, path in run_artifacts(outname, artifacts).items()])
+    return run_id
+
+
+# Runs whose name starts with prefix and whose parameters match all filters, sorted by the mean of metric if given
+# filters are values (compared as strings) or lists of allowed values, f.e. query_runs(conn, num_kernels = [100, 200], lr = 0.001)
+# Returns dictionary with arrays run_id, run, outname, and metric if given (runs without the metric are excluded)
+def query_runs(conn, prefix = None, metric = None, descending = False, limit = None, **filters):
+    sql = 'SELECT runs.run_id, runs.run, runs.outname' + (', metrics.mean' if metric is not None else '') + ' FROM runs'
+    args = []
+    if metric is not None:
+        sql += ' JOIN metrics ON metrics.run_id = runs.run_id AND metrics.name = ?'
+        args.append(metric)
+    for f, (name, value) in enumerate(filters.items()):
+        values = [str(v) for v in (value if isinstance(value, (list, tuple, np.ndarray)) else [value])]
+        sql += ' JOIN params AS p'+str(f)+' ON p'+str(f)+'.run_id = runs.run_id AND p'+str(f)+'.name = ? AND p'+str(f)+'.value IN ('+','.join(['?']*len(values))+')'
+        args += [name] + values
+    if prefix is not None:
+        # range on the unique index of run instead of LIKE, which treats _ as wildcard
+        sql += ' WHERE runs.run >= ? AND runs.run < ?'
+        args += [prefix, prefix + chr(0x10ffff)]
+    sql += ' ORDER BY ' + ('metrics.mean' + (' DESC' if descending else '') if metric is not None else 'runs.run')
+    if limit is not None:
+        sql += ' LIMIT ' + str(int(limit))
+    rows = conn.execute(sql, args).fetchall()
+    selected = {'run_id': np.array([row[0] for row in rows], dtype = int), 'run': np.array([row[1] for row in rows], dtype = str), 'outname': np.array([row[2] for row in rows], dtype = str)}
+    if metric is not None:
+        selected['metric'] = np.array([np.nan if row[3] is None else row[3] for row in rows], dtype = float)
+    return selected
+
+
+# Parameters of the runs in run_ids as list of dictionaries, only names if given
+def run_params(conn, run_ids, names = None):
+    params = {int(run_id): {} for run_id in run_ids}
+    if names is None:
+        rows = chunked_select(conn, 'SELECT run_id, name, value FROM params', run_ids)
+    else:
+        names = [str(name) for name in names]
+        rows = chunked_select(conn, 'SELECT run_id, name, value FROM params', run_ids, 'name IN (' + ','.join(['?']*len(names)) + ')', names)
+    for run_id, name, value in rows:
+        params[run_id][name] = value
+    return [params[int(run_id)] for run_id in run_ids]
+
+
+# Values of metric for every experiment of the runs in run_ids, experiments are sorted
+def run_metric(conn, run_ids, metric):
+    performance = {int(run_id): [] for run_id in run_ids}
+    experiments = {int(run_id): [] for run_id in run_ids}
+    for run_id, experiment, value in chunked_select(conn, 'SELECT run_id, experiment, value FROM metric_values', run_ids, 'name = ?', [metric], order = 'experiment'):
+        performance[run_id].append(value)
+        experiments[run_id].append(experiment)
+    return [np.array(performance[int(run_id)]) for run_id in run_ids], [np.array(experiments[int(run_id)], dtype = str) for run_id in run_ids]
+
+
+# Files of the runs in run_ids as list of dictionaries {kind: path}
+def run_files(conn, run_ids):
+    files = {int(run_id): {} for run_id in run_ids}
+    for run_id, kind, path in chunked_select(conn, 'SELECT run_id, kind, path FROM artifacts', run_ids):
+        files[run_id][kind] = path
+    return [files[int(run_id)] for run_id in run_ids]
+
+
+# Rows of sql for run_ids in chunks below the limit of sqlite for variables in one statement
+def chunked_select(conn, sql, run_ids, where = None, args = [], order = None, chunk = 500):
+    rows = []
+    run_ids = [int(run_id) for run_id in run_ids]
+    for c in range(0, len(run_ids), chunk):
+        ids = run_ids[c:c+chunk]
+        query = sql + ' WHERE run_id IN (' + ','.join(['?']*len(ids)) + ')' + ('' if where is None else ' AND ' + where) + ('' if order is None else ' ORDER BY ' + order)
+        rows += conn.execute(query, ids + list(args)).fetchall()
+    return rows
+
+
+if __name__ == '__main__':
+    # python run_registry.py runs.sqlite prefix --metric exper_corr_tcl0 --select num_kernels=100,200+lr=0.001 --limit 20
+    conn = open_registry(sys.argv[1])
+    prefix = sys.argv[2] if len(sys.argv) > 2 and '--' not in sys.argv[2] else None
+    metric, limit, filters = None, None, {}
+    if '--metric' in sys.argv:
+        metric = sys.argv[sys.argv.index('--metric')+1]
+    if '--limit' in sys.argv:
+        limit = int(sys.argv[sys.argv.index('--limit')+1])
+    if '--select' in sys.argv:
+        for sel in sys.argv[sys.argv.index('--select')+1].split('+'):
+            filters[sel.split('=')[0]] = sel.split('=',1)[1].split(',')
+    selected = query_runs(conn, prefix = prefix, metric = metric, descending = '--descending' in sys.argv, limit = limit, **filters)
+    for r, run in enumerate(selected['run']):
+        print(r+1, selected['metric'][r] if metric is not None else '', selected['outname'][r])
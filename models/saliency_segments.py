@@ -0,0 +1,87 @@
+# saliency_segments.py
+# Segments of saliency maps that represent motifs, for a whole batch of saliency maps (N, L, 4) at once
+# Positions are motif positions if the absolute z-score of their summed saliency is >= z_cut.
+# A segment starts at a motif position and takes its sign, every position with another sign (or no motif position)
+# is a gap. At the second gap the segment ends before it; it is kept if it has at least min_mot positions with its sign,
+# and the search continues at the second gap. Otherwise the search restarts after the first gap.
+# Segments that reach the end of the sequence before their second gap are not kept.
+# Instead of walking through every position, the next gap of every position is found with run-length encoding
+# of the signs, so that every step jumps from one segment to the next for all sequences at once.
+import numpy as np
+import sys, os
+
+
+# z-scores of the summed saliency (N, L) and the saliency maps normalized by the same mean and std
+# mean_sal None uses the mean of every map, otherwise deviations are measured from mean_sal
+def saliency_zscores(saliency, mean_sal = 0):
+    saliency = np.array(saliency, dtype = float)
+    if saliency.ndim == 2:
+        saliency = saliency[None]
+    summed = np.sum(saliency, axis = 2)
+    if mean_sal is None:
+        mean_sal = np.mean(summed, axis = 1)
+        std_sal = np.std(summed, axis = 1)
+    else:
+        mean_sal = np.ones(len(summed)) * mean_sal
+        std_sal = np.sqrt(np.mean((summed - mean_sal[:, None])**2, axis = 1))
+    zscore_sal = (summed - mean_sal[:, None])/std_sal[:, None]
+    saliency = (saliency - mean_sal[:, None, None])/std_sal[:, None, None]
+    return zscore_sal, saliency
+
+
+# Index of the next position >= i where mask is True for every position of every row, L if there is none (N, L+2)
+def next_true(mask):
+    n, l = np.shape(mask)
+    index = np.where(mask, np.arange(l)[None, :], l)
+    index = np.concatenate([index, np.ones((n, 2), dtype = int)*l], axis = 1)
+    return np.minimum.accumulate(index[:, ::-1], axis = 1)[:, ::-1]
+
+
+# Start and end of all segments in zsign (N, L) with values -1, 0, 1
+# Returns the sequence, start and end (inclusive) of every segment, ordered by sequence and start
+def segment_runs(zsign, min_mot = 5):
+    zsign = np.nan_to_num(np.array(zsign, dtype = float)).astype(int)
+    if zsign.ndim == 1:
+        zsign = zsign[None]
+    n, l = np.shape(zsign)
+    # run-length encoding of the signs, runend is the last position of the run that every position belongs to
+    change = np.ones((n, l), dtype = bool)
+    change[:, 1:] = np.diff(zsign, axis = 1) != 0
+    runend = next_true(np.concatenate([change[:, 1:], np.ones((n, 1), dtype = bool)], axis = 1))[:, :l]
+    # next position with a different sign than + or -, and next motif position
+    nextgap = {1: next_true(zsign != 1), -1: next_true(zsign != -1)}
+    nextmotif = next_true(zsign != 0)
+    rows = np.arange(n)
+    start = nextmotif[:, 0]
+    seqs, starts, ends = [], [], []
+    active = start < l
+    while active.any():
+        r, s = rows[active], start[active]
+        sig = zsign[r, s]
+        # first gap is after the run of the start, second gap the next position with another sign after it
+        gap1 = runend[r, s] + 1
+        gap2 = np.where(sig == 1, nextgap[1][r, np.minimum(gap1+1, l)], nextgap[-1][r, np.minimum(gap1+1, l)])
+        gap2[gap1 >= l] = l
+        keep = (gap2 < l) & (gap2 - s - 1 >= min_mot)
+        seqs.append(r[keep])
+        starts.append(s[keep])
+        ends.append(gap2[keep] - 1)
+        restart = np.where(keep, gap2, np.minimum(gap1 + 1, l))
+        start[active] = np.where(gap2 < l, nextmotif[r, restart], l)
+        active = start < l
+    if len(seqs) == 0:
+        return np.array([], dtype = int), np.array([], dtype = int), np.array([], dtype = int)
+    seqs, starts, ends = np.concatenate(seqs), np.concatenate(starts), np.concatenate(ends)
+    order = np.lexsort((starts, seqs))
+    return seqs[order], starts[order], ends[order]
+
+
+# Segments of all saliency maps (N, L, 4), returns a list with the starts and ends of every map, and the normalized maps
+def find_segments(saliency, z_cut = 1.3, min_mot = 5, mean_sal = 0):
+    zscore_sal, saliency = saliency_zscores(saliency, mean_sal = mean_sal)
+    potmotifs = np.absolute(zscore_sal) >= z_cut
+    zsign = np.where(potmotifs, np.sign(zscore_sal), 0)
+    seqs, starts, ends = segment_runs(zsign, min_mot = min_mot)
+    bounds = np.searchsorted(seqs, np.arange(len(saliency)+1))
+    segments = [[list(starts[bounds[i]:bounds[i+1]]), list(ends[bounds[i]:bounds[i+1]])] for i in range(len(saliency))]
+    return segments, saliency
@@ -0,0 +1,364 @@
+# search_strategies.py
+# Search strategies for hyperparameter_search.py that decide which configurations are trained and for how long,
+# jobs are trained with the job_pool of job_scheduler.py
+# Asynchronous successive halving (ASHA): all configurations start with a budget of min_epochs, configurations in the
+# top 1/eta of a rung are promoted to eta times more epochs as soon as enough results are in the rung,
+# and configurations that are never promoted are stopped. Training is resumed with the epoch_budget of fit_model.
+# Tree-structured Parzen estimator (TPE): configurations are sampled where the densities of the best finished trials
+# are large compared to the densities of the other trials, with a fixed budget of trials.
+# Population-based training (PBT): a population is trained in segments of epochs, weak members copy the weights of strong
+# members and continue with perturbed hyperparameters.
+import numpy as np
+import sys, os
+import torch
+
+
+# Epoch budgets of all rungs, the last rung trains up to max_epochs
+def rung_budgets(min_epochs, eta = 3, max_epochs = 1000):
+    budgets = [int(min_epochs)]
+    while budgets[-1]*eta < max_epochs:
+        budgets.append(int(budgets[-1]*eta))
+    if budgets[-1] < max_epochs:
+        budgets.append(int(max_epochs))
+    return budgets
+
+
+# Loss of a result that is used to rank configurations in a rung, failed runs are last
+def result_loss(result):
+    if not result['success'] or result['saveloss'] is None or np.isnan(result['saveloss'][0]):
+        return np.inf
+    return float(result['saveloss'][0])
+
+
+# Validation loss of the weights that a paused result continues from, the loss of its last epoch,
+# results that are not paused are ranked by the loss of their best epoch
+def current_loss(result):
+    if not result['success'] or not result.get('paused', False) or result.get('last_loss') is None:
+        return result_loss(result)
+    if np.isnan(result['last_loss']):
+        return np.inf
+    return float(result['last_loss'])
+
+
+# Removes the files that a stopped configuration keeps to resume training
+def remove_resume_files(outname, keepmodel = False):
+    if outname is None:
+        return
+    endings = ['_checkpoint.pth', '_params0.pth']
+    if not keepmodel:
+        endings.append('_parameter.pth')
+    for ending in endings:
+        if os.path.isfile(outname+ending):
+            os.remove(outname+ending)
+
+
+# Trains jobs (list of dictionaries with id = index in jobs) with asynchronous successive halving in pool
+# on_final(result) is called once for every configuration with its last result,
+# tablefile collects every finished rung as: id rung epochs loss
+# Returns the final results of all configurations
+def successive_halving(pool, jobs, min_epochs, eta = 3, max_epochs = 1000, tablefile = None, on_final = None, n_slots = None):
+    budgets = rung_budgets(min_epochs, eta = eta, max_epochs = max_epochs)
+    if n_slots is None:
+        n_slots = max(1, pool.n_workers)
+    rung_losses = [{} for b in budgets]
+    promoted = [set() for b in budgets]
+    last_result, final, current_rung = {}, {}, {}
+    waiting = set()
+    next_job, running = 0, 0
+    if tablefile is not None:
+        table = open(tablefile, 'w')
+        table.write('# id rung epochs loss\n')
+
+    def finish(result):
+        final[result['id']] = result
+        if on_final is not None:
+            on_final(result)
+
+    def submit(j, rung):
+        job = dict(jobs[j])
+        job['fit_kwargs'] = dict(job.get('fit_kwargs', {}))
+        job['fit_kwargs']['epoch_budget'] = budgets[rung]
+        current_rung[j] = rung
+        pool.submit(job)
+
+    # Configuration in the top 1/eta of the highest possible rung that has not been promoted yet
+    def promotable():
+        for r in range(len(budgets)-2, -1, -1):
+            n_top = int(len(rung_losses[r])/eta)
+            if n_top == 0:
+                continue
+            ids = np.array(list(rung_losses[r].keys()))
+            losses = np.array([rung_losses[r][i] for i in ids])
+            for i in ids[np.argsort(losses, kind = 'stable')[:n_top]]:
+                if i not in promoted[r] and i in waiting:
+                    return i, r
+        return None, None
+
+    while True:
+        # fill all free slots with promotions first and new configurations second
+        while running < n_slots:
+            j, r = promotable()
+            if j is not None:
+                promoted[r].add(j)
+                waiting.discard(j)
+                submit(j, r+1)
+            elif next_job < len(jobs):
+                submit(next_job, 0)
+                next_job += 1
+            else:
+                break
+            running += 1
+        if running == 0:
+            break
+        result = pool.get()
+        running -= 1
+        j = result['id']
+        rung = current_rung[j]
+        loss = result_loss(result)
+        rung_losses[rung][j] = loss
+        last_result[j] = result
+        if tablefile is not None:
+            table.write(str(j)+' '+str(rung)+' '+str(result.get('epochs'))+' '+str(loss)+'\n')
+            table.flush()
+        if not result['success'] or not result.get('paused', False) or rung == len(budgets)-1:
+            # failed, early stopped or trained with the full budget
+            finish(result)
+        else:
+            waiting.add(j)
+
+    # configurations that were not promoted are stopped with their last result
+    for j in sorted(waiting):
+        remove_resume_files(last_result[j]['outname'], keepmodel = jobs[j]['params'].get('keepmodel', False))
+        finish(last_result[j])
+    if tablefile is not None:
+        table.close()
+    return [final[j] for j in sorted(final)]
+
+
+# Parzen estimate of the probabilities of the values of one parameter from the indices of observed values
+# Numeric parameters are smoothed with a gaussian kernel over neighbouring values in the list, all others are categorical
+# Every value keeps a prior weight of one observation spread uniformly
+def parzen_probabilities(indices, n_values, ordinal = False, bandwidth = 1.):
+    probs = np.ones(n_values)/n_values
+    if len(indices) == 0:
+        return probs
+    if ordinal:
+        kernel = np.exp(-0.5*((np.arange(n_values)[None, :] - np.array(indices)[:, None])/bandwidth)**2)
+        kernel = kernel/np.sum(kernel, axis = 1)[:, None]
+        counts = np.sum(kernel, axis = 0)
+    else:
+        counts = np.bincount(indices, minlength = n_values).astype(float)
+    return (counts + probs)/(len(indices) + 1.)
+
+
+# Parameter values that can be ordered, i.e. all are numbers but not booleans
+def is_ordinal(values):
+    return all([isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_)) for v in values]) and len(values) > 2
+
+
+# Tree-structured Parzen estimator (TPE) over space, dictionary of parameter names with lists of values as in --hyper_parameter
+# The first n_startup configurations are sampled at random, afterwards the finished trials are split into the gamma best (good)
+# and the rest (bad), n_candidates configurations are sampled from the densities of the good trials and the candidate with the
+# largest ratio of good to bad density is trained next. Trials are submitted asynchronously to all slots of the pool, so that
+# every proposal uses all results that are finished at that time. Configurations are not trained twice.
+# make_job(config) returns the job for a configuration (dictionary with one value per parameter), including a unique id
+# jobs: additional jobs, f.e. the reference model, that are trained first but not used by the model
+# tablefile collects every trial as: id loss and the values of all parameters
+# Returns the configurations and the results of all trials in the order in which they finished
+def tpe_search(pool, space, make_job, n_trials, n_startup = 10, gamma = 0.25, n_candidates = 64, seed = None, jobs = None, tablefile = None, on_final = None, n_slots = None):
+    rng = np.random.RandomState(seed)
+    keys = list(space.keys())
+    n_values = np.array([len(space[key]) for key in keys])
+    ordinal = [is_ordinal(space[key]) for key in keys]
+    n_trials = int(min(n_trials, np.prod(n_values.astype(float))))
+    if n_slots is None:
+        n_slots = max(1, pool.n_workers)
+    trials, finished = {}, []
+    tried = set()
+    observed, losses = [], []
+    running = 0
+    if tablefile is not None:
+        table = open(tablefile, 'w')
+        table.write('# id loss '+' '.join(keys)+'\n')
+    
+    if jobs is not None:
+        for job in jobs:
+            pool.submit(job)
+            running += 1
+    
+    # Next configuration as indices into the value lists of all parameters
+    def propose():
+        if len(observed) < n_startup:
+            candidates = np.array([rng.randint(0, n, n_candidates) for n in n_values]).T
+            scores = rng.random_sample(n_candidates)
+        else:
+            order = np.argsort(losses, kind = 'stable')
+            n_good = max(1, int(np.ceil(gamma*len(order))))
+            good, bad = np.array(observed)[order[:n_good]], np.array(observed)[order[n_good:]]
+            candidates, scores = [], np.zeros(n_candidates)
+            for k, n in enumerate(n_values):
+                lgood = parzen_probabilities(good[:, k], n, ordinal = ordinal[k])
+                lbad = parzen_probabilities(bad[:, k], n, ordinal = ordinal[k])
+                candidates.append(rng.choice(n, n_candidates, p = lgood))
+                scores += np.log(lgood[candidates[-1]]) - np.log(lbad[candidates[-1]])
+            candidates = np.array(candidates).T
+        for c in np.argsort(-scores, kind = 'stable'):
+            if tuple(candidates[c]) not in tried:
+                return tuple(candidates[c])
+        # all candidates were tried already, the next untried configuration is taken at random
+        while True:
+            candidate = tuple([rng.randint(0, n) for n in n_values])
+            if candidate not in tried:
+                return candidate
+    
+    while True:
+        while running < n_slots and len(tried) < n_trials:
+            candidate = propose()
+            tried.add(candidate)
+            config = {key: space[key][i] for key, i in zip(keys, candidate)}
+            job = make_job(config)
+            trials[job['id']] = (candidate, config)
+            pool.submit(job)
+            running += 1
+        if running == 0:
+            break
+        result = pool.get()
+        running -= 1
+        if result['id'] in trials:
+            candidate, config = trials[result['id']]
+            loss = result_loss(result)
+            # failed trials are ranked behind all finished trials
+            observed.append(candidate)
+            losses.append(loss if np.isfinite(loss) else np.inf)
+            finished.append([config, result])
+            if tablefile is not None:
+                table.write(str(result['id'])+' '+str(loss)+' '+' '.join([str(config[key]) for key in keys])+'\n')
+                table.flush()
+        if on_final is not None:
+            on_final(result)
+    if tablefile is not None:
+        table.close()
+    return finished
+
+
+# New configuration from config by moving every parameter to a neighbouring value in its list of space,
+# or with probability resample to a random value
+def perturb_config(config, space, rng, resample = 0.25):
+    nconfig = dict(config)
+    for key, values in space.items():
+        if len(values) < 2:
+            continue
+        if rng.random_sample() < resample:
+            nconfig[key] = values[rng.randint(len(values))]
+        else:
+            i = [str(v) for v in values].index(str(config[key]))
+            nconfig[key] = values[int(np.clip(i + rng.choice([-1, 1]), 0, len(values)-1))]
+    return nconfig
+
+
+# Population-based training (PBT): n_members configurations from space are trained in segments of interval epochs
+# with the epoch_budget of fit_model. When a member finishes a segment and its validation loss is in the bottom fraction
+# of the latest losses of the population, it copies the weights of a random member in the top fraction (exploit) and
+# continues with perturbed hyperparameters of that member (explore). Members are ranked by the validation loss of their
+# last epoch, the loss of the checkpoint weights that donors hand over, and finished members by their best loss. Weights are loaded with init.load_parameters
+# with allow_reduction, so that tensors of members with different sizes are sliced.
+# make_job(config) returns the job for a configuration with a unique id that is also part of its outname, so that
+# jobs never share files or checkpoints. Members stop after max_epochs or when their training stops early.
+# on_final(result) is called for the last result of every job, tablefile collects: member id epochs loss donor
+# Returns the final results of all members
+def population_based_training(pool, space, make_job, n_members, interval, max_epochs = 1000, fraction = 0.25, resample = 0.25, seed = None, tablefile = None, on_final = None, n_slots = None):
+    rng = np.random.RandomState(seed)
+    keys = list(space.keys())
+    if n_slots is None:
+        n_slots = max(1, pool.n_workers)
+    used = set()
+    members = []
+    if tablefile is not None:
+        table = open(tablefile, 'w')
+        table.write('# member id epochs loss donor\n')
+    
+    # Random configurations of the initial population differ from each other, perturbed configurations
+    # may repeat a configuration because every job has its own files
+    def new_config(config = None):
+        if config is not None:
+            return perturb_config(config, space, rng, resample = resample)
+        for i in range(100):
+            nconfig = {key: space[key][rng.randint(len(space[key]))] for key in keys}
+            if str(nconfig) not in used:
+                used.add(str(nconfig))
+                return nconfig
+        return None
+    
+    # a member trains its current job from offset epochs on, epochs is the total number of epochs of the member
+    def submit(m):
+        job = dict(members[m]['job'])
+        job['fit_kwargs'] = dict(job.get('fit_kwargs', {}))
+        job['fit_kwargs']['epoch_budget'] = int(min(max_epochs, members[m]['epochs'] + interval) - members[m]['offset'])
+        pool.submit(job)
+    
+    for m in range(n_members):
+        config = new_config()
+        if config is None:
+            break
+        members.append({'config': config, 'job': make_job(config), 'offset': 0, 'epochs': 0, 'loss': None, 'result': None, 'done': False})
+    jobmember = {member['job']['id']: m for m, member in enumerate(members)}
+    
+    queue, running = list(range(len(members))), 0
+    while True:
+        while running < n_slots and len(queue) > 0:
+            submit(queue.pop(0))
+            running += 1
+        if running == 0:
+            break
+        result = pool.get()
+        running -= 1
+        m = jobmember[result['id']]
+        member = members[m]
+        if member['job'].get('init_parameters') is not None and os.path.isfile(member['job']['init_parameters']):
+            os.remove(member['job']['init_parameters'])
+            member['job']['init_parameters'] = None
+        member['result'], member['loss'] = result, current_loss(result)
+        donor = None
+        if result['success'] and result.get('epochs') is not None:
+            member['epochs'] = member['offset'] + result['epochs']
+        if tablefile is not None:
+            table.write(str(m)+' '+str(result['id'])+' '+str(member['epochs'])+' '+str(member['loss'])+'\n')
+            table.flush()
+        if not result['success'] or not result.get('paused', False) or member['epochs'] >= max_epochs:
+            # failed, early stopped or trained with all epochs
+            member['done'] = True
+            if result.get('paused', False):
+                remove_resume_files(result['outname'], keepmodel = member['job']['params'].get('keepmodel', False))
+            if on_final is not None:
+                on_final(result)
+            continue
+        
+        # exploit: members in the bottom fraction copy a member of the top fraction
+        reported = np.array([i for i, other in enumerate(members) if other['loss'] is not None])
+        losses = np.array([members[i]['loss'] for i in reported])
+        n_cut = int(np.floor(fraction*len(reported)))
+        if n_cut > 0:
+            order = reported[np.argsort(losses, kind = 'stable')]
+            top = [i for i in order[:n_cut] if i != m and members[i]['result'] is not None and members[i]['result']['success']]
+            if m in order[-n_cut:] and len(top) > 0:
+                donor = top[rng.randint(len(top))]
+                checkpoint = members[donor]['result']['outname']+'_checkpoint.pth'
+                config = new_config(members[donor]['config'])
+                if config is not None and os.path.isfile(checkpoint):
+                    # explore: the perturbed configuration of the donor starts from the donor's current weights
+                    job = make_job(config)
+                    job['init_parameters'] = members[donor]['result']['outname']+'_pbt'+str(job['id'])+'.pth'
+                    torch.save(torch.load(checkpoint, map_location = 'cpu', weights_only = False)['model'], job['init_parameters'])
+                    remove_resume_files(result['outname'], keepmodel = member['job']['params'].get('keepmodel', False))
+                    if on_final is not None:
+                        on_final(result)
+                    member['config'], member['job'], member['offset'] = config, job, member['epochs']
+                    jobmember[job['id']] = m
+                    if tablefile is not None:
+                        table.write(str(m)+' '+str(job['id'])+' '+str(member['epochs'])+' nan '+str(donor)+'\n')
+                        table.flush()
+        queue.append(m)
+    
+    if tablefile is not None:
+        table.close()
+    return [member['result'] for member in members]
@@ -0,0 +1,271 @@
+# seed_ensemble.py
+# Trains several cnn models of the same architecture, f.e. with different seeds to assess the reproducibility of kernels,
+# as one vectorized ensemble in a single training loop.
+# The parameters and buffers of all members are stacked along a new first dimension and the forward pass of all members
+# is one call of torch.func.vmap, so that every batch is drawn, augmented and sent to the device only once and one
+# optimizer step updates all members. Small models that cannot use all cores alone gain the most.
+# Early stopping is tracked for every member with its own stop_criterion; members that stopped do not contribute
+# to the loss anymore. At the end every member gets its best parameters, saveloss, _loss.txt and, with keepmodel,
+# _parameter.pth as if it was trained on its own with fit_model.
+# The learning rate reductions of init_adjust and the restart option of fit_model are not used, members with nan loss stop.
+import numpy as np
+import sys, os
+import copy
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torch.func import stack_module_state, functional_call, vmap
+from init import MyDataset
+from modules import loss_dict
+from train import pwm_scan, save_model, save_losses, stop_criterion, get_optimizer, shift_sequences, reverse_inoutsign, smooth_onehotfunc
+
+
+# Members as one module: forward returns the predictions of all members (n_members, N, n_classes)
+class vmap_ensemble(nn.Module):
+    def __init__(self, models):
+        super(vmap_ensemble, self).__init__()
+        shapes = [[(name, tuple(tensor.size())) for name, tensor in model.state_dict().items()] for model in models]
+        for s, shape in enumerate(shapes[1:]):
+            if shape != shapes[0]:
+                print('Model', s+1, 'has a different architecture than model 0')
+                sys.exit()
+        self.n_members = len(models)
+        self.keys = list(models[0].state_dict().keys())
+        params, buffers = stack_module_state(models)
+        self.param_names = list(params.keys())
+        self.params = nn.ParameterList([nn.Parameter(params[name].detach(), requires_grad = params[name].requires_grad) for name in self.param_names])
+        # buffers are registered with their index because names with dots are not allowed
+        self.buffer_names = list(buffers.keys())
+        for b, name in enumerate(self.buffer_names):
+            self.register_buffer('buffer'+str(b), buffers[name].detach())
+        # the copy of the first model only provides the forward function and is not a submodule
+        self.base = [copy.deepcopy(models[0])]
+
+    def train(self, mode = True):
+        super(vmap_ensemble, self).train(mode)
+        self.base[0].train(mode)
+        return self
+
+    # moves and casts the copy of the first model with the ensemble, also if the ensemble is a submodule
+    def _apply(self, fn, *args, **kwargs):
+        super(vmap_ensemble, self)._apply(fn, *args, **kwargs)
+        self.base[0]._apply(fn, *args, **kwargs)
+        return self
+
+    def stacked_buffers(self):
+        return {name: getattr(self, 'buffer'+str(b)) for b, name in enumerate(self.buffer_names)}
+
+    def forward(self, x, xadd = None):
+        params = dict(zip(self.param_names, self.params))
+        def member_forward(params, buffers, x, xadd):
+            return functional_call(self.base[0], (params, buffers), (x,), {'xadd': xadd})
+        # dropout draws different masks for every member
+        return vmap(member_forward, in_dims = (0, 0, None, None), randomness = 'different')(params, self.stacked_buffers(), x, xadd)
+
+    # Stacked copies of all parameters and buffers
+    def stacked_state(self):
+        state = dict(zip(self.param_names, self.params))
+        state.update(self.stacked_buffers())
+        return {name: tensor.detach().clone() for name, tensor in state.items()}
+
+    # State dict of member m from the stacked state
+    def member_state(self, m, state = None):
+        if state is None:
+            state = self.stacked_state()
+        return OrderedDict([(name, state[name][m].cpu()) for name in self.keys if name in state])
+
+
+# Collects the per member losses of one epoch over dataloader, with take_grad the active members are trained
+# Returns the loss of every member and its validation loss from the predictions of the non-augmented samples
+def ensemble_epoch(ensemble, dataloader, loss_func, val_loss, pwm_out, normsize, yclasses, take_grad, device, val_all, active = None, optimizer = None, sample_weights = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, reverse_sign = False, shift_back = None, random_shift = False, smooth_onehot = 0):
+    n_members = ensemble.n_members
+    trainloss = np.zeros(n_members)
+    Ypred_all = torch.empty((n_members,) + tuple(val_all.size()))
+    tsize = 1
+    if shift_back is not None:
+        if random_shift:
+            tsize = tsize + tsize*2
+        else:
+            tsize = tsize + tsize*2*len(shift_back)
+    if reverse_sign:
+        tsize = tsize*2
+    if smooth_onehot > 0:
+        tsize = tsize *(smooth_onehot +1)
+
+    for sample_x, sample_y, index in dataloader:
+        saddx = None if pwm_out is None else pwm_out[index]
+        # same augmentations as excute_epoch
+        if shift_back is not None:
+            sample_x = shift_sequences(sample_x, shift_back, random_shift = random_shift)
+            nshift = 3 if random_shift else (len(shift_back)+1)*2-1
+            sample_y = torch.cat(nshift*[sample_y])
+            if saddx is not None:
+                saddx = saddx.repeat(nshift, 1, 1)
+        if reverse_sign:
+            sample_x, sample_y = reverse_inoutsign(sample_x), reverse_inoutsign(sample_y)
+            if saddx is not None:
+                saddx = reverse_inoutsign(saddx)
+        if smooth_onehot > 0:
+            sample_x = smooth_onehotfunc(sample_x, ns = smooth_onehot)
+            sample_y = torch.cat((smooth_onehot+1)* [sample_y])
+            if saddx is not None:
+                saddx = saddx.repeat(smooth_onehot +1, 1, 1)
+        if saddx is not None:
+            saddx = saddx.to(device)
+        sample_x, sample_y = sample_x.to(device), sample_y.to(device)
+
+        with torch.set_grad_enabled(take_grad):
+            Ypred = ensemble(sample_x, xadd = saddx)
+            losses = []
+            for m in range(n_members):
+                loss = loss_func(Ypred[m], sample_y)
+                if sample_weights is not None:
+                    loss = loss*sample_weights[index][:,None].to(device)
+                losses.append(torch.sum(loss))
+            losses = torch.stack(losses)
+        trainloss += losses.detach().cpu().numpy()
+
+        if take_grad:
+            optimizer.zero_grad()
+            mask = torch.as_tensor(active).to(device)
+            loss = torch.sum(losses[mask])
+            # penalties of every member from its own slice of the stacked tensors
+            for name, tensor in zip(ensemble.param_names, ensemble.params):
+                dims = tuple(range(1, tensor.dim()))
+                if 'classifier' in name and 'weight' in name:
+                    if l1reg_last > 0:
+                        loss += l1reg_last * torch.sum(torch.abs(tensor).mean(dim = dims)[mask])
+                    if l2reg_last > 0:
+                        loss += l2reg_last * torch.sum(torch.square(tensor).mean(dim = dims)[mask])
+                if l1_kernel > 0 and 'convolutions.weight' in name:
+                    loss += l1_kernel * torch.sum(torch.abs(tensor).mean(dim = dims)[mask])
+            loss.backward()
+            optimizer.step()
+
+        Ypred_all[:, index] = Ypred[:, :len(index)].detach().cpu()
+
+    with torch.no_grad():
+        validatloss = np.array([float(torch.sum(val_loss(Ypred_all[m], val_all)).item()) for m in range(n_members)])
+    trainloss /= (normsize*tsize)*yclasses
+    validatloss /= normsize*yclasses
+    return trainloss, validatloss
+
+
+# Trains the cnn models in members together on the same batches, with the training settings of the first member
+# Every member keeps its own outname, the parameters of the members are replaced by their best parameters
+# pwm_out and pwm_outval are the pwm scans of X and XYval if the members use fixed_kernels
+# Options of fit_model that are not implemented for ensembles, in kwargs or the kwargs of the models, stop the run
+def fit_ensemble(members, X, Y, XYval = None, sample_weights = None, pwm_out = None, pwm_outval = None, verbose = None, **kwargs):
+    model = members[0]
+    n_members = len(members)
+    for member in members:
+        options = dict(member.kwargs, **kwargs)
+        unsupported = [key for key in ['taylor_epochs', 'epoch_budget', 'checkpoint_minutes', 'multiple_input'] if options.get(key)]
+        if len(unsupported) > 0:
+            print(', '.join(unsupported), 'not supported for ensembles of models')
+            sys.exit()
+    device, batchsize = model.device, model.batchsize
+    if verbose is None:
+        verbose = model.verbose
+    shift_back = model.shift_sequence
+    if isinstance(shift_back, int):
+        shift_back = np.arange(1,shift_back+1) if shift_back > 0 else None
+
+    loss_func = loss_dict[model.loss_function]
+    val_loss = loss_func if model.validation_loss is None else loss_dict[model.validation_loss]
+
+    fixed_kernels = getattr(model, 'fixed_kernels', None)
+    if fixed_kernels is not None and pwm_out is None:
+        pwm_out = pwm_scan(X, fixed_kernels, targetlen = model.l_kernels, verbose = verbose, motif_cutoff = model.motif_cutoff)
+    if XYval is None:
+        XYval, pwm_outval = [X, Y], pwm_out
+    elif fixed_kernels is not None and pwm_outval is None:
+        pwm_outval = pwm_scan(XYval[0], fixed_kernels, targetlen = model.l_kernels, verbose = verbose, motif_cutoff = model.motif_cutoff)
+    if pwm_out is not None:
+        pwm_out, pwm_outval = torch.Tensor(pwm_out), torch.Tensor(pwm_outval)
+
+    trainsize = float(len(X)) if sample_weights is None else np.sum(sample_weights)
+    valsize = float(len(XYval[0]))
+    if sample_weights is not None:
+        sample_weights = torch.Tensor(sample_weights)
+    X, Y = torch.Tensor(X), torch.Tensor(Y)
+    Xval, Yval = torch.Tensor(XYval[0]), torch.Tensor(XYval[1])
+    yclasses = model.n_classes
+    if getattr(model, 'l_out', None) is not None:
+        yclasses *= model.l_out
+
+    if batchsize is None:
+        batchsize = len(X)
+    mindata = 10 # minimum left data points for last batch to not be dropped
+    dataloader = DataLoader(MyDataset(X, Y), batch_size = batchsize, shuffle = True, drop_last = len(Y)%batchsize < mindata)
+    val_batchsize = int(min(batchsize, len(Yval)))
+    val_dataloader = DataLoader(MyDataset(Xval, Yval), batch_size = val_batchsize, shuffle = False)
+
+    ensemble = vmap_ensemble(members)
+    ensemble.to(device)
+    # kernel_lr is used for the convolutions like in fit_model
+    a_dict = []
+    for name, tensor in zip(ensemble.param_names, ensemble.params):
+        a_lr = model.kernel_lr if model.kernel_lr is not None and 'convolutions' in name.split('.') else model.lr
+        a_dict.append({'params': tensor, 'lr': a_lr})
+    optimizer = get_optimizer(a_dict, model.optimizer, model.lr, optim_params = model.optim_params)
+    augment = {'reverse_sign': model.reverse_sign, 'shift_back': shift_back, 'random_shift': model.random_shift, 'smooth_onehot': model.smooth_onehot}
+    regularize = {'l1reg_last': model.l1reg_last, 'l2reg_last': model.l2reg_last, 'l1_kernel': model.l1_kernel}
+
+    def validate():
+        ensemble.eval()
+        lossorigval, lossval = ensemble_epoch(ensemble, val_dataloader, loss_func, val_loss, pwm_outval, valsize, yclasses, False, device, Yval, shift_back = shift_back)
+        ensemble.train()
+        return lossorigval, lossval
+
+    lossorigval, lossval = validate()
+    best = ensemble.stacked_state()
+    trainloss, loss2 = ensemble_epoch(ensemble, dataloader, loss_func, val_loss, pwm_out, trainsize, yclasses, False, device, Y, sample_weights = sample_weights, **augment)
+    saveloss = [[lossval[m], loss2[m], lossorigval[m], trainloss[m], 0] for m in range(n_members)]
+    stopcriteria = [stop_criterion(model.checkval, model.patience) for m in range(n_members)]
+    for m in range(n_members):
+        stopcriteria[m](0, lossval[m])
+        if model.writeloss:
+            save_losses(members[m].outname+'_loss.txt', 0, str(round(lossorigval[m],4))+'\t'+str(round(lossval[m],4))+'\t'+str(round(trainloss[m],4))+'\t'+str(round(loss2[m],4)))
+    if verbose:
+        print('Training', n_members, 'members, Val_loss(val) of every member')
+        print(0, ' '.join(np.around(lossval, 4).astype(str)))
+
+    active = np.ones(n_members, dtype = bool)
+    stopped = np.zeros(n_members, dtype = int)
+    e = 0
+    while active.any():
+        trainloss, loss2 = ensemble_epoch(ensemble, dataloader, loss_func, val_loss, pwm_out, trainsize, yclasses, True, device, Y, active = active, optimizer = optimizer, sample_weights = sample_weights, **augment, **regularize)
+        e += 1
+        lossorigval, lossval = validate()
+        improved = []
+        for m in np.where(active)[0]:
+            if model.writeloss and (e%model.write_steps == 0 or e < model.init_epochs):
+                save_losses(members[m].outname+'_loss.txt', e, str(round(lossorigval[m],4))+'\t'+str(round(lossval[m],4))+'\t'+str(round(trainloss[m],4))+'\t'+str(round(loss2[m],4)))
+            early_stop, stopexp = stopcriteria[m](e, lossval[m])
+            stop = e == model.epochs or (early_stop and e > model.init_epochs) or np.isnan(trainloss[m])
+            if (~np.isnan(lossval[m]) and (lossval[m] < saveloss[m][0] or np.isnan(saveloss[m][0]))) or (stop and not model.load_previous):
+                saveloss[m] = [lossval[m], loss2[m], lossorigval[m], trainloss[m], e]
+                improved.append(m)
+            if stop:
+                active[m] = False
+                stopped[m] = e
+                if verbose:
+                    print('Member', m, 'stopped at', e, stopexp if early_stop else '', 'with best loss', saveloss[m][0], 'from epoch', saveloss[m][-1])
+        if len(improved) > 0:
+            state = ensemble.stacked_state()
+            for name in best:
+                best[name][improved] = state[name][improved]
+        if verbose and e%model.write_steps == 0:
+            print(e, ' '.join(np.around(lossval, 4).astype(str)))
+
+    # every member gets its best parameters and is exported on its own
+    for m, member in enumerate(members):
+        member.load_state_dict(ensemble.member_state(m, best))
+        member.to(device)
+        member.saveloss = saveloss[m]
+        member.paused, member.epochs_trained = False, stopped[m]
+        if model.keepmodel:
+            save_model(member, member.outname+'_parameter.pth')
+    return [member.saveloss for member in members]
@@ -1,6 +1,9 @@
 import torch
 import numpy as np
 import sys, os
+import time
+import random
+import hashlib
 import torch.nn as nn
 from torch.utils.data import TensorDataset, DataLoader, Dataset
 import torch.optim as optim
@@ -12,6 +15,8 @@ import torch.nn.functional as F
 from init import MyDataset, get_device
 from modules import loss_dict, func_dict
 from torch_regression import torch_Regression
+from results_store import model_params
+from motif_scanning import score_tables, pvalue_thresholds
 
 
 #### Wondering if there is something similar to the alpha fold techniques that we can do for this here: They use predicted information in a latter layer and pass it to an earlier layer 3 times. I sounds like a new type of recurrent block, a specialized recurrent block. Maybe there is something that we can do simiarly here.
@@ -61,6 +66,12 @@ def pwm_scan(sequences, pwms, targetlen = None, activation = 'max', motif_cutoff
     if targetlen is None:
         targetlen = np.amax([len(pqm.T) for pqm in pwms])
     outscan = np.zeros((np.shape(sequences)[0], len(pwms), np.shape(sequences)[-1]-targetlen+1))
+    # motif_cutoff with one cutoff for every window of every pwm, f.e. from pwmset_thresholds, keeps a position
+    # if any window reaches its own cutoff
+    windows = None
+    if motif_cutoff is not None and np.ndim(motif_cutoff) > 0 and len(motif_cutoff) != len(pwms):
+        windows = np.cumsum([0]+[len(pwmset(pwm, targetlen = targetlen)) for pwm in pwms])
+        window_cutoff, motif_cutoff = np.array(motif_cutoff), None
     if verbose:
         print('Scanning', len(sequences), 'sequences with', len(pwms), 'PWMs')
     for p, pwm in enumerate(pwms):
@@ -74,12 +85,25 @@ def pwm_scan(sequences, pwms, targetlen = None, activation = 'max', motif_cutoff
                 outscan[:,p, l] = np.amax(setscans, axis = -1)
             elif activation == 'mean':
                 outscan[:,p, l] = np.mean(setscans, axis = -1)
+            if windows is not None:
+                hit = np.any(setscans >= window_cutoff[None, windows[p]:windows[p+1]], axis = -1)
+                outscan[~hit, p, l] = set_to
     # pwms also assign values to partial fits of the sequence, to remove these partial fits one can 
+    # motif_cutoff can also be one cutoff per pwm, f.e. log-odds thresholds for a p-value from motif_scanning.pvalue_thresholds
     if motif_cutoff is not None:
+        if np.ndim(motif_cutoff) > 0:
+            motif_cutoff = np.array(motif_cutoff)[None, :, None]
         outscan[outscan < motif_cutoff] = set_to
     return outscan
 
 
+# Log-odds thresholds for a p-value of all windows of targetlen that pwm_scan scores the pwms with, see pwmset
+# Long pwms are scored with their windows, whose scores are smaller than the scores of the entire pwm
+def pwmset_thresholds(pwms, targetlen, pvalue = 1e-4, bk_freq = None):
+    windows = [window for pwm in pwms for window in pwmset(pwm, targetlen = targetlen)]
+    return pvalue_thresholds(score_tables(windows, bk_freq = bk_freq), pvalue = pvalue)
+
+
 def l1_loss(w):
     return torch.abs(w).mean()
     
@@ -103,8 +127,46 @@ class hook_grads():
             self.grads[name] = grad
         return hook
 
-def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function = 'MSE', validation_loss = None, batchsize = None, device = 'cpu', optimizer = 'Adam', optim_params = None,  verbose = True, lr = 0.001, kernel_lr = None, hot_start = False, hot_alpha = 0.01, warm_start = False, outname = 'Fitmodel', adjust_lr = 'F', patience = 25, init_adjust = True, keepmodel = False, load_previous = True, write_steps = 10, checkval = True, writeloss = True, init_epochs = 250, epochs = 1000, l1reg_last = 0, l2reg_last = 0, l1_kernel= 0, reverse_sign = False, shift_back = None, random_shift = False, smooth_onehot = 0, multiple_input = False, restart = False, **kwargs):
+# First-order Taylor importance of the kernels of a convolutional layer, accumulated during the backward passes of training
+# The score of a kernel is |sum over positions of activation x gradient of the loss| for every sequence, summed over sequences
+# Scores of every epoch are normalized by the number of sequences and only the last n_epochs are kept
+class taylor_importance():
+    def __init__(self, module, n_epochs):
+        self.n_epochs = n_epochs
+        self.epochs = []
+        self.scores = None
+        self.nseqs = 0
+        self.handle = module.register_forward_hook(self.forward_hook)
+    
+    def forward_hook(self, module, inp, out):
+        # validation and predictions run without gradient and are not counted
+        if out.requires_grad:
+            out.register_hook(self.save_score(out.detach()))
+    
+    def save_score(self, act):
+        def hook(grad):
+            score = torch.sum(torch.abs(torch.sum(act*grad, dim = -1)), dim = 0).cpu().numpy()
+            self.scores = score if self.scores is None else self.scores + score
+            self.nseqs += act.shape[0]
+        return hook
     
+    def end_epoch(self):
+        if self.scores is not None:
+            self.epochs.append(self.scores/self.nseqs)
+            self.epochs = self.epochs[-self.n_epochs:]
+        self.scores, self.nseqs = None, 0
+    
+    def importance(self):
+        if len(self.epochs) == 0:
+            return None
+        return np.mean(self.epochs, axis = 0)
+    
+    def remove(self):
+        self.handle.remove()
+
+
+# Optimizer for the list of parameter dictionaries a_dict with default parameters for each optimizer
+def get_optimizer(a_dict, optimizer, lr, optim_params = None):
     # Default parameters for each optimizer
     if optim_params is None:
         if optimizer == 'SGD':
@@ -120,6 +182,29 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
         else:
             optim_params = None
     
+    if optimizer == 'SGD':
+        optimizer = optim.SGD(a_dict, lr=lr, momentum=optim_params)
+    elif optimizer == 'NAG':
+        optimizer = optim.SGD(a_dict, lr=lr, momentum=optim_params, nesterov = True)
+    elif optimizer == 'Adagrad':
+        optimizer = optim.Adagrad(a_dict, lr=lr, lr_decay = optim_params)
+    elif optimizer == 'Adadelta':
+        optimizer = optim.Adadelta(a_dict, lr=lr, rho=optim_params)
+    elif optimizer == 'Adam':
+        optimizer = optim.Adam(a_dict, lr=lr, betas=optim_params)
+    elif optimizer == 'NAdam':
+        optimizer = optim.NAdam(a_dict, lr=lr, betas=optim_params, momentum_decay = 4e-3)
+    elif optimizer == 'AdamW':
+        optimizer = optim.AdamW(a_dict, lr=lr, betas=optim_params)
+    elif optimizer == 'Amsgrad':
+        optimizer = optim.AdamW(a_dict, lr=lr, betas=optim_params, amsgrad = True)
+    else:
+        print(optimizer, 'not allowed')
+    return optimizer
+
+
+def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function = 'MSE', validation_loss = None, batchsize = None, device = 'cpu', optimizer = 'Adam', optim_params = None,  verbose = True, lr = 0.001, kernel_lr = None, hot_start = False, hot_alpha = 0.01, warm_start = False, outname = 'Fitmodel', adjust_lr = 'F', patience = 25, init_adjust = True, keepmodel = False, load_previous = True, write_steps = 10, checkval = True, writeloss = True, init_epochs = 250, epochs = 1000, l1reg_last = 0, l2reg_last = 0, l1_kernel= 0, reverse_sign = False, shift_back = None, random_shift = False, smooth_onehot = 0, multiple_input = False, restart = False, taylor_epochs = 0, epoch_budget = None, checkpoint_minutes = None, pwm_out = None, pwm_outval = None, **kwargs):
+    
     if model.outname is not None:
         outname = model.outname
         
@@ -171,24 +256,24 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
                 kernel_layertensor.append(str(param_tensor))
         
     # If pwms are provided, scan the sequences with them to avoid reoccuring scanning
-    pwm_out = None
-    if fixed_kernels is not None:
+    # pwm_out and pwm_outval can also be given if the scans were computed once for many models, f.e. all folds of a cross-validation
+    if fixed_kernels is not None and pwm_out is None:
         # generate maxpooled feature list with given kernels
         pwm_out = pwm_scan(X, fixed_kernels, targetlen = l_kernels, verbose = verbose, motif_cutoff = motif_cutoff)
+    if pwm_out is not None:
         pwm_out = torch.Tensor(pwm_out)
     
     
     # XYval represents a validation set on which the performance for the stop criterion is measured
-    pwm_outval = None
     if XYval is None:
         # If XYval is None, the training data will be used
         Xval, Yval = X, Y
-        if fixed_kernels is None:
-            pwm_outval = pwm_out
+        pwm_outval = pwm_out
     else:
         Xval, Yval = XYval[0], XYval[1]
-        if fixed_kernels is not None:
+        if fixed_kernels is not None and pwm_outval is None:
             pwm_outval = pwm_scan(Xval, fixed_kernels, targetlen = l_kernels, verbose = verbose, motif_cutoff = motif_cutoff) 
+        if pwm_outval is not None:
             pwm_outval = torch.Tensor(pwm_outval)
     
     val_weights = None
@@ -310,55 +395,86 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
             print(param_tensor, a_lrs[layernames.index(layname)])
         a_dict.append({'params':tensor, 'lr':a_lrs[layernames.index(layname)]})
     
-    # Give this dictionary to the optimizer
-    if optimizer == 'SGD':
-        optimizer = optim.SGD(a_dict, lr=lr, momentum=optim_params)
-    elif optimizer == 'NAG':
-        optimizer = optim.SGD(a_dict, lr=lr, momentum=optim_params, nesterov = True)
-    elif optimizer == 'Adagrad':
-        optimizer = optim.Adagrad(a_dict, lr=lr, lr_decay = optim_params)
-    elif optimizer == 'Adadelta':
-        optimizer = optim.Adadelta(a_dict, lr=lr, rho=optim_params)
-    elif optimizer == 'Adam':
-        optimizer = optim.Adam(a_dict, lr=lr, betas=optim_params)
-    elif optimizer == 'NAdam':
-        optimizer = optim.NAdam(a_dict, lr=lr, betas=optim_params, momentum_decay = 4e-3)
-    elif optimizer == 'AdamW':
-        optimizer = optim.AdamW(a_dict, lr=lr, betas=optim_params)
-    elif optimizer == 'Amsgrad':
-        optimizer = optim.AdamW(a_dict, lr=lr, betas=optim_params, amsgrad = True)
+    # Give this dictionary to the optimizer, the checkpoint fingerprint uses its name
+    optimizer_name = optimizer
+    optimizer = get_optimizer(a_dict, optimizer, lr, optim_params = optim_params)
+    
+    # With epoch_budget, training pauses after epoch_budget epochs and the training state is saved to _checkpoint.pth,
+    # a later call with a larger epoch_budget resumes from it, f.e. to train configurations in rungs of epochs
+    # With checkpoint_minutes, the training state is saved every checkpoint_minutes, so that a preempted run
+    # resumes from the last checkpoint when it is started again
+    checkpointfile = outname+'_checkpoint.pth'
+    fingerprint = training_fingerprint(model, {'loss_function': str(loss_function), 'validation_loss': str(validation_loss), 'batchsize': batchsize, 'optimizer': str(optimizer_name), 'optim_params': str(optim_params), 'lr': lr, 'kernel_lr': kernel_lr, 'hot_start': hot_start, 'warm_start': warm_start, 'adjust_lr': adjust_lr, 'patience': patience, 'init_adjust': init_adjust, 'checkval': checkval, 'init_epochs': init_epochs, 'epochs': epochs, 'l1reg_last': l1reg_last, 'l2reg_last': l2reg_last, 'l1_kernel': l1_kernel, 'reverse_sign': reverse_sign, 'shift_back': str(shift_back), 'random_shift': random_shift, 'smooth_onehot': smooth_onehot, 'restart': restart, 'taylor_epochs': taylor_epochs, 'n_train': trainsize, 'n_val': valsize})
+    resumed = (epoch_budget is not None or checkpoint_minutes is not None) and os.path.isfile(checkpointfile)
+    if resumed:
+        state = torch.load(checkpointfile, map_location = 'cpu', weights_only = False)
+        # a checkpoint of another configuration or data set with the same outname is not resumed and will be replaced
+        if state.get('fingerprint') != fingerprint:
+            print('Checkpoint', checkpointfile, 'was written with different settings, training starts from the beginning')
+            resumed = False
+    if resumed:
+        model.load_state_dict(state['model'])
+        model.to(device)
+        optimizer.load_state_dict(state['optimizer'])
+        a_dict = optimizer.param_groups
+        e, saveloss, restarted, been_larger, restart = state['epoch'], state['saveloss'], state['restarted'], state['been_larger'], state['restart']
+        total_epochs = state.get('total_epochs', e)
+        beginning_loss, writebeginning = state['beginning_loss'], state['writebeginning']
+        stopcriterion = stop_criterion(checkval, patience)
+        stopcriterion.best_loss, stopcriterion.steps_since = state['best_loss'], state['steps_since']
+        set_rng_state(state['rng'])
+        early_stop = False
+        if verbose:
+            print('Resumed from', checkpointfile, 'at epoch', e)
     else:
-        print(optimizer, 'not allowed')
+        # Compute losses at the beginning with randomly initialized model
+        lossorigval, lossval = excute_epoch(model, val_dataloader, loss_func, pwm_outval, valsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = Yval, reverse_sign = False, shift_back = shift_back, smooth_onehot = 0,multiple_input = multiple_input)
     
-    # Compute losses at the beginning with randomly initialized model
-    lossorigval, lossval = excute_epoch(model, val_dataloader, loss_func, pwm_outval, valsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = Yval, reverse_sign = False, shift_back = shift_back, smooth_onehot = 0,multiple_input = multiple_input)
+        beginning_loss, loss2 = excute_epoch(model, dataloader, loss_func, pwm_out, trainsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = l1reg_last, l2reg_last = l2reg_last, l1_kernel = l1_kernel, last_layertensor = last_layertensor, kernel_layertensor = kernel_layertensor, sample_weights = sample_weights, val_all = Y, reverse_sign = reverse_sign, shift_back = shift_back, smooth_onehot = smooth_onehot, multiple_input = multiple_input)
     
-    beginning_loss, loss2 = excute_epoch(model, dataloader, loss_func, pwm_out, trainsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = l1reg_last, l2reg_last = l2reg_last, l1_kernel = l1_kernel, last_layertensor = last_layertensor, kernel_layertensor = kernel_layertensor, sample_weights = sample_weights, val_all = Y, reverse_sign = reverse_sign, shift_back = shift_back, smooth_onehot = smooth_onehot, multiple_input = multiple_input)
+        saveloss = [lossval, loss2, lossorigval, beginning_loss, 0]
+        save_model(model, outname+'_params0.pth')
+        save_model(model, outname+'_parameter.pth')   
     
-    saveloss = [lossval, loss2, lossorigval, beginning_loss, 0]
-    save_model(model, outname+'_params0.pth')
-    save_model(model, outname+'_parameter.pth')   
-    
-    if verbose:
-        print('Train_loss(val), Val_loss(val), Train_loss(train), Val_loss(train)')
-    if writeloss:
+        if verbose:
+            print('Train_loss(val), Val_loss(val), Train_loss(train), Val_loss(train)')
         writebeginning = str(round(lossorigval,4))+'\t'+str(round(lossval,4))+'\t'+str(round(beginning_loss,4))+'\t'+str(round(loss2,4))
-        save_losses(outname+'_loss.txt', 0, writebeginning)
-    if verbose:
-        print(0, writebeginning)
-    stopcriterion = stop_criterion(checkval, patience)
-    early_stop, stopexp = stopcriterion(0, lossval)
+        if writeloss:
+            save_losses(outname+'_loss.txt', 0, writebeginning)
+        if verbose:
+            print(0, writebeginning)
+        stopcriterion = stop_criterion(checkval, patience)
+        early_stop, stopexp = stopcriterion(0, lossval)
+    
+    # Taylor scores of the kernels from the backward passes of the last taylor_epochs epochs before the saved model
+    taylor, taylor_best = None, None
+    if taylor_epochs > 0 and isinstance(getattr(model, 'convolutions', None), nn.Conv1d):
+        taylor = taylor_importance(model.convolutions, taylor_epochs)
+    if resumed:
+        taylor_best = state.get('taylor_best')
+        if taylor is not None:
+            taylor.epochs = state.get('taylor_epochs') or []
     
     # Start epochs and updates
-    restarted = 0
-    e = 0
-    been_larger = 1
+    if not resumed:
+        restarted = 0
+        e = 0
+        been_larger = 1
+        # e starts again from 0 when the learning rate is reduced, total_epochs counts all epochs for the epoch_budget
+        total_epochs = 0
+    paused = False
+    last_checkpoint = time.time()
+    
+    # Everything that is needed to continue the loop after the last finished epoch
+    def training_state():
+        return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': e, 'total_epochs': total_epochs, 'saveloss': saveloss, 'restarted': restarted, 'been_larger': been_larger, 'restart': restart, 'beginning_loss': beginning_loss, 'writebeginning': writebeginning, 'best_loss': stopcriterion.best_loss, 'steps_since': stopcriterion.steps_since, 'rng': get_rng_state(), 'taylor_best': taylor_best, 'taylor_epochs': None if taylor is None else taylor.epochs, 'fingerprint': fingerprint}
     
     while True:
-        trainloss, loss2 = excute_epoch(model, dataloader, loss_func, pwm_out, trainsize, True, device, val_loss = val_loss, optimizer = optimizer, l1reg_last = l1reg_last, l2reg_last = l2reg_last, l1_kernel = l1_kernel, last_layertensor = last_layertensor, kernel_layertensor = kernel_layertensor, sample_weights = sample_weights, val_all = Y, reverse_sign = reverse_sign, shift_back = shift_back, random_shift = random_shift, smooth_onehot = smooth_onehot, multiple_input = multiple_input)
+        trainloss, loss2 = excute_epoch(model, dataloader, loss_func, pwm_out, trainsize, True, device, val_loss = val_loss, optimizer = optimizer, l1reg_last = l1reg_last, l2reg_last = l2reg_last, l1_kernel = l1_kernel, last_layertensor = last_layertensor, kernel_layertensor = kernel_layertensor, sample_weights = sample_weights, val_all = Y, reverse_sign = reverse_sign, shift_back = shift_back, random_shift = random_shift, smooth_onehot = smooth_onehot, multiple_input = multiple_input, taylor = taylor)
         
         model.eval() # Sets model to evaluation mode which is important for batch normalization over all training mean and for dropout to be zero
         e += 1
+        total_epochs += 1
         
         lossorigval, lossval = excute_epoch(model, val_dataloader, loss_func, pwm_outval, valsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = Yval, reverse_sign = False, shift_back = shift_back, smooth_onehot = 0, multiple_input = multiple_input)
         
@@ -385,6 +501,8 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
                 save_losses(outname+'_loss.txt', 0, writebeginning)
                 load_model(model, outname+'_params0.pth',device)
                 e = 0
+                if taylor is not None:
+                    taylor.epochs = []
                 lossorigval, lossval = excute_epoch(model, val_dataloader, loss_func, pwm_outval, valsize, False, device, val_loss = val_loss, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = Yval, reverse_sign = False, smooth_onehot = 0, shift_back = shift_back, multiple_input = multiple_input)
                 early_stop, stopexp = stopcriterion(0, lossval)
                 print('Learning rate reduced', restarted,  lossorigval, lossval, lr * 0.25**restarted)
@@ -428,6 +546,8 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
                         print("Loaded model from", outname+'_parameter.pth', e - saveloss[-1], 'steps ago with loss', saveloss[0])
                 else:
                     saveloss = [lossval, loss2, lossorigval, trainloss, e]
+                    if taylor is not None:
+                        taylor_best = taylor.importance()
                 os.remove(outname+'_params0.pth')
                 break
         
@@ -436,12 +556,72 @@ def fit_model(model, X, Y, XYval = None, sample_weights = None, loss_function =
             if (~np.isnan(lossval) and lossval < saveloss[0]) or (~np.isnan(lossval) and np.isnan(saveloss[0])):
                 saveloss = [lossval, loss2, lossorigval, trainloss, e]
                 save_model(model, outname+'_parameter.pth')
+                if taylor is not None:
+                    taylor_best = taylor.importance()
+        
+        if epoch_budget is not None and total_epochs >= epoch_budget:
+            # pause training and keep all files to resume later
+            save_state(training_state(), checkpointfile)
+            # the checkpoint continues from the current weights, but the paused model returns
+            # the weights of the best epoch so that predictions belong to saveloss
+            load_model(model, outname+'_parameter.pth',device)
+            paused = True
+            break
+        
+        if checkpoint_minutes is not None and time.time() - last_checkpoint >= 60*checkpoint_minutes:
+            save_state(training_state(), checkpointfile)
+            last_checkpoint = time.time()
+    
+    # the model knows if it can be trained further with a larger epoch_budget, how many epochs it was trained
+    # and the validation loss of the last epoch, which belongs to the weights in the checkpoint of a paused model
+    model.paused, model.epochs_trained, model.last_loss = paused, total_epochs, float(lossval)
+    if paused:
+        if taylor is not None:
+            taylor.remove()
+        return saveloss
+    if os.path.isfile(checkpointfile):
+        os.remove(checkpointfile)
+    
+    if taylor is not None:
+        taylor.remove()
+        if taylor_best is not None:
+            np.savetxt(outname+'_taylor_importance.txt', np.array([np.arange(len(taylor_best)), taylor_best]).T, fmt = ['%d', '%.6e'], header = 'kernel taylor_importance')
     
     if not keepmodel:
         os.remove(outname+'_parameter.pth')
     return saveloss
 
 
+# States of all random number generators that shuffling, dropout and random shifts use
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+# Saves a dictionary of training states with torch to a temporary file first, so that an interrupted save does not destroy the last state
+def save_state(state, PATH):
+    torch.save(state, PATH+'.tmp')
+    os.replace(PATH+'.tmp', PATH)
+
+
+# Hash of the hyperparameters of the model, the shapes of its tensors and the training settings
+# A checkpoint is only resumed by a run with the same fingerprint
+def training_fingerprint(model, settings):
+    params = model_params(model)
+    for key in ['outname', 'device', 'verbose', 'training', 'paused', 'epochs_trained', 'last_loss']:
+        params.pop(key, None)
+    shapes = [(name, tuple(tensor.size())) for name, tensor in model.state_dict().items()]
+    return hashlib.sha1((str(sorted(params.items())) + str(sorted(settings.items())) + str(shapes)).encode()).hexdigest()
+
+
 def save_losses(PATH, i, lo):
     if i == 0:
         obj = open(PATH, 'w')
@@ -509,7 +689,7 @@ def smooth_onehotfunc(sample_x, ns = 2):
 
 
 # execute one epoch with training or validation set. Training set takes gradient but validation set computes loss without gradient
-def excute_epoch(model, dataloader, loss_func, pwm_out, normsize, take_grad, device, val_loss = None, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = None, reverse_sign = False, shift_back = None, random_shift = False, smooth_onehot = 0, multiple_input = False):
+def excute_epoch(model, dataloader, loss_func, pwm_out, normsize, take_grad, device, val_loss = None, optimizer = None, l1reg_last = 0, l2reg_last = 0, l1_kernel = 0, last_layertensor = None, kernel_layertensor = None, sample_weights = None, val_all = None, reverse_sign = False, shift_back = None, random_shift = False, smooth_onehot = 0, multiple_input = False, taylor = None):
     if val_loss is None:
         val_loss = loss_func
     
@@ -627,6 +807,8 @@ def excute_epoch(model, dataloader, loss_func, pwm_out, normsize, take_grad, dev
         else:
             with torch.no_grad():
                 validatloss += float(torch.sum(val_loss(Ypred, sample_y)).item())
+    if taylor is not None and take_grad:
+        taylor.end_epoch()
     if val_all is not None:
         with torch.no_grad():
             validatloss = float(torch.sum(val_loss(Ypred_all, val_all)).item())
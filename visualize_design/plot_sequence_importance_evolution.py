@@ -5,6 +5,9 @@ from data_processing import readinfasta, quick_onehot, check
 import pandas as pd
 from generate_sequence import load_cnn_model
 from modules import loss_dict
+from ism import ism_loss
+from motif_index import database_index
+from saliency_segments import find_segments
 import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
@@ -46,7 +49,10 @@ def read_pwm(pwmlist, nameline = 'Motif'):
                 features[line[0]] = line[1]
     return pwms, names, collected_features
 
-def bestpwmmatch(saliency, st, en, pfms, infocont = True):
+# candidates: indices of pfms that are compared, f.e. from motif_index.candidates, all pfms if None
+def bestpwmmatch(saliency, st, en, pfms, infocont = True, candidates = None):
+    if candidates is None:
+        candidates = np.arange(len(pfms))
     matchscore = []
     matchpos = []
     lcontrol = []
@@ -54,7 +60,8 @@ def bestpwmmatch(saliency, st, en, pfms, infocont = True):
     osaliency = np.copy(saliency)
     saliency[np.sign(np.sum(saliency[st:en]))*saliency < 0] = 0
     saliency = np.absolute(saliency)
-    for p, pfm in enumerate(pfms):
+    for p in candidates:
+        pfm = pfms[p]
         if infocont:
             pfm = np.log2((pfm+1e-16)/0.25)
         ### Somehow devide by sum over max of all positions, to control for limited usage tf pwm
@@ -99,7 +106,7 @@ def bestpwmmatch(saliency, st, en, pfms, infocont = True):
         matchpos.append(mp)
         lcontrol.append(lc)
     
-    argmax = np.argsort(matchscore)[::-1]
+    argmax = np.array(candidates)[np.argsort(matchscore)[::-1]]
     #print(np.array(matchscore)[argmax][:10])
     '''
     for p in argmax[:3]:
@@ -121,80 +128,18 @@ def bestpwmmatch(saliency, st, en, pfms, infocont = True):
         print(np.sign(np.sum(saliency[st:en])))
         print(rbpnames[p], ''.join(nts[np.argmax(pfm,axis = 1)]), ''.join(nts[np.argmax(saliency[st:en],axis = 1)]))
     '''
-    maxscore, maxoff = np.array(matchscore)[argmax], np.array(matchpos)[argmax]
+    maxscore, maxoff = np.sort(matchscore)[::-1], np.array(matchpos)[np.argsort(matchscore)[::-1]]
     #print(maxscore, maxoff)
     return maxscore, maxoff, argmax
 
             
-def find_pwms(saliency, pfms, z_cut = 1.3, detect_cut = 1., min_mot = 5, infocont = True, equal_score = True, mean_sal = 0):
-    salpwms = None
-    # find positions in saliency that represent motifs
-    if mean_sal is None:
-        zscore_sal = (np.sum(saliency, axis =1) - np.mean(np.sum(saliency,axis = 1)))/np.std(np.sum(saliency,axis = 1))
-    else:
-        zscore_sal = (np.sum(saliency, axis =1) - mean_sal)/np.sqrt(np.mean((np.sum(saliency,axis = 1)-mean_sal)**2))
-    potmotifs = np.absolute(zscore_sal) >= z_cut
-    zsign = np.sign(zscore_sal) * potmotifs
-    lmot, lgap,ngap, ldif, lstr, ps, sig = 0, 0, 0, 0, 0, None, None
-    # detemine motifs in saliency map as positions with enriched saliency scores
-    salpstart, salpend = [], []
-    #print(np.where(potmotifs))
-    # acount for different signs
-    # find continous stretches with same sign # allow one gap per 7 basepairs, minimum continous stretch must be 3 within and 1 one the flanks
-    p = 0
-    while True:
-    #for p in range(len(potmotifs)):
-        if potmotifs[p]:
-            if lmot ==0:
-                ps = p
-                sig = zsign[p]
-                ngap = 0
-                lstr = 0
-            if zsign[p] == sig:
-                lmot += 1
-                lgap = 0
-                lstr += 1
-            else:
-                lgap += 1
-                ngap +=1
-                if ngap == 2:
-                    if lmot < min_mot:
-                        p = p - (lstr+1)
-                        lgap, ngap, lmot = 0, 0, 0
-                    else:
-                        salpstart.append(ps)
-                        salpend.append(p-1)
-                        p = p -1
-                        lgap, ngap, lmot = 0, 0, 0
-                lstr = 0
-        else:
-            lgap += 1
-            ngap +=1
-            if ngap == 2:
-                if lmot < min_mot:
-                    p = p - (lstr+1)
-                    lgap, ngap, lmot = 0, 0, 0
-                else:
-                    salpstart.append(ps)
-                    salpend.append(p - 1)
-                    p = p -1
-                    lgap, ngap, lmot = 0, 0, 0
-            lstr = 0
-            if lgap == 2:
-                if lmot >= min_mot and (ngap-2)/lmot <= 1./(lmot+2.):
-                        salpstart.append(ps)
-                        salpend.append(p - 2)
-
-                p = p - 2*(zsign[p-2:p] != sig).any()
-                sig = None
-                lmot,ngap = 0,0
-        #print(p, lmot, lgap, ngap, lstr, sig)
-        p += 1
-        if p == len(potmotifs):
-            break
-    
-    #print(salpstart, salpend)
-    #sys.exit()
+# motif_index: index of the database that pfms were taken from, index_mask marks pfms in the database
+# Only the n_candidates motifs that the index returns for each detected motif are scored with bestpwmmatch
+def find_pwms(saliency, pfms, z_cut = 1.3, detect_cut = 1., min_mot = 5, infocont = True, equal_score = True, mean_sal = 0, motif_index = None, index_mask = None, n_candidates = 100, segments = None):
+    # find positions in saliency that represent motifs, segments of many saliency maps can be determined at once with find_segments
+    if segments is None:
+        segments = find_segments(np.array(saliency)[None], z_cut = z_cut, min_mot = min_mot, mean_sal = mean_sal)[0][0]
+    salpstart, salpend = segments
     salpwms = saliency.copy()
     #print(salpwms[salpstart[0]-2:salpend[0]+2+1])
     salpwms[:] = 0
@@ -208,7 +153,14 @@ def find_pwms(saliency, pfms, z_cut = 1.3, detect_cut = 1., min_mot = 5, infocon
                 #salmap[~potmotifs] = 0
             else:
                 salmap = saliency
-            mscore, mpos, argpwm = bestpwmmatch(salmap, salpstart[s], salpend[s]+1, pfms, infocont = infocont)
+            candidates = None
+            if motif_index is not None:
+                segment = np.absolute(saliency.to_numpy()[salpstart[s]:salpend[s]+1])
+                segment = segment/np.maximum(np.sum(segment, axis = 1)[:, None], 1e-8)
+                candidates = motif_index.candidates([segment], n_candidates = n_candidates, mask = index_mask)[0]
+                if index_mask is not None:
+                    candidates = np.searchsorted(np.where(index_mask)[0], candidates)
+            mscore, mpos, argpwm = bestpwmmatch(salmap, salpstart[s], salpend[s]+1, pfms, infocont = infocont, candidates = candidates)
             for m, ms in enumerate(mscore):
                 if ms > detect_cut:
                     pfmchose = pfms[argpwm[m]]
@@ -247,34 +199,11 @@ def saliency_map(cseq, target, loss_function, model, scoring):
     
     elif scoring == 'forward':
         
-        #t0 = time.time()
-        # extend zero axis for cseq,  then set all positions to 0 individually and then insert the one all at once
-        setto = np.array(np.where(cseq[0] == 0))
-        icur = np.array(np.where(cseq[0] == 1))
-        with torch.no_grad():
-            target = target.expand(len(setto[0])+1,-1)
-            tseq = torch.clone(cseq.detach())
-            tseq = tseq.repeat(len(setto[0])+1,1,1)
-            iscur = []
-            for i in range(len(setto[0])):
-                iscur.append([icur[0][icur[1] == setto[1][i]][0] , setto[1][i]])
-                tseq[i, :, setto[1][i]] = 0
-                tseq[i, setto[0][i], setto[1][i]] = 1
-            iscur = np.array(iscur).T
-            #print(np.where(np.where(tseq[0].T == 1)[1] != np.where(tseq[-1].T == 1)[1]), setto[0][0], setto[1][0])
-            #print(np.where(np.where(tseq[300].T == 1)[1] != np.where(tseq[-1].T == 1)[1]), setto[0][300], setto[1][300])
-            tpred = model.forward(tseq)
-            ismloss = loss(tpred,target)
-            ismloss = torch.mean(ismloss, axis = 1)
-            saliency = np.zeros(cseq[0].size())
-            diffloss = ismloss[-1]
-            for i in range(len(setto[0])):
-                saliency[iscur[0][i], iscur[1][i]] += ismloss[i]-diffloss
-            pred = tpred[[-1]]
-                #print(setto[0][i], setto[1][i], ismloss[i], diffloss)
-            #print('Saliency', saliency)
-            ##t1 = time.time()
-            #print(t1-t0)
+        # all mutants are generated at once and run through the model in batches, see ism.py
+        ismloss, diffloss, pred = ism_loss(model, cseq, target, loss)
+        # sum of loss changes of all mutations at a position is assigned to the base in the sequence
+        saliency = np.sum(ismloss, axis = 0)*cseq[0].detach().numpy()
+        pred = pred.unsqueeze(0)
         '''
         #t0 = time.time()
         loss.reduction = 'mean'
@@ -411,6 +340,10 @@ if __name__ == '__main__':
         considerpfm[:, np.sum(considerpfm, axis = 0) == 0] = True
         print('Considerable PFMs', np.sum(considerpfm, axis = 0))
         pwmcount = [[[],[]] for i in range(len(target_tracks))]
+        # index of the pwm database to only score the closest pfms for every motif in the saliency maps
+        pfmindex = None
+        if '--motif_index' in sys.argv:
+            pfmindex = database_index(pwmfile, pfms, names = rbpnames)
         
         
     for q in range(0, len(opt)):
@@ -443,13 +376,16 @@ if __name__ == '__main__':
             #print(ylim)
             #print(steps, columns, rows, len(seqset))
             j = 1
+            if pwmline:
+                # motif segments in the saliency maps of all steps
+                segments = find_segments(np.array([pwm.to_numpy() for pwm in pwms]), z_cut = 1.3, min_mot = 5, mean_sal = 0)[0]
             for i, s in enumerate(steps):
                 #print(rows, columns, columns*i+1+t)
                 pwm = pwms[i]
                 if pwmline:
                     j = 2
                     # search for motifs of length 6 or more in saliency saliency_map
-                    salpwms, salnames, salpos, salpstart, salpend = find_pwms(pwm, pfms[considerpfm[:,t]], z_cut = 1.3, detect_cut = 1., infocont = True, equal_score = False)
+                    salpwms, salnames, salpos, salpstart, salpend = find_pwms(pwm, pfms[considerpfm[:,t]], z_cut = 1.3, detect_cut = 1., infocont = True, equal_score = False, motif_index = pfmindex, index_mask = considerpfm[:,t], segments = segments[i])
                     if len(salnames) > 0:
                         if i == 0:
                             pwmcount[t][0].append(np.where(considerpfm[:,t])[0][salnames])
@@ -11,81 +11,24 @@ import torch.nn as nn
 from cluster_pwms import numbertype
 from plot_sequence_importance_evolution import read_pwm, saliency_map
 from cluster_pwms import compare_ppms, combine_pwms
+from motif_index import database_index
 from sklearn.cluster import AgglomerativeClustering
-from scipy.stats import fisher_exact
+from occurrence_statistics import occurrence_matrix, cooccurrence_tests, enrichment_tests
 from compare_expression_distribution import read_separated
+from attribution import compute_attributions, read_attribution_store
+from interaction import pairwise_ism, integrated_hessians, interaction_tables
+from saliency_segments import find_segments
 
 
 
             
-def find_pwms(saliency, z_cut = 1.3, min_mot = 5, mean_sal = 0):
-    salpwms = None
-    # find positions in saliency that represent motifs
-    if mean_sal is None:
-        mean_sal = np.mean(np.sum(saliency,axis = 1))
-        std_sal = np.std(np.sum(saliency,axis = 1))
-    else:
-        std_sal = np.sqrt(np.mean((np.sum(saliency,axis = 1)-mean_sal)**2))
-    zscore_sal = (np.sum(saliency, axis =1) - mean_sal)/std_sal
-    saliency = (saliency - mean_sal)/std_sal
-    potmotifs = np.absolute(zscore_sal) >= z_cut
-    #print(np.where(potmotifs)[0])
-    zsign = np.sign(zscore_sal) * potmotifs
-    lmot, lgap, ngap, lstr, ps, sig = 0, 0, 0, 0, None, None
-    # detemine motifs in saliency map as positions with enriched saliency scores
-    salpstart, salpend = [], []
-    # acount for different signs
-    # find continous stretches with same sign # allow one gap per 7 basepairs, minimum continous stretch must be 3 within and 1 one the flanks
-    p = 0
-    while True:
-        if potmotifs[p]:
-            if lmot ==0:
-                ps = p
-                sig = zsign[p]
-                ngap = 0
-                lstr = 0
-            if zsign[p] == sig:
-                lmot += 1
-                lgap = 0
-                lstr += 1
-            else:
-                lgap += 1
-                ngap +=1
-                if ngap == 2:
-                    if lmot < min_mot:
-                        p = p - (lstr+1)
-                        lgap, ngap, lmot = 0, 0, 0
-                    else:
-                        salpstart.append(ps)
-                        salpend.append(p-1)
-                        p = p -1
-                        lgap, ngap, lmot = 0, 0, 0
-                lstr = 0
-        else:
-            lgap += 1
-            ngap +=1
-            if ngap == 2:
-                if lmot < min_mot:
-                    p = p - (lstr+1)
-                    lgap, ngap, lmot = 0, 0, 0
-                else:
-                    salpstart.append(ps)
-                    salpend.append(p - 1)
-                    p = p -1
-                    lgap, ngap, lmot = 0, 0, 0
-            lstr = 0
-            if lgap == 2:
-                if lmot >= min_mot and (ngap-2)/lmot <= 1./(lmot+2.):
-                        salpstart.append(ps)
-                        salpend.append(p - 2)
+# Start and end of stretches in saliency (L, 4) that represent motifs, and the normalized saliency
+def motif_segments(saliency, z_cut = 1.3, min_mot = 5, mean_sal = 0):
+    segments, saliency = find_segments(np.array(saliency)[None], z_cut = z_cut, min_mot = min_mot, mean_sal = mean_sal)
+    return segments[0][0], segments[0][1], saliency[0]
 
-                p = p - 2*(zsign[p-2:p] != sig).any()
-                sig = None
-                lmot,ngap = 0,0
-        p += 1
-        if p == len(potmotifs):
-            break
-    #print(salpstart, salpend)
+# Absolute normalized saliency of the segments and their direction
+def segment_pwms(saliency, salpstart, salpend):
     det_direction = []
     detected_pwms = []
     for s, sst in enumerate(salpstart):
@@ -93,6 +36,10 @@ def find_pwms(saliency, z_cut = 1.3, min_mot = 5, mean_sal = 0):
         det_direction.append(np.sign(np.sum(saliency[sst:salpend[s]+1])))
     return detected_pwms, det_direction
 
+def find_pwms(saliency, z_cut = 1.3, min_mot = 5, mean_sal = 0):
+    salpstart, salpend, saliency = motif_segments(saliency, z_cut = z_cut, min_mot = min_mot, mean_sal = mean_sal)
+    return segment_pwms(saliency, salpstart, salpend)
+
 def read_optseqs(seed_seqs, seed_names, evofile):
     obj = open(evofile, 'r').readlines()
     opt = []
@@ -239,6 +186,11 @@ if __name__ == '__main__':
     # set to all TRue in not specified by Ctype
     considerpfm[:, np.sum(considerpfm, axis = 0) == 0] = True
     print('Considered PFMs', np.sum(considerpfm, axis = 0))
+    # index of the pwm database, only the index_k closest pfms are compared exactly to every motif cluster
+    pfmindex = None
+    if '--motif_index' in sys.argv:
+        index_k = int(sys.argv[sys.argv.index('--motif_index')+1])
+        pfmindex = database_index(pwmfile, pfms, names = rbpnames, indexfile = os.path.splitext(pwmfile)[0]+'_infocont_motifindex.npz', padding = 0., min_sim = 5)
     
     
     
@@ -247,6 +199,29 @@ if __name__ == '__main__':
         pwmstats = efile['pwmstats']
         ext_pwms = efile['ext_pwms']
     else:
+        # attributions of all start and optimized sequences are computed in batches and stored in outname_ctype_attributions.npy
+        # sequence i of seed q is at position 2*q+i
+        attribution_stores = None
+        if scoring in ['integrated_gradients', 'deeplift']:
+            attribution_stores = []
+            for t, tt in enumerate(target_tracks):
+                storefile = outname+'_'+ctype[t]+'_attributions.npy'
+                if '--load_attributions' not in sys.argv:
+                    allseqs, nts = quick_onehot(np.concatenate(opt))
+                    model = load_cnn_model(predictor, verbose = False)
+                    model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[tt])
+                    model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[tt])
+                    compute_attributions(model, np.transpose(allseqs, axes=(0,2,1)), storefile, method = scoring, target = target_values[t], loss_function = loss_function)
+                attribution_stores.append(read_attribution_store(storefile))
+        
+        # motif interactions between the detected segments in each sequence, with pairwise_ism or integrated_hessians
+        # and maximum number of model evaluations per sequence
+        interactions = None
+        if '--interactions' in sys.argv:
+            interactions = sys.argv[sys.argv.index('--interactions')+1]
+            interaction_budget = int(sys.argv[sys.argv.index('--interactions')+2])
+            interaction_input = [[] for t in range(len(target_tracks))]
+        
         # collect significant pwms from importat position in each sequence
         ext_pwms = []
         pwmstats = []
@@ -256,20 +231,48 @@ if __name__ == '__main__':
             seqset, nts = quick_onehot(seqset)
             seqset = np.transpose(seqset, axes=(0,2,1))
             for t, tt in enumerate(target_tracks):
-                model = load_cnn_model(predictor, verbose = False)
-                model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[tt])
-                model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[tt])
+                if attribution_stores is None:
+                    model = load_cnn_model(predictor, verbose = False)
+                    model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[tt])
+                    model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[tt])
+                salmaps = []
                 for i in range(2):
                     ohseq = seqset[[i]]
-                    pwm, loss, pred = saliency_map(ohseq, target_values[t], loss_function, model, scoring)
+                    if attribution_stores is not None:
+                        pwm = np.array(attribution_stores[t][2*q+i])
+                    else:
+                        pwm, loss, pred = saliency_map(ohseq, target_values[t], loss_function, model, scoring)
                     #print(loss, pred, np.shape(pwm))
-                    detected_pwms, direction = find_pwms(pwm.T, z_cut = 1.3, min_mot = 5, mean_sal = 0)
+                    salmaps.append(pwm.T)
+                # segments of the seed and the optimized sequence at once
+                segments, nsals = find_segments(np.array(salmaps), z_cut = 1.3, min_mot = 5, mean_sal = 0)
+                for i in range(2):
+                    salpstart, salpend = segments[i]
+                    detected_pwms, direction = segment_pwms(nsals[i], salpstart, salpend)
+                    if interactions is not None:
+                        interaction_input[t].append([2*q+i, seqset[i], list(zip(salpstart, salpend))])
                     #print(detected_pwms, direction)
                     for d, dtpwm in enumerate(detected_pwms):
                         ext_pwms.append(dtpwm)
                         pwmstats.append([t, i, direction[d], q])
         pwmstats = np.array(pwmstats)
         np.savez_compressed(outname+'_extract_pwms.npz', pwmstats = pwmstats, ext_pwms =ext_pwms)
+        
+        if interactions is not None:
+            for t, tt in enumerate(target_tracks):
+                model = load_cnn_model(predictor, verbose = False)
+                model.classifier.Linear.weight = nn.Parameter(model.classifier.Linear.weight[tt])
+                model.classifier.Linear.bias = nn.Parameter(model.classifier.Linear.bias[tt])
+                seqids = np.array([inp[0] for inp in interaction_input[t]])
+                iseqs = np.array([inp[1] for inp in interaction_input[t]])
+                isegments = [inp[2] for inp in interaction_input[t]]
+                if interactions == 'integrated_hessians':
+                    seg_interactions, pos_interactions = integrated_hessians(model, iseqs, isegments, budget = interaction_budget, target = target_values[t], loss = loss_dict[loss_function])
+                else:
+                    seg_interactions, pos_interactions = pairwise_ism(model, iseqs, isegments, budget = interaction_budget, target = target_values[t], loss = loss_dict[loss_function], seed = 1)
+                # one numeric table for all sequences, the first column is the sequence id
+                np.savez_compressed(outname+'_'+ctype[t]+'_'+interactions+'.npz', seqids = seqids, **interaction_tables(seqids, isegments, seg_interactions, pos_interactions, pairwise = interactions != 'integrated_hessians'))
+                print(outname+'_'+ctype[t]+'_'+interactions+'.npz')
         print(outname+'_extract_pwms.npz')
         
     if '--load_clusters' in sys.argv:
@@ -313,7 +316,10 @@ if __name__ == '__main__':
     else:
         # compare to known motifs and assign name if known
         if (np.sum(considerpfm, axis = 0) == len(considerpfm)).all():
-            correlation, log_pvalues, offsets, bestmatch = compare_ppms(clusterpwms, pfms, find_bestmatch = True, fill_logp_self = 0, one_half = False, min_sim = 5, padding = 0., infocont = False, bk_freq = 0.25, non_zero_elements = False)
+            if pfmindex is not None:
+                correlation, log_pvalues, offsets = pfmindex.query_matrix(clusterpwms, k = index_k)
+            else:
+                correlation, log_pvalues, offsets, bestmatch = compare_ppms(clusterpwms, pfms, find_bestmatch = True, fill_logp_self = 0, one_half = False, min_sim = 5, padding = 0., infocont = False, bk_freq = 0.25, non_zero_elements = False)
             allmatches = [[np.argsort(correlation,axis = 1), np.sort(correlation,axis = 1)] for t in range(len(tartet_tracks))]
             bestmatches = [[np.argmin(correlation,axis = 1), np.amin(correlation,axis = 1)] for t in range(len(tartet_tracks))]
         else:
@@ -321,7 +327,11 @@ if __name__ == '__main__':
             allmatches = []
             for t in range(len(target_tracks)):
                 print(len(pfms[considerpfm[:,t]]), len(clusterpwms))
-                correlation, log_pvalues, offsets, bestmatch = compare_ppms(clusterpwms, pfms[considerpfm[:,t]], find_bestmatch = True, fill_logp_self = 0, one_half = False, min_sim = 5, padding = 0., infocont = False, bk_freq = 0.25, non_zero_elements = False)
+                if pfmindex is not None:
+                    correlation, log_pvalues, offsets = pfmindex.query_matrix(clusterpwms, k = index_k, mask = considerpfm[:,t])
+                    correlation, log_pvalues, offsets = correlation[:, considerpfm[:,t]], log_pvalues[:, considerpfm[:,t]], offsets[:, considerpfm[:,t]]
+                else:
+                    correlation, log_pvalues, offsets, bestmatch = compare_ppms(clusterpwms, pfms[considerpfm[:,t]], find_bestmatch = True, fill_logp_self = 0, one_half = False, min_sim = 5, padding = 0., infocont = False, bk_freq = 0.25, non_zero_elements = False)
                 print(np.shape(correlation))
                 bestmatches.append([np.where(considerpfm[:,t])[0][np.argmin(correlation,axis = 1)], np.amin(correlation,axis = 1)])
                 allmatches.append([np.where(considerpfm[:,t])[0][np.argsort(correlation,axis = 1)], np.sort(correlation,axis = 1)])
@@ -528,36 +538,32 @@ if __name__ == '__main__':
         print(outname +'_motif_cluster_countscatter.jpg')
     
     if '--plot_interactions' in sys.argv:
-        # for each condition test with fisher's exact motif interaction score in generated sequences, maybe start with most enriched motifs and use threshold to avoid n^2 time.
+        # for each condition test with fisher's exact motif interaction score in generated sequences
+        # all pairs of clusters are tested at once on the sparse occurrence matrix of the optimized sequences, and p-values are corrected with FDR
         minoccur = 2
         motif_interactions = [[] for t in range(len(target_tracks))]
         min_pval = 0.01
+        seqids, n_clusters = pwmstats[:,-1].astype(int), int(np.amax(clusters))+1
+        cooccurrence_tables, enrichment_tables = {}, {}
         for t in range(len(target_tracks)):
-            pwmcount = pwmcounts[t][1][0]
-            sortpwms = np.argsort(-pwmcount)
-            pwin = pwmsin[t]
-            for g, s in enumerate(sortpwms):
-                for q in sortpwms[g:]:
-                    if pwmcount[s] >= minoccur and pwmcount[q] >= minoccur:
-                        pws, pwq = pwin[s], pwin[q]
-                        clmasks = clusters == pws
-                        clmaskq = clusters == pwq
-                        tmask = (pwmstats[:,0] ==t) * (pwmstats[:,1] ==1) * (pwmstats[:,2] ==1)
-                        clmasks, clmaskq = clmasks*tmask, clmaskq*tmask
-                        seqs, seqsn = np.unique(pwmstats[clmasks, -1], return_counts = True) 
-                        seqq, seqqn= np.unique(pwmstats[clmaskq, -1], return_counts = True)
-                        if s == q:
-                            combseqs = seqs[seqsn > 1]
-                        else:
-                            combseqs = np.intersect1d(seqs, seqq)
-                        ss, sq, cs = len(seqs), len(seqq), len(combseqs)
-                        table = [[ss-cs,cs],[Nseqs-ss-sq+cs,sq-cs]]
-                        odd_, pval_interactg = fisher_exact(table, alternative = 'greater')
-                        odd_, pval_interactl = fisher_exact(table, alternative = 'less')
-                        #print(ss, sq, cs, pval_interactg, pval_interactl)
-                        if min(pval_interactg, pval_interactl) < min_pval:
-                            motif_interactions[t].append([pws, pwq, -np.log10(pval_interactl)+np.log10(pval_interactg), cs])
-                            print('motifinterractions', motif_interactions[t][-1])
+            tmask = (pwmstats[:,0] ==t) * (pwmstats[:,1] ==1) * (pwmstats[:,2] ==1)
+            occurrences = occurrence_matrix(seqids[tmask], clusters[tmask], Nseqs, n_clusters)
+            pairs, ns, nq, ncomb, pval_interactg, pval_interactl, score, qvals = cooccurrence_tests(occurrences, min_occurrence = minoccur)
+            cooccurrence_tables['interactions'+str(t)] = np.concatenate([pairs, np.array([ns, nq, ncomb, pval_interactg, pval_interactl, score, qvals]).T], axis = 1)
+            for p in np.where(qvals < min_pval)[0]:
+                motif_interactions[t].append([pairs[p,0], pairs[p,1], score[p], ncomb[p]])
+                print('motifinterractions', motif_interactions[t][-1])
+            # enrichment of clusters in optimized versus start sequences, start sequences are rows 2*q, optimized 2*q+1
+            smask = (pwmstats[:,0] ==t) * (pwmstats[:,2] ==1)
+            occurrences = occurrence_matrix(2*seqids[smask]+pwmstats[smask,1].astype(int), clusters[smask], 2*Nseqs, n_clusters)
+            optimized = np.arange(2*Nseqs)%2 == 1
+            nopt, nstart, logodds, pval_enrg, pval_enrl, qvals = enrichment_tests(occurrences, optimized, ~optimized)
+            tested = np.where(nopt + nstart > 0)[0]
+            enrichment_tables['enrichment'+str(t)] = np.array([tested, nopt[tested], nstart[tested], logodds[tested], pval_enrg[tested], pval_enrl[tested], qvals[tested]]).T
+        # columns: cluster, cluster, sequences with first, with second, with both, p-value greater, p-value less, score, q-value
+        # and cluster, optimized sequences with cluster, start sequences with cluster, log2 odds, p-value enriched, p-value depleted, q-value
+        np.savez_compressed(outname+'_motif_interaction_tables.npz', **cooccurrence_tables, **enrichment_tables)
+        print(outname+'_motif_interaction_tables.npz')
         
         if len(np.concatenate(motif_interactions, axis = 0)) > 0:
             # Generate figure with log10(p-value as bar plot and motifs on left side
@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 import ast
 import scipy.stats as st
 from functools import reduce 
+from results_store import read_index, select_runs, load_metric
+from run_registry import open_registry, query_runs, run_params, run_metric
 
 
 def numbertype(inbool):
@@ -38,7 +40,6 @@ def check(inbool):
 important_params = np.array(['loss_function', 'validation_loss', 'num_kernels', 'kernel_bias', 'fixed_kernels', 'motif_cutoff', 'l_kernels', 'kernel_function', 'hot_start', 'kernel_thresholding', 'max_pooling', 'mean_pooling', 'pooling_size', 'pooling_steps', 'dilated_convolutions', 'strides', 'conv_increase', 'dilations', 'l_dilkernels', 'dilmax_pooling', 'dilmean_pooling', 'dilpooling_size', 'dilpooling_steps', 'dilpooling_residual', 'dilresidual_entire', 'gapped_convs', 'gapconv_residual', 'gapconv_pooling', 'embedding_convs', 'n_transformer', 'n_attention', 'n_distattention', 'dim_distattention', 'dim_embattention', 'maxpool_attention', 'sum_attention', 'transformer_convolutions', 'trdilations', 'trstrides', 'l_trkernels', 'trconv_dim', 'trmax_pooling', 'trmean_pooling', 'trpooling_size', 'trpooling_steps', 'trpooling_residual', 'nfc_layers', 'nfc_residuals', 'fc_function', 'layer_widening', 'interaction_layer', 'neuralnetout', 'dropout', 'batch_norm', 'l1_kernel', 'l2reg_last', 'l1reg_last', 'reverse_sign', 'shift_sequence', 'random_shift', 'smooth_onehot', 'lr', 'kernel_lr', 'adjust_lr', 'batchsize', 'outclass', 'optimizer', 'optim_params', 'seed', 'restart', 'cnn_embedding', 'n_inputs', 'n_combine_layers', 'combine_function', 'combine_widening', 'combine_residual'])
 
 
-param_files = glob.glob(sys.argv[1]+'*'+sys.argv[2])
 corrfile = sys.argv[3]
 
 osoutname = False
@@ -50,48 +51,91 @@ all_params = []
 parameters = []
 performance = []
 permeasures = []
-for p, pfile in enumerate(param_files):
-    obj = open(pfile, 'r').readlines()
-    params = {}
-    dnot = True
-    falselines = []
-    outname = ''
-    for l, line in enumerate(obj):
-        line = line.strip().split(' : ')
-        if line[0] != 'outname':
-            if line[0] in important_params:
-                if len(line) > 0:
-                    params[line[0]] = check(line[1])
-                    all_params.append(line[0])
-                else:
-                    dnot=False
-                    falselines.append(line)
-                    break
-        else:
-            if osoutname:
-                outname = pfile.replace(sys.argv[2], '')
+# Runs are selected from the columnar results store of cnn_model.py instead of reading every parameter and performance file
+# corrfile then names the metric, f.e. _exper_corr_tcl0.txt or exper_corr_tcl0
+if '--results_store' in sys.argv:
+    storedir = sys.argv[sys.argv.index('--results_store')+1]
+    index = read_index(storedir)
+    # additional filters on parameters, f.e. --select num_kernels=100+lr=0.001
+    filters = {}
+    if '--select' in sys.argv:
+        for sel in sys.argv[sys.argv.index('--select')+1].split('+'):
+            filters[sel.split('=')[0]] = sel.split('=',1)[1].split(',')
+    mask = select_runs(index, prefix = os.path.split(sys.argv[1])[1], **filters)
+    metric = os.path.splitext(corrfile)[0].strip('_')
+    performance, permeasures = load_metric(storedir, index, mask, metric)
+    has_metric = np.array([len(p) > 0 for p in performance], dtype = bool)
+    for run in index['run'][mask][~has_metric]:
+        print( '\nfor', run)
+        print( metric, 'not in results store')
+    performance, permeasures = [p for p in performance if len(p) > 0], [p for p in permeasures if len(p) > 0]
+    pmask = np.isin(index['param_names'], important_params)
+    paramvalues = index['params'][mask][has_metric][:, pmask]
+    for values in paramvalues:
+        params = {name: check(value) for name, value in zip(index['param_names'][pmask], values) if value != 'None'}
+        all_params += list(params.keys())
+        parameters.append(params)
+    filenames = list(index['run'][mask][has_metric])
+# Runs are selected with one query from the sqlite registry of cnn_model.py --run_registry, see run_registry.py
+# corrfile names the metric as with --results_store, --select filters the parameters
+elif '--run_registry' in sys.argv:
+    registry = open_registry(sys.argv[sys.argv.index('--run_registry')+1])
+    filters = {}
+    if '--select' in sys.argv:
+        for sel in sys.argv[sys.argv.index('--select')+1].split('+'):
+            filters[sel.split('=')[0]] = sel.split('=',1)[1].split(',')
+    metric = os.path.splitext(corrfile)[0].strip('_')
+    selected = query_runs(registry, prefix = os.path.split(sys.argv[1])[1], metric = metric, **filters)
+    performance, permeasures = run_metric(registry, selected['run_id'], metric)
+    for params in run_params(registry, selected['run_id'], names = important_params):
+        params = {name: check(value) for name, value in params.items() if value != 'None'}
+        all_params += list(params.keys())
+        parameters.append(params)
+    filenames = list(selected['run'])
+else:
+    param_files = glob.glob(sys.argv[1]+'*'+sys.argv[2])
+    for p, pfile in enumerate(param_files):
+        obj = open(pfile, 'r').readlines()
+        params = {}
+        dnot = True
+        falselines = []
+        outname = ''
+        for l, line in enumerate(obj):
+            line = line.strip().split(' : ')
+            if line[0] != 'outname':
+                if line[0] in important_params:
+                    if len(line) > 0:
+                        params[line[0]] = check(line[1])
+                        all_params.append(line[0])
+                    else:
+                        dnot=False
+                        falselines.append(line)
+                        break
             else:
-                outname = os.path.split(line[1])[1]
-    if os.path.isfile(outname + corrfile) and dnot:
+                if osoutname:
+                    outname = pfile.replace(sys.argv[2], '')
+                else:
+                    outname = os.path.split(line[1])[1]
+        if os.path.isfile(outname + corrfile) and dnot:
             
-        parameters.append(params)
+            parameters.append(params)
         
-        perform = []
-        permeasure = []
-        pobj = open(outname + corrfile, 'r').readlines()
-        for l, line in enumerate(pobj):
-            if line[0] != '#':
-                perform.append(float(line.strip().split()[1]))
-                permeasure.append(line.strip().split()[0])
-        performance.append(perform)
-        permeasures.append(permeasure)
-        filenames.append(outname)
-    else:
-        if not dnot:
-            print( pfile, falselines)
-        elif not os.path.isfile(outname + corrfile):
-            print( '\nfor', pfile)
-            print( outname + corrfile, 'not a file')
+            perform = []
+            permeasure = []
+            pobj = open(outname + corrfile, 'r').readlines()
+            for l, line in enumerate(pobj):
+                if line[0] != '#':
+                    perform.append(float(line.strip().split()[1]))
+                    permeasure.append(line.strip().split()[0])
+            performance.append(perform)
+            permeasures.append(permeasure)
+            filenames.append(outname)
+        else:
+            if not dnot:
+                print( pfile, falselines)
+            elif not os.path.isfile(outname + corrfile):
+                print( '\nfor', pfile)
+                print( outname + corrfile, 'not a file')
 
 
 uniper = reduce(np.intersect1d, permeasures)